@@ -40,10 +40,10 @@ pip install -r requirements.txt
 
 # Set up systemd service
 echo "Setting up systemd service..."
-cp /var/www/sheepmanager/sheepmanager.service /etc/systemd/system/
+cp /var/www/sheepmanager/sheepmanager.service /var/www/sheepmanager/sheepmanager-tasks.service /etc/systemd/system/
 systemctl daemon-reload
-systemctl enable sheepmanager
-systemctl start sheepmanager
+systemctl enable sheepmanager sheepmanager-tasks
+systemctl start sheepmanager sheepmanager-tasks
 
 # Set up Nginx
 echo "Setting up Nginx..."
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Breed, Sheep, BreedingRecord, LambingRecord, HealthRecord, SheepImage, LambingImage
+from .models import Breed, Sheep, BreedingRecord, LambingRecord, HealthRecord, SheepImage, LambingImage, Task
 
 
 class SheepImageInline(admin.TabularInline):
@@ -107,3 +107,10 @@ class LambingImageAdmin(admin.ModelAdmin):
     list_display = ('caption', 'date_added')
     search_fields = ('caption', 'date_added')
     exclude = ('lambing_records',)
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'priority', 'attempts', 'created_at', 'finished_at')
+    list_filter = ('status', 'name')
+    readonly_fields = ('created_at', 'started_at', 'finished_at', 'heartbeat_at', 'worker')
@@ -0,0 +1,241 @@
+"""
+Read-only JSON API over breeds, sheep and their records.
+
+Each model is described by a Resource: the fields it can return, which
+of them refer to rows of another resource, and the orderings a list can
+be paged on. The views in views.py turn a request into:
+
+- ?fields=a,b,c    only these fields (default: all of them)
+- ?expand=x,y      these relations as nested objects instead of ids
+- ?sort=field      one of the resource's sorts, '-' for descending
+- ?limit=N         rows per page, up to MAX_LIMIT
+- ?after=/before=  the cursors in a page's next and previous links
+
+Rows are read with values() as plain dicts, never as model instances,
+and pages are fetched with a KeysetPaginator, so page 500 costs the same
+as page 1. Expanded relations are fetched after the page, with one query
+per related resource for the whole page, not one per row.
+"""
+from django.core.files.storage import default_storage
+
+from .models import Breed, Sheep, BreedingRecord, LambingRecord, HealthRecord
+from .pagination import KeysetPaginator, InvalidCursor
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class ApiError(ValueError):
+    """A request the API cannot answer; the message is returned to the client"""
+    pass
+
+
+class Resource:
+    """
+    How one model is shown by the API.
+
+    fields maps each output name to the values() lookup it is read from.
+    relations maps output names that hold the id of another resource's
+    row to the name of that resource. embed_fields are the fields a row
+    shows when it is expanded inside another.
+    """
+
+    def __init__(self, name, model, fields, relations=None, embed_fields=None, sorts=('id',), files=()):
+        self.name = name
+        self.model = model
+        self.fields = fields
+        self.relations = relations or {}
+        self.embed_fields = embed_fields or list(fields)
+        self.sorts = [prefix + sort for sort in sorts for prefix in ('', '-')]
+        self.files = files
+
+    def __repr__(self):
+        return f'<Resource {self.name}>'
+
+
+BREED = Resource('breeds', Breed, {
+    'id': 'id',
+    'name': 'name',
+    'description': 'description',
+}, embed_fields=['id', 'name'], sorts=('id', 'name'))
+
+SHEEP = Resource('sheep', Sheep, {
+    'id': 'id',
+    'uuid': 'uuid',
+    'tag_number': 'tag_number',
+    'name': 'name',
+    'gender': 'gender',
+    'date_of_birth': 'date_of_birth',
+    'breed': 'breed_id',
+    'status': 'status',
+    'mother': 'mother_id',
+    'father': 'father_id',
+    'birth_record': 'birth_record_id',
+    'weight_birth': 'weight_birth',
+    'weight_current': 'weight_current',
+    'color': 'color',
+    'markings': 'markings',
+    'primary_image': 'primary_image',
+    'date_acquired': 'date_acquired',
+    'date_removed': 'date_removed',
+    'removal_reason': 'removal_reason',
+    'cull_candidate': 'cull_candidate',
+    'cull_date': 'cull_date',
+    'cull_reason': 'cull_reason',
+    'bottle_lamb': 'bottle_lamb',
+    'bottle_lamb_reason': 'bottle_lamb_reason',
+    'body_type': 'body_type',
+    'udder_type': 'udder_type',
+    'feet_type': 'feet_type',
+    'notes': 'notes',
+    'created_at': 'created_at',
+    'updated_at': 'updated_at',
+}, relations={
+    'breed': 'breeds',
+    'mother': 'sheep',
+    'father': 'sheep',
+    'birth_record': 'lambing',
+}, embed_fields=['id', 'tag_number', 'name', 'gender', 'date_of_birth', 'breed', 'status'],
+    sorts=('id', 'tag_number', 'updated_at'), files=('primary_image',))
+
+BREEDING = Resource('breeding', BreedingRecord, {
+    'id': 'id',
+    'ewe': 'ewe_id',
+    'ram': 'ram_id',
+    'date_started': 'date_started',
+    'date_ended': 'date_ended',
+    'expected_lambing_date': 'expected_lambing_date',
+    'status': 'status',
+    'notes': 'notes',
+}, relations={
+    'ewe': 'sheep',
+    'ram': 'sheep',
+}, embed_fields=['id', 'ewe', 'ram', 'date_started', 'status'], sorts=('id', 'date_started'))
+
+LAMBING = Resource('lambing', LambingRecord, {
+    'id': 'id',
+    'ewe': 'ewe_id',
+    'date': 'date',
+    'assisted': 'assisted',
+    'complications': 'complications',
+    'total_born': 'total_born',
+    'born_alive': 'born_alive',
+    'born_dead': 'born_dead',
+    'primary_image': 'primary_image',
+    'notes': 'notes',
+}, relations={
+    'ewe': 'sheep',
+}, embed_fields=['id', 'ewe', 'date', 'total_born', 'born_alive', 'born_dead'],
+    sorts=('id', 'date'), files=('primary_image',))
+
+HEALTH = Resource('health', HealthRecord, {
+    'id': 'id',
+    'sheep': 'sheep_id',
+    'date': 'date',
+    'record_type': 'record_type',
+    'treatment': 'treatment',
+    'dosage': 'dosage',
+    'administered_by': 'administered_by',
+    'requires_followup': 'requires_followup',
+    'followup_date': 'followup_date',
+    'notes': 'notes',
+}, relations={
+    'sheep': 'sheep',
+}, embed_fields=['id', 'sheep', 'date', 'record_type', 'treatment'], sorts=('id', 'date'))
+
+RESOURCES = {resource.name: resource for resource in (BREED, SHEEP, BREEDING, LAMBING, HEALTH)}
+
+
+def _names(value):
+    return [name for name in (part.strip() for part in value.split(',')) if name]
+
+
+def parse_fields(resource, params):
+    """(fields, expand) asked for by ?fields= and ?expand=, in the resource's order"""
+    fields = _names(params.get('fields', '')) or list(resource.fields)
+    unknown = [name for name in fields if name not in resource.fields]
+    if unknown:
+        raise ApiError(f"Unknown fields: {', '.join(unknown)}. Choose from: {', '.join(resource.fields)}")
+    expand = _names(params.get('expand', ''))
+    unknown = [name for name in expand if name not in resource.relations]
+    if unknown:
+        raise ApiError(f"Cannot expand: {', '.join(unknown)}. Choose from: {', '.join(resource.relations) or 'nothing'}")
+    # An expanded relation is always returned, even when ?fields= leaves it out
+    fields += [name for name in expand if name not in fields]
+    return fields, expand
+
+
+def parse_limit(params):
+    value = params.get('limit')
+    if not value:
+        return DEFAULT_LIMIT
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ApiError("limit must be a whole number")
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ApiError(f"limit must be between 1 and {MAX_LIMIT}")
+    return limit
+
+
+def parse_sort(resource, params):
+    sort = params.get('sort') or resource.sorts[0]
+    if sort not in resource.sorts:
+        raise ApiError(f"Cannot sort by {sort}. Choose from: {', '.join(resource.sorts)}")
+    return sort
+
+
+def _output(resource, rows, fields):
+    """Rows read with values() renamed to the output fields, with file names made into URLs"""
+    pairs = [(name, resource.fields[name]) for name in fields]
+    output = [{name: row[lookup] for name, lookup in pairs} for row in rows]
+    for name in resource.files:
+        if name in fields:
+            for row in output:
+                row[name] = default_storage.url(row[name]) if row[name] else None
+    return output
+
+
+def _expand(resource, rows, expand, using):
+    """Replace the ids of each expanded relation with the related row, one query per related resource"""
+    wanted = {}
+    for name in expand:
+        ids = wanted.setdefault(resource.relations[name], set())
+        ids.update(row[name] for row in rows if row[name] is not None)
+    related = {}
+    for related_name, ids in wanted.items():
+        if not ids:
+            continue
+        related_resource = RESOURCES[related_name]
+        lookups = [related_resource.fields[name] for name in related_resource.embed_fields]
+        found = related_resource.model.objects.using(using).filter(pk__in=ids).values(*lookups)
+        related[related_name] = {
+            row['id']: row for row in _output(related_resource, found, related_resource.embed_fields)
+        }
+    for name in expand:
+        by_id = related.get(resource.relations[name], {})
+        for row in rows:
+            row[name] = by_id.get(row[name])
+    return rows
+
+
+def serialize(resource, queryset, fields, expand=()):
+    """Every row of a queryset of the resource's model as a dict"""
+    rows = _output(resource, queryset.values(*(resource.fields[name] for name in fields)), fields)
+    return _expand(resource, rows, expand, queryset.db) if expand else rows
+
+
+def page(resource, queryset, params, fields, expand=()):
+    """(rows, next cursor, previous cursor) of the page of a queryset a request asks for"""
+    sort = parse_sort(resource, params)
+    lookups = [resource.fields[name] for name in fields]
+    rows = queryset.values('pk', sort.lstrip('-'), *lookups)
+    paginator = KeysetPaginator(rows, sort, per_page=parse_limit(params))
+    try:
+        found = paginator.page(after=params.get('after'), before=params.get('before'))
+    except InvalidCursor:
+        raise ApiError("Invalid page cursor")
+    rows = _output(resource, found.object_list, fields)
+    if expand:
+        _expand(resource, rows, expand, queryset.db)
+    return rows, found.next_cursor, found.previous_cursor
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class SheepConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'sheep'
+
+    def ready(self):
+        # Connect the signal handlers that keep derived data in sync
+        from . import signals  # noqa: F401
+        # Retry statements that find the SQLite database locked
+        from . import sqlite  # noqa: F401
@@ -0,0 +1,218 @@
+"""
+Online backups and clones of the SQLite databases.
+
+Both use SQLite's backup API, which copies the database page by page
+through its own connection and so gives a consistent copy of a database
+that gunicorn is writing to, where copying the file could catch a save
+halfway.
+
+backup() copies BACKUP_PAGES pages per step. Each step is a short read,
+so saves go ahead between steps, and in WAL mode during them too. A
+save in between makes SQLite start the copy over; if that keeps
+happening the copy is taken in a single step, which in WAL mode still
+does not block saves. The copy is checked with PRAGMA integrity_check,
+gzipped into SHEEP_BACKUP_DIR and all but the newest backups of the
+database are deleted. A failed check leaves the older backups alone.
+
+clone() copies one database over another in a single step, for example
+production into dev to look into a problem. Notes can be blanked in the
+copy, and the search index is rebuilt to drop them from it too.
+"""
+import gzip
+import os
+import shutil
+import sqlite3
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from . import search
+
+# Pages copied per step of a backup; SQLite's default page is 4 KiB
+BACKUP_PAGES = 1024
+
+# Times a backup may be started over by saves before it is taken in one step
+MAX_RESTARTS = 3
+
+# Aliases clone() only overwrites when told to
+PROTECTED_ALIASES = ('production',)
+
+# Fields blanked by clone(scrub_notes=True), on every model of the app that has them
+SCRUB_FIELDS = ('notes',)
+
+
+class BackupError(Exception):
+    pass
+
+
+class _Restarted(Exception):
+    pass
+
+
+def backup_dir():
+    return str(getattr(settings, 'SHEEP_BACKUP_DIR', settings.BASE_DIR / 'backups'))
+
+
+def keep():
+    return getattr(settings, 'SHEEP_BACKUP_KEEP', 14)
+
+
+def database_path(alias):
+    """File of a SQLite database alias"""
+    if alias not in connections.settings:
+        raise BackupError(f"No database called {alias!r}; choose from: {', '.join(connections.settings)}")
+    database = connections.settings[alias]
+    if database['ENGINE'] != 'django.db.backends.sqlite3':
+        raise BackupError(f"{alias} is not a SQLite database")
+    return str(database['NAME'])
+
+
+def _existing_path(alias):
+    # Connecting to a missing file would create an empty database
+    path = database_path(alias)
+    if not os.path.exists(path):
+        raise BackupError(f"{alias} has no database file at {path}")
+    return path
+
+
+def _connect(path):
+    # Waits out a save holding the lock, like the site's own connections
+    return sqlite3.connect(path, timeout=30, isolation_level=None)
+
+
+def copy_database(source_path, target_path, pages=BACKUP_PAGES):
+    """Copy a live database with the backup API; returns the times the copy was started over"""
+    restarts = 0
+    source = _connect(source_path)
+    try:
+        target = _connect(target_path)
+        try:
+            remaining_before = None
+
+            def progress(status, remaining, total):
+                nonlocal remaining_before, restarts
+                if remaining_before is not None and remaining > remaining_before:
+                    restarts += 1
+                    if restarts > MAX_RESTARTS:
+                        raise _Restarted
+                remaining_before = remaining
+
+            try:
+                source.backup(target, pages=pages, progress=progress)
+            except _Restarted:
+                source.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+    return restarts
+
+
+def check_integrity(path):
+    """Problems PRAGMA integrity_check finds in a database file; empty when there are none"""
+    connection = sqlite3.connect(path)
+    try:
+        problems = [row[0] for row in connection.execute('PRAGMA integrity_check')]
+    finally:
+        connection.close()
+    return [] if problems == ['ok'] else problems
+
+
+def _compress(path, target_path):
+    partial = f'{target_path}.{os.getpid()}.partial'
+    with open(path, 'rb') as source, gzip.open(partial, 'wb', compresslevel=6) as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+    os.replace(partial, target_path)
+
+
+def list_backups(alias):
+    """Paths of the stored backups of a database alias, newest first"""
+    try:
+        names = os.listdir(backup_dir())
+    except FileNotFoundError:
+        return []
+    prefix = f'{alias}-'
+    return [os.path.join(backup_dir(), name) for name in sorted(names, reverse=True)
+            if name.startswith(prefix) and name.endswith('.sqlite3.gz')]
+
+
+def rotate(alias):
+    """Delete all but the newest SHEEP_BACKUP_KEEP backups of a database; returns the paths deleted"""
+    deleted = list_backups(alias)[keep():]
+    for path in deleted:
+        os.remove(path)
+    return deleted
+
+
+def backup(alias, pages=BACKUP_PAGES):
+    """
+    Take a checked, compressed backup of a database alias.
+
+    Returns the backup's path, its size, how long the copy took and how
+    many times saves started it over.
+    """
+    source_path = _existing_path(alias)
+    os.makedirs(backup_dir(), exist_ok=True)
+    name = f"{alias}-{timezone.now():%Y%m%d-%H%M%S}"
+    # Two backups in the same second must not share the copy
+    copy_path = os.path.join(backup_dir(), f'{name}-{os.getpid()}.sqlite3.partial')
+    path = os.path.join(backup_dir(), f'{name}.sqlite3.gz')
+    try:
+        started = time.perf_counter()
+        restarts = copy_database(source_path, copy_path, pages=pages)
+        seconds = time.perf_counter() - started
+        copy = sqlite3.connect(copy_path)
+        try:
+            # A restored file should not need the -wal file the live database had
+            copy.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            copy.close()
+        problems = check_integrity(copy_path)
+        if problems:
+            raise BackupError(f"The copy of {alias} failed its integrity check: {'; '.join(problems[:5])}")
+        _compress(copy_path, path)
+    finally:
+        if os.path.exists(copy_path):
+            os.remove(copy_path)
+    rotate(alias)
+    return {'path': path, 'bytes': os.path.getsize(path), 'seconds': seconds, 'restarts': restarts}
+
+
+def scrub(using):
+    """Blank SCRUB_FIELDS on every row that has them; returns the number of rows changed"""
+    changed = 0
+    with transaction.atomic(using=using):
+        for model in apps.get_app_config('sheep').get_models():
+            names = [field.name for field in model._meta.get_fields() if field.name in SCRUB_FIELDS]
+            if names:
+                changed += model.objects.using(using).exclude(**{name: '' for name in names}).update(
+                    **{name: '' for name in names}
+                )
+    return changed
+
+
+def clone(source, target, scrub_notes=False, force=False):
+    """
+    Replace the target database with a copy of the source.
+
+    Returns how long the copy took and how many rows were scrubbed.
+    """
+    source_path, target_path = _existing_path(source), database_path(target)
+    if os.path.realpath(source_path) == os.path.realpath(target_path):
+        raise BackupError(f"{source} and {target} are the same database")
+    if target in PROTECTED_ALIASES and not force:
+        raise BackupError(f"Refusing to overwrite {target} without force")
+    connections[target].close()
+    started = time.perf_counter()
+    copy_database(source_path, target_path, pages=-1)
+    seconds = time.perf_counter() - started
+    scrubbed = 0
+    if scrub_notes:
+        scrubbed = scrub(target)
+        # The index holds the notes as well
+        search.rebuild_search_index(using=target)
+    connections[target].close()
+    return {'seconds': seconds, 'scrubbed': scrubbed}
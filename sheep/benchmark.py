@@ -0,0 +1,422 @@
+"""
+Response times and SQL query counts for every page in sheep/urls.py.
+
+run() requests each route through Django's test client as a logged-in
+user and repeats it. It records the status, the number of queries and
+the time taken, including reading the whole body of streamed responses.
+Each route is timed in up to three modes (see MODES): cold, with the
+page caches off, which is what the first visitor after any save gets;
+warm, from the caches; and revalidated, sending the ETag and
+Last-Modified of an earlier response the way a browser does, which
+should be answered with a 304. Routes that take a pk get a sample row
+from the current database, so point the settings at a generated flock
+(see the generate_flock command) to see how pages behave at size.
+
+compare() checks each mode of a run against a stored baseline. These
+count as regressions:
+- a different status
+- more queries
+- a p95 time above the baseline by more than both the tolerance and
+  MIN_SLOWDOWN_MS
+
+concurrency() measures the database rather than pages: several worker
+processes, each with a few threads like the gunicorn workers, read and
+write a copy of it at once, first as plain SQLite and then as the
+settings configure it, and report operations per second and how many
+failed with 'database is locked'.
+"""
+import json
+import math
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.db import OperationalError, connections, router, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import URLPattern, reverse
+from django.utils import timezone
+
+from . import profiling, urls
+from .models import Breed, Sheep, SheepImage, BreedingRecord, LambingRecord, LambingImage, HealthRecord, Task
+from .sqlite import is_locked
+
+
+def _first(model, *ordering, **filters):
+    return lambda using: model.objects.using(using).filter(**filters).order_by(*ordering).values_list('pk', flat=True).first()
+
+
+# Sample pk for routes that take one. Sheep pages use the youngest sheep with both parents, for
+# the deepest pedigree, and the descendants export uses the oldest ewe, for the largest family.
+SAMPLE_SHEEP = _first(Sheep, '-date_of_birth', '-pk', mother__isnull=False, father__isnull=False)
+SAMPLE_EWE = _first(Sheep, '-pk', gender='F', status='ACTIVE')
+PK_SAMPLES = {
+    'breed-detail': _first(Breed, 'pk'),
+    'breed-update': _first(Breed, 'pk'),
+    'breed-delete': _first(Breed, 'pk'),
+    'sheep-detail': SAMPLE_SHEEP,
+    'sheep-update': SAMPLE_SHEEP,
+    'sheep-delete': SAMPLE_SHEEP,
+    'sheep-add-image': SAMPLE_SHEEP,
+    'sheep-pedigree': SAMPLE_SHEEP,
+    'sheep-descendants-export': _first(Sheep, 'date_of_birth', 'pk', gender='F', date_of_birth__isnull=False),
+    'sheep-delete-image': _first(SheepImage, 'pk'),
+    'breeding-record-detail': _first(BreedingRecord, '-pk'),
+    'breeding-record-update': _first(BreedingRecord, '-pk'),
+    'breeding-record-delete': _first(BreedingRecord, '-pk'),
+    'ewe-breeding-record-create': SAMPLE_EWE,
+    'lambing-record-detail': _first(LambingRecord, '-pk'),
+    'lambing-record-update': _first(LambingRecord, '-pk'),
+    'lambing-record-delete': _first(LambingRecord, '-pk'),
+    'lambing-add-image': _first(LambingRecord, '-pk'),
+    'ewe-lambing-record-create': SAMPLE_EWE,
+    'lambing-delete-image': _first(LambingImage, 'pk'),
+    'health-record-detail': _first(HealthRecord, '-pk'),
+    'health-record-update': _first(HealthRecord, '-pk'),
+    'health-record-delete': _first(HealthRecord, '-pk'),
+    'ewe-health-record-create': SAMPLE_EWE,
+    'ewe-add-health-record': SAMPLE_EWE,
+    'api-breed-detail': _first(Breed, 'pk'),
+    'api-sheep-detail': SAMPLE_SHEEP,
+    'api-breeding-record-detail': _first(BreedingRecord, '-pk'),
+    'api-lambing-record-detail': _first(LambingRecord, '-pk'),
+    'api-health-record-detail': _first(HealthRecord, '-pk'),
+    'task-detail': _first(Task, '-pk'),
+    'api-task-detail': _first(Task, '-pk'),
+    'task-download': _first(Task, '-pk', name='export', status='SUCCEEDED'),
+}
+
+
+def _search_query(using):
+    tag = Sheep.objects.using(using).order_by('-pk').values_list('tag_number', flat=True).first()
+    return {'q': tag or 'ewe'}
+
+
+def _inbreeding_query(using):
+    ram = _first(Sheep, '-pk', gender='M', status='ACTIVE')(using)
+    return {'ewe': SAMPLE_EWE(using), 'ram': ram} if ram else None
+
+
+# Query string for routes that do nothing useful without one
+QUERY_SAMPLES = {
+    'search': _search_query,
+    'expected-inbreeding': _inbreeding_query,
+    'breeding-plan': lambda using: {'capacity': 50, 'max_inbreeding': '12.5'},
+}
+
+def _profile_kwargs(using):
+    profiles = profiling.list_profiles()
+    return {'profile_id': profiles[0]['id']} if profiles else None
+
+
+# Other URL arguments, or a function of the database returning them; None when there is no sample
+KWARG_SAMPLES = {
+    'flock-export': {'kind': 'sheep', 'format': 'csv'},
+    'profile-detail': _profile_kwargs,
+    'profile-download': _profile_kwargs,
+}
+
+# Routes that change data on GET, or only answer POST
+UNSAFE_ROUTES = {'breeding-record-duplicate', 'flock-export-task', 'sheep-bulk-action'}
+
+# Pages outside sheep/urls.py that are benchmarked too
+EXTRA_ROUTES = ('home',)
+
+# Slowdowns smaller than this are noise, whatever the tolerance
+MIN_SLOWDOWN_MS = 5
+
+# How each route is requested: page caches off, page caches on, and with a browser's validators
+MODES = ('cold', 'warm', 'revalidated')
+
+CACHES_OFF = {'SHEEP_RESPONSE_CACHE_TIMEOUT': 0, 'SHEEP_DETAIL_CACHE_TIMEOUT': 0}
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def routes(using=None, names=None):
+    """(name, url) for every route to benchmark; url is None when there is no sample for it"""
+    using = using or router.db_for_read(Sheep)
+    found = list(EXTRA_ROUTES)
+    for pattern in urls.urlpatterns:
+        # A name shared by two routes reverses to the same view
+        if isinstance(pattern, URLPattern) and pattern.name not in found and pattern.name not in UNSAFE_ROUTES:
+            found.append(pattern.name)
+    for name in found:
+        if names and name not in names:
+            continue
+        kwargs = KWARG_SAMPLES.get(name, {})
+        kwargs = kwargs(using) if callable(kwargs) else dict(kwargs)
+        if kwargs is not None and name in PK_SAMPLES:
+            kwargs['pk'] = PK_SAMPLES[name](using)
+        query = QUERY_SAMPLES[name](using) if name in QUERY_SAMPLES else {}
+        if kwargs is None or kwargs.get('pk', 0) is None or query is None:
+            yield name, None
+            continue
+        url = reverse(name, kwargs=kwargs)
+        yield name, f'{url}?{urlencode(query)}' if query else url
+
+
+def _client(user):
+    # The test client's default host is not in ALLOWED_HOSTS outside the test runner
+    hosts = [host for host in settings.ALLOWED_HOSTS if host not in ('*',) and not host.startswith('.')]
+    client = Client(HTTP_HOST=hosts[0] if hosts else 'localhost', raise_request_exception=False)
+    client.force_login(user)
+    return client
+
+
+def _request(client, url, headers=None):
+    response = client.get(url, **(headers or {}))
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    else:
+        response.content
+    return response
+
+
+def _validators(response):
+    """The conditional request headers a browser would send back for a response"""
+    headers = {}
+    if response.has_header('ETag'):
+        headers['HTTP_IF_NONE_MATCH'] = response['ETag']
+    if response.has_header('Last-Modified'):
+        headers['HTTP_IF_MODIFIED_SINCE'] = response['Last-Modified']
+    return headers
+
+
+def _time(client, connection, url, repeat, headers=None):
+    times, queries = [], []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            response = _request(client, url, headers)
+            times.append((time.perf_counter() - started) * 1000)
+        queries.append(len(captured.captured_queries))
+    return {
+        'status': response.status_code,
+        'queries': max(queries),
+        'p50_ms': round(percentile(times, 0.5), 2),
+        'p95_ms': round(percentile(times, 0.95), 2),
+        'max_ms': round(max(times), 2),
+    }
+
+
+def run(user, repeat=5, warmup=1, names=None, modes=MODES, using=None, stdout=None):
+    """
+    Benchmark every route; returns {route name: result} in route order.
+
+    Each result holds the route's url and a timing for each of the modes.
+    """
+    using = using or router.db_for_read(Sheep)
+    connection = connections[using]
+    client = _client(user)
+    results = {}
+    for name, url in routes(using, names):
+        if url is None:
+            results[name] = {'url': None, 'skipped': 'no sample data'}
+            continue
+        result = results[name] = {'url': url}
+        if 'cold' in modes:
+            with override_settings(**CACHES_OFF):
+                for _ in range(warmup):
+                    _request(client, url)
+                result['cold'] = _time(client, connection, url, repeat)
+        if 'warm' in modes:
+            # Also fills the caches
+            for _ in range(warmup):
+                _request(client, url)
+            result['warm'] = _time(client, connection, url, repeat)
+        if 'revalidated' in modes:
+            headers = _validators(_request(client, url))
+            if headers:
+                result['revalidated'] = _time(client, connection, url, repeat, headers)
+            else:
+                result['revalidated'] = {'skipped': 'no ETag or Last-Modified'}
+        if stdout:
+            stdout.write(f"{url}: " + ', '.join(
+                f"{mode} {timing['p50_ms']} ms, {timing['queries']} queries"
+                for mode, timing in result.items() if mode in MODES and 'skipped' not in timing
+            ))
+    return results
+
+
+def flock_size(using=None):
+    """Row counts stored with a baseline, so runs on different flocks are told apart"""
+    using = using or router.db_for_read(Sheep)
+    return {model._meta.model_name: model.objects.using(using).count()
+            for model in (Sheep, BreedingRecord, LambingRecord, HealthRecord)}
+
+
+def save_baseline(path, results, using=None):
+    with open(path, 'w') as file:
+        json.dump({'flock': flock_size(using), 'results': results}, file, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Regressions of a run against a baseline, as messages; modes missing from either are not compared"""
+    regressions = []
+    for name, result in results.items():
+        before = baseline['results'].get(name)
+        if 'skipped' in result or not before or 'skipped' in before:
+            continue
+        for mode in MODES:
+            now, then = result.get(mode), before.get(mode)
+            if not now or not then or 'skipped' in now or 'skipped' in then:
+                continue
+            if now['status'] != then['status']:
+                regressions.append(f"{name} ({mode}): status {then['status']} -> {now['status']}")
+            if now['queries'] > then['queries']:
+                regressions.append(f"{name} ({mode}): {then['queries']} -> {now['queries']} queries")
+            slowdown = now['p95_ms'] - then['p95_ms']
+            if slowdown > MIN_SLOWDOWN_MS and now['p95_ms'] > then['p95_ms'] * (1 + tolerance):
+                regressions.append(f"{name} ({mode}): p95 {then['p95_ms']} -> {now['p95_ms']} ms")
+    return regressions
+
+
+# Alias the concurrency benchmark opens its copies of the database under
+CONCURRENCY_ALIAS = 'concurrency-benchmark'
+
+# Sheep the concurrent reads and writes pick from
+CONCURRENCY_SAMPLE = 1000
+
+
+def _read(using, sheep_id):
+    """What a sheep page and a page of the sheep list read"""
+    sheep = Sheep.objects.using(using).select_related('breed', 'mother', 'father').get(pk=sheep_id)
+    list(sheep.health_records.using(using).order_by('-date')[:20])
+    list(sheep.lambings.using(using).order_by('-date')[:20])
+    list(Sheep.objects.using(using).select_related('breed').filter(status='ACTIVE').order_by('tag_number')[:50])
+
+
+def _write(using, sheep_id):
+    """What saving a weighing with a health record writes, signals and all"""
+    with transaction.atomic(using=using):
+        sheep = Sheep.objects.using(using).get(pk=sheep_id)
+        sheep.weight_current = round(random.uniform(40, 90), 1)
+        sheep.save(using=using, update_fields=['weight_current'])
+        HealthRecord.objects.using(using).create(
+            sheep=sheep, date=timezone.localdate(), record_type='OTHER', treatment='Weighed',
+        )
+
+
+def _worker_thread(start, seconds, write_share, sample_ids, timings):
+    rng = random.Random()
+    time.sleep(max(0, start - time.time()))
+    finish = time.perf_counter() + seconds
+    connection = connections[CONCURRENCY_ALIAS]
+    while time.perf_counter() < finish:
+        kind = 'write' if rng.random() < write_share else 'read'
+        started = time.perf_counter()
+        try:
+            (_write if kind == 'write' else _read)(CONCURRENCY_ALIAS, rng.choice(sample_ids))
+            outcome = 'ok'
+        except OperationalError as error:
+            if not is_locked(error):
+                raise
+            outcome = 'locked'
+        timings.append((kind, outcome, (time.perf_counter() - started) * 1000))
+        # As Django does at the end of every request
+        connection.close_if_unusable_or_obsolete()
+    connection.close()
+
+
+def _worker_process(threads, start, seconds, write_share, sample_ids, overrides, queue):
+    timings = []
+    with override_settings(**overrides):
+        workers = [
+            threading.Thread(target=_worker_thread, args=(start, seconds, write_share, sample_ids, timings))
+            for _ in range(threads)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    queue.put(timings)
+
+
+def _summary(timings, seconds):
+    result = {}
+    for kind in ('read', 'write'):
+        times = [ms for timed_kind, outcome, ms in timings if timed_kind == kind and outcome == 'ok']
+        result[kind] = {
+            'per_second': round(len(times) / seconds, 1),
+            'locked': sum(1 for timed_kind, outcome, _ in timings if timed_kind == kind and outcome == 'locked'),
+            'p50_ms': round(percentile(times, 0.5), 2) if times else None,
+            'p95_ms': round(percentile(times, 0.95), 2) if times else None,
+            'max_ms': round(max(times), 2) if times else None,
+        }
+    return result
+
+
+def concurrency(processes=3, threads=2, seconds=10, write_share=0.2, using=None, stdout=None):
+    """
+    Read and write throughput of worker processes sharing the database at once.
+
+    Runs twice, each time on a fresh copy of the database so nothing is
+    written to it: 'defaults' opens the copy as plain SQLite does, without
+    WAL, pragmas, kept connections or retries; 'configured' opens it with
+    the alias's DATABASES settings and SHEEP_SQLITE_LOCK_RETRIES. Returns
+    {profile: {'read': ..., 'write': ...}}.
+    """
+    using = using or router.db_for_write(Sheep)
+    source = connections[using]
+    sample_ids = list(Sheep.objects.using(using).order_by('?').values_list('pk', flat=True)[:CONCURRENCY_SAMPLE])
+    if not sample_ids:
+        return {}
+    configured = connections.settings[using]
+    profiles = {
+        'defaults': (
+            dict(configured, OPTIONS={}, CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=False),
+            {'SHEEP_SQLITE_LOCK_RETRIES': 0},
+        ),
+        'configured': (dict(configured), {}),
+    }
+    # Cache invalidations of the copy's rows would clear pages cached from the real database
+    caches_off = {'SHEEP_RESPONSE_CACHE_TIMEOUT': 0, 'SHEEP_DETAIL_CACHE_TIMEOUT': 0}
+    context = multiprocessing.get_context('fork')
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for profile, (database, overrides) in profiles.items():
+            path = os.path.join(directory, f'{profile}.sqlite3')
+            source.ensure_connection()
+            copy = sqlite3.connect(path)
+            source.connection.backup(copy)
+            # Journal mode is kept in the file, so start each profile from SQLite's default
+            copy.execute('PRAGMA journal_mode=DELETE')
+            copy.close()
+            # Forked workers must not share the parent's connections
+            connections.close_all()
+            connections.settings[CONCURRENCY_ALIAS] = dict(database, NAME=path)
+            queue = context.Queue()
+            start = time.time() + 0.5
+            workers = [
+                context.Process(target=_worker_process, args=(
+                    threads, start, seconds, write_share, sample_ids, {**overrides, **caches_off}, queue,
+                ))
+                for _ in range(processes)
+            ]
+            for worker in workers:
+                worker.start()
+            timings = [timing for _ in workers for timing in queue.get()]
+            for worker in workers:
+                worker.join()
+            del connections.settings[CONCURRENCY_ALIAS]
+            results[profile] = _summary(timings, seconds)
+            if stdout:
+                stdout.write(f"{profile}: {len(timings)} operations")
+    return results
@@ -0,0 +1,140 @@
+"""
+Assign active ewes to rams for the breeding season.
+
+The assignment is a min-cost flow: every ewe goes to at most one ram, every
+ram takes at most `capacity` ewes, pairs at or above `max_kinship` are not
+allowed, and the total kinship of the chosen pairs is as small as possible.
+
+It is solved exactly with successive shortest paths. Because there are only
+a handful of rams, the residual graph is searched over rams alone: moving a
+ewe from ram A to ram B costs kinship(ewe, B) - kinship(ewe, A).
+"""
+from django.db import router, transaction
+
+from . import kinship, signals
+from .models import BreedingRecord
+
+# Half siblings and closer
+DEFAULT_MAX_KINSHIP = 0.125
+
+
+class BreedingPlan:
+    """Result of plan_breeding_groups"""
+
+    def __init__(self, assignment, matrix, unassigned):
+        # ewe_id -> ram_id
+        self.assignment = assignment
+        # (ewe_id, ram_id) -> kinship
+        self.matrix = matrix
+        # ewe ids that could not be placed with any ram
+        self.unassigned = unassigned
+
+    @property
+    def total_kinship(self):
+        return sum(self.matrix[(ewe_id, ram_id)] for ewe_id, ram_id in self.assignment.items())
+
+    def groups(self):
+        """{ram_id: [(ewe_id, kinship), ...]} sorted by kinship"""
+        groups = {}
+        for ewe_id, ram_id in self.assignment.items():
+            groups.setdefault(ram_id, []).append((ewe_id, self.matrix[(ewe_id, ram_id)]))
+        for members in groups.values():
+            members.sort(key=lambda member: member[1])
+        return groups
+
+
+def _augment(unplaced, ram_ids, cost, allowed, members, capacity):
+    """
+    Place one more ewe along the cheapest chain of moves (Bellman-Ford over rams).
+
+    Any unplaced ewe may start the chain, which is what keeps the plan
+    optimal when there are more ewes than ram capacity. Returns the list of
+    (ewe_id, ram_id) moves to apply, or None if no further ewe can be placed
+    without breaking a capacity or relatedness limit.
+    """
+    infinity = float('inf')
+    # Cheapest single-ewe move between each pair of rams: (from, to) -> (cost change, ewe)
+    edges = {}
+    for from_ram in ram_ids:
+        for moved_ewe in members[from_ram]:
+            current = cost[(moved_ewe, from_ram)]
+            for to_ram in ram_ids:
+                if to_ram == from_ram or not allowed(moved_ewe, to_ram):
+                    continue
+                delta = cost[(moved_ewe, to_ram)] - current
+                if (from_ram, to_ram) not in edges or delta < edges[(from_ram, to_ram)][0]:
+                    edges[(from_ram, to_ram)] = (delta, moved_ewe)
+
+    distance = {ram_id: infinity for ram_id in ram_ids}
+    # ram_id -> unplaced ewe that reaches it most cheaply
+    start = {}
+    for ewe_id in unplaced:
+        for ram_id in ram_ids:
+            if allowed(ewe_id, ram_id) and cost[(ewe_id, ram_id)] < distance[ram_id]:
+                distance[ram_id] = cost[(ewe_id, ram_id)]
+                start[ram_id] = ewe_id
+    # ram_id -> (previous ram_id, ewe moved from previous ram into this one)
+    previous = {ram_id: None for ram_id in ram_ids}
+    for _ in range(len(ram_ids)):
+        changed = False
+        for (from_ram, to_ram), (delta, moved_ewe) in edges.items():
+            if distance[from_ram] + delta < distance[to_ram] - 1e-12:
+                distance[to_ram] = distance[from_ram] + delta
+                previous[to_ram] = (from_ram, moved_ewe)
+                changed = True
+        if not changed:
+            break
+
+    open_rams = [ram_id for ram_id in ram_ids
+                 if len(members[ram_id]) < capacity and distance[ram_id] < infinity]
+    if not open_rams:
+        return None
+    ram_id = min(open_rams, key=lambda ram: distance[ram])
+
+    moves = []
+    seen = set()
+    while previous[ram_id] is not None and ram_id not in seen:
+        seen.add(ram_id)
+        from_ram, moved_ewe = previous[ram_id]
+        moves.append((moved_ewe, ram_id))
+        ram_id = from_ram
+    moves.append((start[ram_id], ram_id))
+    return moves
+
+
+def plan_breeding_groups(ewe_ids, ram_ids, capacity, max_kinship=DEFAULT_MAX_KINSHIP):
+    """Propose a ram for each ewe that minimizes total kinship between mates"""
+    ewe_ids = list(ewe_ids)
+    ram_ids = list(ram_ids)
+    matrix = kinship.kinship_matrix(ewe_ids, ram_ids)
+
+    def allowed(ewe_id, ram_id):
+        return matrix[(ewe_id, ram_id)] < max_kinship
+
+    assignment = {}
+    members = {ram_id: set() for ram_id in ram_ids}
+    unplaced = sorted(ewe_ids)
+    while unplaced:
+        moves = _augment(unplaced, ram_ids, matrix, allowed, members, capacity)
+        if moves is None:
+            break
+        for moved_ewe, ram_id in moves:
+            if moved_ewe in assignment:
+                members[assignment[moved_ewe]].discard(moved_ewe)
+            assignment[moved_ewe] = ram_id
+            members[ram_id].add(moved_ewe)
+        unplaced.remove(moves[-1][0])
+    return BreedingPlan(assignment, matrix, unplaced)
+
+
+def create_breeding_records(pairs, date_started, status='PLANNED', notes='', using=None):
+    """Create one BreedingRecord per (ewe_id, ram_id) pair in a single transaction"""
+    using = using or router.db_for_write(BreedingRecord)
+    records = [
+        BreedingRecord(ewe_id=ewe_id, ram_id=ram_id, date_started=date_started, status=status, notes=notes)
+        for ewe_id, ram_id in pairs
+    ]
+    with transaction.atomic(using=using):
+        records = BreedingRecord.objects.using(using).bulk_create(records, batch_size=500)
+        signals.after_bulk_write(BreedingRecord, records, using=using)
+    return records
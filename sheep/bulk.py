@@ -0,0 +1,236 @@
+"""
+Changes to many sheep at once: a treatment given to the whole flock, or
+a truckload of lambs sold.
+
+Animals are picked by status, breed, birth year and an explicit list of
+tags, all of which must match; a listed tag the other choices leave out
+is reported rather than dropped. A treatment becomes one HealthRecord
+per animal, created with a single bulk_create in the transaction that
+checks the selection one last time. A status
+change or cull flag is one UPDATE of every selected sheep, applied only
+if problems() finds nothing wrong with any of them.
+
+bulk_create and update skip model signals, so signals.after_bulk_write()
+does what they would have done for each row once for the whole batch,
+in the same transaction. A status change works out its own change to
+the dashboard counts, from the statuses the sheep had before.
+"""
+import re
+from collections import Counter
+
+from django.db import router, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from . import dashboard, signals
+from .models import Sheep, HealthRecord
+
+# Rows per INSERT statement
+BATCH_SIZE = 500
+
+# Tags named in one problem with a selection; the rest are counted
+PROBLEM_TAGS = 10
+
+# HealthRecord fields a treatment sets on every record
+TREATMENT_FIELDS = [
+    'date', 'record_type', 'treatment', 'dosage', 'administered_by',
+    'requires_followup', 'followup_date', 'notes',
+]
+
+
+def parse_tags(text):
+    """Tag numbers separated by commas, semicolons or white space, in order and without repeats"""
+    return list(dict.fromkeys(tag for tag in re.split(r'[\s,;]+', text or '') if tag))
+
+
+class BulkError(Exception):
+    """The selected sheep do not pass their checks; nothing was saved"""
+
+    def __init__(self, problems):
+        super().__init__('; '.join(problems))
+        self.problems = problems
+
+
+def _listed(items):
+    if len(items) <= PROBLEM_TAGS:
+        return ', '.join(items)
+    return f"{', '.join(items[:PROBLEM_TAGS])} and {len(items) - PROBLEM_TAGS} more"
+
+
+def select_sheep(status=None, breed=None, birth_year=None, tags=None, using=None):
+    """
+    Sheep matching every criterion given, by tag number.
+
+    Returns the queryset and the problems with the tags asked for: tags
+    not in the flock, and tags of sheep the other criteria leave out.
+    """
+    queryset = Sheep.objects.using(using or router.db_for_read(Sheep))
+    if status:
+        queryset = queryset.filter(status=status)
+    if breed:
+        queryset = queryset.filter(breed=breed)
+    if birth_year:
+        queryset = queryset.filter(date_of_birth__year=birth_year)
+    problems = []
+    if tags:
+        known = dict(Sheep.objects.using(queryset.db).filter(tag_number__in=tags).values_list('tag_number', 'status'))
+        queryset = queryset.filter(tag_number__in=tags)
+        matching = set(queryset.values_list('tag_number', flat=True))
+        missing = [tag for tag in tags if tag not in known]
+        statuses = dict(Sheep.STATUS_CHOICES)
+        left_out = [f"{tag} ({statuses[known[tag]]})" for tag in tags if tag in known and tag not in matching]
+        if missing:
+            problems.append(f"Not in the flock: {_listed(missing)}")
+        if left_out:
+            problems.append(f"Left out by the status, breed or birth year chosen: {_listed(left_out)}")
+    return queryset.order_by('tag_number'), problems
+
+
+def treat(sheep_ids, values, using=None):
+    """Create a HealthRecord with the same TREATMENT_FIELDS values for every sheep; returns the records"""
+    using = using or router.db_for_write(HealthRecord)
+    sheep_ids = list(dict.fromkeys(sheep_ids))
+    fields = {name: values[name] for name in TREATMENT_FIELDS if name in values}
+    records = [HealthRecord(sheep_id=sheep_id, **fields) for sheep_id in sheep_ids]
+    if not records:
+        return records
+    with transaction.atomic(using=using):
+        HealthRecord.objects.using(using).bulk_create(records, batch_size=BATCH_SIZE)
+        signals.after_bulk_write(HealthRecord, records, using=using)
+    return records
+
+
+def treat_selection(values, using=None, **criteria):
+    """
+    Treat every sheep select_sheep() picks for the criteria; returns the records.
+
+    The selection is checked again in the transaction that writes the
+    records, so sheep changed since the form was checked are not treated
+    by mistake. Raises BulkError, saving nothing, when it fails.
+    """
+    using = using or router.db_for_write(HealthRecord)
+    with transaction.atomic(using=using):
+        selection, problems = select_sheep(using=using, **criteria)
+        sheep_ids = list(selection.values_list('pk', flat=True))
+        if not problems and not sheep_ids:
+            problems = ["No animals match those choices."]
+        if problems:
+            raise BulkError(problems)
+        return treat(sheep_ids, values, using=using)
+
+
+# action -> (label, what was done, for the summary)
+SHEEP_ACTIONS = {
+    'SOLD': ('Mark as sold', 'marked as sold'),
+    'CULLED': ('Mark as culled', 'marked as culled'),
+    'HARVESTED': ('Mark as harvested', 'marked as harvested'),
+    'DECEASED': ('Mark as deceased', 'marked as deceased'),
+    'ACTIVE': ('Return to active', 'returned to active'),
+    'flag-cull': ('Flag as cull candidates', 'flagged as cull candidates'),
+    'clear-cull': ('Clear cull flag', 'no longer flagged for culling'),
+}
+
+# Statuses that take a sheep out of the flock, with a removal date and reason
+REMOVAL_STATUSES = [status for status, _ in Sheep.STATUS_CHOICES if status != 'ACTIVE']
+
+
+def _tag_list(queryset):
+    tags = list(queryset.order_by('tag_number').values_list('tag_number', flat=True)[:PROBLEM_TAGS + 1])
+    if len(tags) <= PROBLEM_TAGS:
+        return ', '.join(tags)
+    return f"{', '.join(tags[:PROBLEM_TAGS])} and {queryset.count() - PROBLEM_TAGS} more"
+
+
+def action_values(action, date=None, reason=''):
+    """Field values an action sets on every selected sheep"""
+    if action in REMOVAL_STATUSES:
+        return {'status': action, 'date_removed': date or timezone.localdate(), 'removal_reason': reason}
+    if action == 'ACTIVE':
+        return {'status': 'ACTIVE', 'date_removed': None, 'removal_reason': ''}
+    if action == 'flag-cull':
+        return {'cull_candidate': True, 'cull_date': date, 'cull_reason': reason}
+    if action == 'clear-cull':
+        return {'cull_candidate': False, 'cull_date': None, 'cull_reason': ''}
+    raise ValueError(f"Unknown action {action!r}")
+
+
+def problems(sheep_ids, action, date=None, using=None):
+    """
+    Reasons the action cannot be applied to the selected sheep; empty when it can be applied to all of them.
+
+    Only as good as the moment it runs: apply_action() runs it in the
+    transaction that writes the change.
+    """
+    selected = Sheep.objects.using(using or router.db_for_read(Sheep)).filter(pk__in=sheep_ids)
+    found = []
+    if date and date > timezone.localdate():
+        found.append("The date cannot be in the future.")
+    checks = []
+    if action in REMOVAL_STATUSES:
+        checks.append((~Q(status='ACTIVE'), "Only active sheep can be removed from the flock"))
+        if date:
+            checks.append((Q(date_of_birth__gt=date), f"Born after {date:%b %d, %Y}"))
+    elif action == 'ACTIVE':
+        checks.append((Q(status='ACTIVE'), "Already active"))
+    elif action == 'flag-cull':
+        checks.append((~Q(status='ACTIVE'), "Only active sheep can be flagged for culling"))
+    elif action == 'clear-cull':
+        checks.append((Q(cull_candidate=False), "Not flagged for culling"))
+    for condition, message in checks:
+        matching = selected.filter(condition)
+        if matching.exists():
+            found.append(f"{message}: {_tag_list(matching)}")
+    return found
+
+
+def _headcounts(queryset):
+    totals = Counter()
+    fields, counters = dashboard.COUNTERS[Sheep]
+    for *values, rows in queryset.order_by().values_list(*fields).annotate(rows=Count('pk')):
+        for name, amount in counters(*values).items():
+            totals[name] += amount * rows
+    return totals
+
+
+def update_sheep(sheep_ids, values, using=None):
+    """
+    Set the same field values on every given sheep with one UPDATE.
+
+    Returns the number of sheep changed and how many of them had each
+    status before.
+    """
+    using = using or router.db_for_write(Sheep)
+    sheep_ids = list(dict.fromkeys(sheep_ids))
+    selected = Sheep.objects.using(using).filter(pk__in=sheep_ids)
+    with transaction.atomic(using=using):
+        previous = Counter(dict(selected.order_by().values_list('status').annotate(rows=Count('pk'))))
+        counted = bool(set(values) & set(dashboard.COUNTERS[Sheep][0]))
+        before = _headcounts(selected) if counted else Counter()
+        updated = selected.update(**values, updated_at=timezone.now())
+        if counted:
+            delta = _headcounts(selected)
+            delta.subtract(before)
+            dashboard.apply(delta, using=using)
+        # Status, removal and cull fields are not indexed for search
+        signals.after_bulk_write(Sheep, selected.only('mother_id', 'father_id'), using=using, created=False)
+    return {'updated': updated, 'previous': previous}
+
+
+def apply_action(sheep_ids, action, date=None, reason='', using=None):
+    """
+    Apply one of SHEEP_ACTIONS to every given sheep; returns update_sheep()'s summary.
+
+    The sheep are locked, problems() checks them and the UPDATE is made
+    in one transaction, so a sheep another worker changes after the check
+    cannot be removed twice. On SQLite the IMMEDIATE transaction holds the
+    write lock from the start; elsewhere select_for_update() holds the
+    rows. Raises BulkError, saving nothing, when it finds any problem.
+    """
+    using = using or router.db_for_write(Sheep)
+    with transaction.atomic(using=using):
+        locked = Sheep.objects.using(using).select_for_update().filter(pk__in=sheep_ids)
+        sheep_ids = list(locked.values_list('pk', flat=True))
+        found = problems(sheep_ids, action, date, using=using)
+        if found:
+            raise BulkError(found)
+        return update_sheep(sheep_ids, action_values(action, date, reason), using=using)
@@ -0,0 +1,185 @@
+"""
+ETag and Last-Modified validators for conditional GET.
+
+Every row the site shows gets a new SyncChange entry, with a higher id,
+whenever it is saved or deleted (see sheep/sync.py). That makes the
+change feed a set of modification stamps that can be trusted:
+
+- model_stamp() is the latest entry of whole models. Deletes leave
+  tombstones, so it moves on any change, and it gives a Last-Modified
+  time as well as an ETag. List pages and exports use it.
+- rows_stamp() is the highest entry id and the number of entries among
+  the rows a detail page shows. An edit or an added row raises the
+  highest id, and a deleted row lowers the count or the highest id. A
+  row that leaves the set leaves no stamp behind, so there is no honest
+  Last-Modified for such a set and these pages send an ETag only.
+
+Each costs an indexed query or a few, so a browser revalidating an
+unchanged page gets a 304 without the page's own queries or rendering.
+
+The validators also cover what changes a page without touching its
+rows: the date (pages show ages), the code deployed and, for the ETag,
+the user and their CSRF secret. Logging in rotates the secret, and a
+copy kept from before would post its forms with the old token.
+Responses are marked private and no-cache, so browsers always ask
+before reusing a copy and shared caches never keep one.
+
+Conditional GET is on unless SHEEP_CONDITIONAL_GET is False.
+"""
+import hashlib
+import os
+from datetime import datetime, time, timezone as dt_timezone
+from functools import lru_cache, wraps
+
+from django.conf import settings
+from django.contrib import messages
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from .models import SyncChange
+from .sync import KINDS
+
+
+def enabled():
+    return getattr(settings, 'SHEEP_CONDITIONAL_GET', True)
+
+
+@lru_cache(maxsize=None)
+def code_version():
+    """Newest modification time of the project's code and templates, read once per process"""
+    newest = 0
+    for app in ('sheep', 'sheepflock'):
+        for root, dirs, files in os.walk(os.path.join(settings.BASE_DIR, app)):
+            dirs[:] = [name for name in dirs if name != '__pycache__']
+            for name in files:
+                if name.endswith(('.py', '.html')):
+                    newest = max(newest, os.stat(os.path.join(root, name)).st_mtime_ns)
+    return str(newest)
+
+
+def model_stamp(*models, using=None):
+    """(version, last modified) of the latest change to any row of the models; (0, None) if none"""
+    changes = SyncChange.objects.using(using)
+    latest = [
+        changes.filter(kind=KINDS[model]).order_by('-pk').values_list('pk', 'changed_at').first()
+        for model in models
+    ]
+    latest = [stamp for stamp in latest if stamp]
+    return max(latest) if latest else (0, None)
+
+
+def rows_stamp(*scopes, using=None):
+    """
+    'version-count' of the rows in scope, or None if there are none.
+
+    Each scope is a (model, ids) pair, where ids is a list of ids or a
+    values() queryset of them.
+    """
+    in_scope = Q()
+    for model, ids in scopes:
+        in_scope |= Q(kind=KINDS[model], object_id__in=ids)
+    stamp = SyncChange.objects.using(using).filter(in_scope, deleted=False).aggregate(version=Max('pk'), count=Count('pk'))
+    if not stamp['count']:
+        return None
+    return f"{stamp['version']}-{stamp['count']}"
+
+
+def etag(request, *parts):
+    """ETag of a page for the requesting user, from the stamps it depends on"""
+    if any(part is None for part in parts) or len(messages.get_messages(request)):
+        # Missing rows 404 as usual; pending messages must be rendered and used up
+        return None
+    user = request.user.pk if request.user.is_authenticated else 0
+    csrf_secret = request.META.get('CSRF_COOKIE', '')
+    key = ':'.join(str(part) for part in (user, csrf_secret, timezone.localdate(), code_version(), *parts))
+    return hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
+
+
+def last_modified(request, changed_at):
+    """Last-Modified of a page from its latest change, moved on by midnight and deploys like the ETag"""
+    if changed_at is None or len(messages.get_messages(request)):
+        return None
+    midnight = timezone.make_aware(datetime.combine(timezone.localdate(), time.min))
+    deployed = datetime.fromtimestamp(int(code_version()) / 1e9, tz=dt_timezone.utc)
+    return max(changed_at, midnight, deployed)
+
+
+def request_stamp(request, *models):
+    """model_stamp() of the models, worked out once per request"""
+    stamps = request.__dict__.setdefault('_conditional_stamps', {})
+    if models not in stamps:
+        stamps[models] = model_stamp(*models)
+    return stamps[models]
+
+
+def model_validators(models_func):
+    """
+    (etag_func, last_modified_func) for a view showing whole models.
+
+    models_func takes the view's arguments and returns the models, or
+    None when the request is not one the view can answer.
+    """
+    def etag_func(request, *args, **kwargs):
+        models = models_func(request, *args, **kwargs)
+        return etag(request, request.path, request_stamp(request, *models)[0]) if models else None
+
+    def last_modified_func(request, *args, **kwargs):
+        models = models_func(request, *args, **kwargs)
+        return last_modified(request, request_stamp(request, *models)[1]) if models else None
+
+    return etag_func, last_modified_func
+
+
+def conditional_get(etag_func=None, last_modified_func=None):
+    """
+    Like Django's condition decorator, and marks the response private and no-cache.
+
+    Does nothing when SHEEP_CONDITIONAL_GET is off.
+    """
+    def decorator(view):
+        conditional_view = condition(etag_func=etag_func, last_modified_func=last_modified_func)(view)
+
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if not enabled():
+                return view(request, *args, **kwargs)
+            response = conditional_view(request, *args, **kwargs)
+            if response.has_header('ETag') or response.has_header('Last-Modified'):
+                patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapped
+    return decorator
+
+
+class ConditionalGetMixin:
+    """
+    Answers GET and HEAD with 304 Not Modified when the page has not changed.
+
+    Set conditional_models to every model whose rows the page shows, or
+    override get_etag() for pages that show a few rows out of many.
+    """
+    conditional_models = ()
+
+    def get_conditional_models(self):
+        return tuple(self.conditional_models)
+
+    def get_etag(self, request, *args, **kwargs):
+        models = self.get_conditional_models()
+        if not models:
+            return None
+        return etag(request, type(self).__name__, request_stamp(request, *models)[0])
+
+    def get_last_modified(self, request, *args, **kwargs):
+        models = self.get_conditional_models()
+        if not models:
+            return None
+        return last_modified(request, request_stamp(request, *models)[1])
+
+    def dispatch(self, request, *args, **kwargs):
+        # Put after LoginRequiredMixin, so anonymous requests are turned away first
+        if request.method not in ('GET', 'HEAD'):
+            return super().dispatch(request, *args, **kwargs)
+        view = conditional_get(self.get_etag, self.get_last_modified)(super().dispatch)
+        return view(request, *args, **kwargs)
@@ -0,0 +1,161 @@
+"""
+Running counts behind the home page dashboard.
+
+Every sheep and record adds to a few named counters in FlockStat, worked
+out from a handful of its fields by the functions in COUNTERS: an active
+ewe adds one to 'headcount:ACTIVE:F' and one to 'breed:<id>:ACTIVE'. When
+a row is saved, the signals in signals.py take away what it added before
+and add what it adds now in a single upsert, so the dashboard reads a few
+dozen rows however large the flock grows.
+
+rebuild() recounts everything with GROUP BY queries. It runs by itself the
+first time the dashboard is shown, and through the rebuild_dashboard
+command whenever the counts need repair.
+"""
+from collections import Counter
+
+from django.db import connections, router, transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import Breed, Sheep, BreedingRecord, LambingRecord, HealthRecord, FlockStat
+
+# Present once rebuild() has filled the table
+BUILT = 'built'
+
+# Breeding records still waiting on an outcome
+PENDING_BREEDING_STATUSES = ('PLANNED', 'IN_PROGRESS')
+
+UPSERT_SQL = (
+    f"INSERT INTO {FlockStat._meta.db_table} (name, value) VALUES (%s, %s) "
+    f"ON CONFLICT (name) DO UPDATE SET value = value + excluded.value"
+)
+
+
+def _sheep_counters(status, gender, breed_id):
+    return {f'headcount:{status}:{gender}': 1, f'breed:{breed_id}:{status}': 1}
+
+
+def _lambing_counters(date, total_born, born_alive):
+    # A season is the calendar year of the lambing
+    return {
+        f'lambing:{date.year}:records': 1,
+        f'lambing:{date.year}:born': total_born,
+        f'lambing:{date.year}:alive': born_alive,
+    }
+
+
+def _health_counters(requires_followup):
+    return {'followups:open': 1} if requires_followup else {}
+
+
+def _breeding_counters(status):
+    return {f'breeding:{status}': 1}
+
+
+# model -> (fields the counters depend on, function from their values to {counter: amount})
+COUNTERS = {
+    Sheep: (('status', 'gender', 'breed_id'), _sheep_counters),
+    LambingRecord: (('date', 'total_born', 'born_alive'), _lambing_counters),
+    HealthRecord: (('requires_followup',), _health_counters),
+    BreedingRecord: (('status',), _breeding_counters),
+}
+
+
+def contributions(instance):
+    """{counter: amount} that one row adds to the dashboard"""
+    model = type(instance)
+    fields, counters = COUNTERS[model]
+    # to_python, because a freshly created row may still hold what it was given, e.g. a date string
+    return counters(*(model._meta.get_field(field).to_python(getattr(instance, field)) for field in fields))
+
+
+def total_contributions(instances):
+    totals = Counter()
+    for instance in instances:
+        totals.update(contributions(instance))
+    return totals
+
+
+def apply(delta, using=None):
+    """Add {counter: amount} to the stored counts with one statement"""
+    rows = [(name, amount) for name, amount in delta.items() if amount]
+    if not rows:
+        return
+    with connections[using or router.db_for_write(FlockStat)].cursor() as cursor:
+        cursor.executemany(UPSERT_SQL, rows)
+
+
+def remember(instance, using=None):
+    """Note what a row added before it is saved over"""
+    model = type(instance)
+    fields, counters = COUNTERS[model]
+    stored = None
+    if instance.pk is not None:
+        stored = model.objects.using(using).filter(pk=instance.pk).values_list(*fields).first()
+    instance._dashboard_counts = counters(*stored) if stored else {}
+
+
+def saved(instance, using=None):
+    delta = Counter(contributions(instance))
+    delta.subtract(getattr(instance, '_dashboard_counts', {}))
+    apply(delta, using=using)
+
+
+def deleted(instance, using=None):
+    apply({name: -amount for name, amount in contributions(instance).items()}, using=using)
+
+
+def rebuild(using=None):
+    """Recount every counter from the sheep and record tables"""
+    using = using or router.db_for_write(FlockStat)
+    with transaction.atomic(using=using):
+        totals = Counter({BUILT: 1})
+        for model, (fields, counters) in COUNTERS.items():
+            # order_by() keeps the model's default ordering out of the GROUP BY
+            groups = model.objects.using(using).order_by().values_list(*fields).annotate(rows=Count('pk'))
+            for *values, rows in groups:
+                for name, amount in counters(*values).items():
+                    totals[name] += amount * rows
+        FlockStat.objects.using(using).all().delete()
+        FlockStat.objects.using(using).bulk_create(
+            [FlockStat(name=name, value=value) for name, value in totals.items() if value]
+        )
+    return totals
+
+
+def summary(today=None, using=None):
+    """Everything the dashboard shows, read from the counters"""
+    stats = FlockStat.objects.using(using or router.db_for_read(FlockStat))
+    counts = dict(stats.values_list('name', 'value'))
+    if BUILT not in counts:
+        counts = rebuild(using=using)
+    season = (today or timezone.localdate()).year
+
+    headcount = []
+    for status, label in Sheep.STATUS_CHOICES:
+        row = {gender: counts.get(f'headcount:{status}:{gender}', 0) for gender, _ in Sheep.GENDER_CHOICES}
+        headcount.append({'status': status, 'label': label, 'ewes': row['F'], 'rams': row['M'],
+                          'total': sum(row.values())})
+
+    active_by_breed = {}
+    for name, value in counts.items():
+        if name.startswith('breed:') and name.endswith(':ACTIVE') and value:
+            active_by_breed[int(name.split(':')[1])] = value
+    breed_names = dict(Breed.objects.using(stats.db).filter(pk__in=active_by_breed).values_list('pk', 'name'))
+    breeds = sorted(
+        ((breed_names.get(breed_id, '?'), value) for breed_id, value in active_by_breed.items()),
+        key=lambda item: (-item[1], item[0]),
+    )
+
+    return {
+        'headcount': headcount,
+        'active': next(row['total'] for row in headcount if row['status'] == 'ACTIVE'),
+        'breeds': breeds,
+        'season': season,
+        'lambings': counts.get(f'lambing:{season}:records', 0),
+        'lambs_born': counts.get(f'lambing:{season}:born', 0),
+        'lambs_alive': counts.get(f'lambing:{season}:alive', 0),
+        'open_followups': counts.get('followups:open', 0),
+        'pending_breedings': sum(counts.get(f'breeding:{status}', 0) for status in PENDING_BREEDING_STATUSES),
+    }
@@ -0,0 +1,52 @@
+"""
+Per-sheep versions for caching the rendered sheep detail page.
+
+The body of the detail page is cached as a template fragment keyed on the
+sheep's current version. The signals in signals.py drop that version
+whenever the sheep, its parents, offspring or mates, or any record shown
+on its page changes, so a stale page is never served.
+
+Caching is off unless SHEEP_DETAIL_CACHE_TIMEOUT is set to a number of seconds.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+
+def cache_timeout():
+    return getattr(settings, 'SHEEP_DETAIL_CACHE_TIMEOUT', 0)
+
+
+def enabled():
+    return bool(cache_timeout())
+
+
+def _version_key(sheep_id):
+    return f'sheep-detail:version:{sheep_id}'
+
+
+def version(sheep_id):
+    """Current render version of a sheep's detail page"""
+    key = _version_key(sheep_id)
+    value = cache.get(key)
+    if value is None:
+        value = uuid.uuid4().hex
+        if not cache.add(key, value, None):
+            value = cache.get(key, value)
+    return value
+
+
+def invalidate(*sheep_ids, using=None):
+    """
+    Make the next request re-render the detail page of every given sheep,
+    once the current transaction commits.
+
+    Like response_cache.invalidate(), waiting for the commit stops another
+    worker from caching a page rendered from the old rows under the new
+    version.
+    """
+    keys = {_version_key(sheep_id) for sheep_id in sheep_ids if sheep_id is not None}
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys), using=using)
@@ -0,0 +1,320 @@
+"""
+Streaming export of the flock as CSV, JSON lines or XLSX.
+
+Each export is one query: lineage columns come from joins on the parent
+references, and lambing totals and the latest health event from correlated
+subqueries, so nothing is loaded per row. Rows are read with
+QuerySet.iterator() as plain tuples and written out a batch at a time,
+so memory stays flat however large the flock is.
+
+Column names match the importer's, so an export can be imported again.
+"""
+import csv
+import io
+import json
+import re
+import zipfile
+from datetime import date, datetime, time
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Sheep, LambingRecord, HealthRecord
+
+# Rows fetched from the database, and written out, at a time
+CHUNK_SIZE = 2000
+
+# format -> (content type, file extension)
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+}
+
+
+def sheep_queryset():
+    lambings = LambingRecord.objects.filter(ewe=OuterRef('pk')).order_by().values('ewe')
+    latest_health = HealthRecord.objects.filter(sheep=OuterRef('pk')).order_by('-date', '-pk')
+    return Sheep.objects.annotate(
+        lambing_count=Coalesce(Subquery(lambings.annotate(value=Count('pk')).values('value')), 0),
+        lambs_born_total=Coalesce(Subquery(lambings.annotate(value=Sum('total_born')).values('value')), 0),
+        lambs_born_alive_total=Coalesce(Subquery(lambings.annotate(value=Sum('born_alive')).values('value')), 0),
+        latest_health_date=Subquery(latest_health.values('date')[:1]),
+        latest_health_type=Subquery(latest_health.values('record_type')[:1]),
+        latest_health_treatment=Subquery(latest_health.values('treatment')[:1]),
+    ).order_by('tag_number')
+
+
+def lambing_queryset():
+    return LambingRecord.objects.order_by('date', 'pk')
+
+
+def health_queryset():
+    return HealthRecord.objects.order_by('date', 'pk')
+
+
+# kind -> (queryset factory, [(column, lookup)])
+EXPORT_KINDS = {
+    'sheep': (sheep_queryset, [
+        ('tag_number', 'tag_number'),
+        ('name', 'name'),
+        ('gender', 'gender'),
+        ('date_of_birth', 'date_of_birth'),
+        ('breed', 'breed__name'),
+        ('status', 'status'),
+        ('mother', 'mother__tag_number'),
+        ('father', 'father__tag_number'),
+        ('maternal_granddam', 'mother__mother__tag_number'),
+        ('maternal_grandsire', 'mother__father__tag_number'),
+        ('paternal_granddam', 'father__mother__tag_number'),
+        ('paternal_grandsire', 'father__father__tag_number'),
+        ('weight_birth', 'weight_birth'),
+        ('weight_current', 'weight_current'),
+        ('color', 'color'),
+        ('markings', 'markings'),
+        ('date_acquired', 'date_acquired'),
+        ('date_removed', 'date_removed'),
+        ('removal_reason', 'removal_reason'),
+        ('cull_candidate', 'cull_candidate'),
+        ('cull_date', 'cull_date'),
+        ('cull_reason', 'cull_reason'),
+        ('bottle_lamb', 'bottle_lamb'),
+        ('bottle_lamb_reason', 'bottle_lamb_reason'),
+        ('body_type', 'body_type'),
+        ('udder_type', 'udder_type'),
+        ('feet_type', 'feet_type'),
+        ('lambings', 'lambing_count'),
+        ('lambs_born', 'lambs_born_total'),
+        ('lambs_born_alive', 'lambs_born_alive_total'),
+        ('latest_health_date', 'latest_health_date'),
+        ('latest_health_type', 'latest_health_type'),
+        ('latest_health_treatment', 'latest_health_treatment'),
+        ('notes', 'notes'),
+    ]),
+    'lambing': (lambing_queryset, [
+        ('ewe', 'ewe__tag_number'),
+        ('ewe_name', 'ewe__name'),
+        ('date', 'date'),
+        ('assisted', 'assisted'),
+        ('complications', 'complications'),
+        ('total_born', 'total_born'),
+        ('born_alive', 'born_alive'),
+        ('born_dead', 'born_dead'),
+        ('notes', 'notes'),
+    ]),
+    'health': (health_queryset, [
+        ('sheep', 'sheep__tag_number'),
+        ('sheep_name', 'sheep__name'),
+        ('date', 'date'),
+        ('record_type', 'record_type'),
+        ('treatment', 'treatment'),
+        ('dosage', 'dosage'),
+        ('administered_by', 'administered_by'),
+        ('requires_followup', 'requires_followup'),
+        ('followup_date', 'followup_date'),
+        ('notes', 'notes'),
+    ]),
+}
+
+
+def export_rows(kind, chunk_size=CHUNK_SIZE, using=None):
+    """Return (column names, iterator of row tuples) for one kind of export"""
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"Unknown export kind: {kind}")
+    queryset_factory, columns = EXPORT_KINDS[kind]
+    queryset = queryset_factory()
+    if using:
+        queryset = queryset.using(using)
+    rows = queryset.values_list(*(lookup for _, lookup in columns)).iterator(chunk_size=chunk_size)
+    return [column for column, _ in columns], rows
+
+
+def _batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Writers: each takes (header, rows, chunk_size) and yields bytes
+
+def write_csv(header, rows, chunk_size=CHUNK_SIZE):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for batch in _batched(rows, chunk_size):
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def write_jsonl(header, rows, chunk_size=CHUNK_SIZE):
+    for batch in _batched(rows, chunk_size):
+        yield ''.join(
+            json.dumps(dict(zip(header, row)), default=_json_default) + '\n' for row in batch
+        ).encode('utf-8')
+
+
+# XLSX is a zip of XML parts. The worksheet is streamed into the zip with
+# inline strings, so no shared string table has to be held in memory.
+
+XLSX_MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+XLSX_REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+XLSX_PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<Relationships xmlns="{XLSX_PKG_REL_NS}">'
+        f'<Relationship Id="rId1" Type="{XLSX_REL_NS}/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<workbook xmlns="{XLSX_MAIN_NS}" xmlns:r="{XLSX_REL_NS}">'
+        '<sheets><sheet name="{sheet_name}" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<Relationships xmlns="{XLSX_PKG_REL_NS}">'
+        f'<Relationship Id="rId1" Type="{XLSX_REL_NS}/worksheet" Target="worksheets/sheet1.xml"/>'
+        f'<Relationship Id="rId2" Type="{XLSX_REL_NS}/styles" Target="styles.xml"/>'
+        '</Relationships>'
+    ),
+    # Cell styles: 0 plain, 1 date, 2 bold header
+    'xl/styles.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<styleSheet xmlns="{XLSX_MAIN_NS}">'
+        '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+        '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+        '<fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="3">'
+        '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>'
+        '</cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'
+    ),
+}
+
+XLSX_SHEET_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    f'<worksheet xmlns="{XLSX_MAIN_NS}">'
+    '<sheetViews><sheetView workbookViewId="0">'
+    '<pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/>'
+    '</sheetView></sheetViews>'
+    '<sheetData>'
+)
+XLSX_SHEET_TAIL = '</sheetData></worksheet>'
+
+# Day zero of spreadsheet date serials
+XLSX_EPOCH = date(1899, 12, 30)
+
+# Characters XML 1.0 cannot carry at all
+XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _xlsx_cell(value, style=0):
+    if value is None or value == '':
+        return '<c/>'
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float, Decimal)):
+        return f'<c><v>{value}</v></c>'
+    if isinstance(value, datetime):
+        value = value.date()
+    if isinstance(value, date):
+        return f'<c s="1"><v>{(value - XLSX_EPOCH).days}</v></c>'
+    text = escape(XML_ILLEGAL.sub('', str(value)))
+    style_attr = f' s="{style}"' if style else ''
+    return f'<c t="inlineStr"{style_attr}><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+class _ChunkBuffer:
+    """Write-only stream that hands back whatever was written since the last take()"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def write_xlsx(header, rows, chunk_size=CHUNK_SIZE, sheet_name='Flock'):
+    buffer = _ChunkBuffer()
+    # The buffer cannot seek, so zipfile writes sizes after each member instead of before
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_PARTS.items():
+            archive.writestr(name, content.replace('{sheet_name}', escape(sheet_name)))
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(XLSX_SHEET_HEAD.encode('utf-8'))
+            sheet.write(('<row>' + ''.join(_xlsx_cell(column, style=2) for column in header) + '</row>').encode('utf-8'))
+            for batch in _batched(rows, chunk_size):
+                sheet.write(''.join(
+                    '<row>' + ''.join(_xlsx_cell(value) for value in row) + '</row>' for row in batch
+                ).encode('utf-8'))
+                yield buffer.take()
+            sheet.write(XLSX_SHEET_TAIL.encode('utf-8'))
+    yield buffer.take()
+
+
+WRITERS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+    'xlsx': write_xlsx,
+}
+
+
+def export_chunks(kind, format, chunk_size=CHUNK_SIZE, using=None):
+    """Yield an export of one kind of record as byte strings, a batch of rows at a time"""
+    if format not in WRITERS:
+        raise ValueError(f"Unknown export format: {format}")
+    header, rows = export_rows(kind, chunk_size=chunk_size, using=using)
+    writer = WRITERS[format]
+    if format == 'xlsx':
+        return writer(header, rows, chunk_size, sheet_name=kind.title())
+    return writer(header, rows, chunk_size)
@@ -0,0 +1,410 @@
+"""
+Bulk import of sheep, lambing records and health records from CSV or JSON lines.
+
+The input is read as a stream and handled one chunk of rows at a time:
+each chunk is validated, the sheep tags it mentions are resolved with a
+single query, and the valid rows are inserted with bulk_create in their
+own transaction. Mothers and fathers are linked in a second pass once
+every sheep in the file exists, so a lamb may come before its dam; parents
+already in the flock or earlier in the file are set on the first insert.
+Parents are held to the rules of the sheep form: a mother must be female,
+a father male, and no sheep may become its own ancestor. A row whose
+parent breaks them is rejected on the first pass; on the second pass the
+sheep is already in, so the parent is left out and the row reported.
+
+A dry run goes through the same checks without writing anything. Rows it
+would insert get placeholder ids below any real one, so later rows and
+the second pass can refer to them, and its report lists the same row
+errors a real import would. It takes no write lock, so checking a large
+file never holds up saves on the site.
+
+bulk_create skips model signals, so signals.after_bulk_write() does what
+they would have done for each chunk, and the pedigree closure and the
+kinship cache are brought up to date at the end.
+"""
+import csv
+import io
+import itertools
+import json
+from datetime import datetime
+
+from django.core.exceptions import ValidationError
+from django.db import connections, models, router, transaction
+
+from . import kinship, pedigree, signals
+from .models import Breed, Sheep, LambingRecord, HealthRecord
+
+# kind -> (model, importable columns, {column: attribute} for sheep referenced by tag)
+IMPORT_KINDS = {
+    'sheep': (Sheep, [
+        'tag_number', 'name', 'gender', 'date_of_birth', 'breed', 'status',
+        'weight_birth', 'weight_current', 'color', 'markings',
+        'date_acquired', 'date_removed', 'removal_reason',
+        'cull_candidate', 'cull_date', 'cull_reason', 'bottle_lamb', 'bottle_lamb_reason',
+        'body_type', 'udder_type', 'feet_type', 'notes',
+    ], {}),
+    'lambing': (LambingRecord, [
+        'date', 'assisted', 'complications', 'total_born', 'born_alive', 'born_dead', 'notes',
+    ], {'ewe': 'ewe_id'}),
+    'health': (HealthRecord, [
+        'date', 'record_type', 'treatment', 'dosage', 'administered_by',
+        'requires_followup', 'followup_date', 'notes',
+    ], {'sheep': 'sheep_id'}),
+}
+
+# Parent columns of a sheep import, linked in the second pass
+PARENT_COLUMNS = {'mother': 'mother_id', 'father': 'father_id'}
+
+# Gender each parent column must have
+PARENT_GENDERS = {'mother': 'F', 'father': 'M'}
+
+FORMATS = ('csv', 'jsonl')
+
+# Date formats accepted besides ISO 8601, as written in the flock notebooks
+DATE_FORMATS = ('%m/%d/%Y', '%m/%d/%y')
+
+TRUE_VALUES = {'1', 'true', 't', 'yes', 'y', 'x'}
+FALSE_VALUES = {'0', 'false', 'f', 'no', 'n', ''}
+
+# Row errors kept for the report; the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+
+
+class ImportReport:
+    """Outcome of an import: counts and row-level errors"""
+
+    def __init__(self, kind, dry_run):
+        self.kind = kind
+        self.dry_run = dry_run
+        self.rows = 0
+        self.created = 0
+        self.parents_linked = 0
+        self.error_count = 0
+        # (line number, message)
+        self.errors = []
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    @property
+    def skipped(self):
+        return self.rows - self.created
+
+
+def read_rows(file, format):
+    """
+    Yield (line number, row dict or None, error or None) from a text stream.
+
+    Only the current line is held in memory.
+    """
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, {key.strip(): value for key, value in row.items() if key}, None
+    elif format == 'jsonl':
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                yield line_number, None, f"Invalid JSON: {error}"
+                continue
+            if not isinstance(row, dict):
+                yield line_number, None, "Each line must be a JSON object"
+                continue
+            yield line_number, row, None
+    else:
+        raise ValueError(f"Unknown import format: {format}")
+
+
+def open_text(file, encoding='utf-8-sig'):
+    """Wrap a binary upload or file in a streaming text reader"""
+    return io.TextIOWrapper(file, encoding=encoding, newline='')
+
+
+def _choice_lookup(field):
+    lookup = {}
+    for value, label in field.choices:
+        lookup[str(value).lower()] = value
+        lookup[str(label).lower()] = value
+    return lookup
+
+
+class FlockImporter:
+    """Validates and inserts one kind of record in chunks"""
+
+    def __init__(self, kind, dry_run=False, batch_size=500, using=None):
+        if kind not in IMPORT_KINDS:
+            raise ValueError(f"Unknown import kind: {kind}")
+        self.kind = kind
+        self.model, self.columns, self.sheep_columns = IMPORT_KINDS[kind]
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.using = using or router.db_for_write(self.model)
+        self.report = ImportReport(kind, dry_run)
+        self.fields = {column: self.model._meta.get_field(column) for column in self.columns}
+        self.choices = {column: _choice_lookup(field) for column, field in self.fields.items() if field.choices}
+        self.sheep_ids = {}
+        self.sheep_genders = {}
+        self.breed_ids = {}
+        self.seen_tags = set()
+        # Sheep import: (line, sheep id, mother tag, father tag) not yet known on insert
+        self.pending_parents = []
+        # Imported sheep id -> ids of its parents imported with it; only these can close an ancestry loop
+        self.imported_parents = {}
+        self.created_ids = []
+        # Ids a dry run gives the rows and breeds it would have created
+        self.placeholder_ids = itertools.count(-1, -1)
+
+    def run(self, rows):
+        """Import an iterable of read_rows() tuples and return the report"""
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.batch_size:
+                self._import_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._import_chunk(chunk)
+        if self.pending_parents:
+            self._link_parents()
+        if not self.dry_run:
+            self._finish()
+        return self.report
+
+    # First pass
+
+    def _parse(self, column, raw):
+        """Turn one raw cell into a value for the model field"""
+        field = self.fields[column]
+        if isinstance(raw, str):
+            raw = raw.strip()
+        if raw is None or raw == '':
+            if field.null:
+                return None
+            if isinstance(field, models.BooleanField):
+                return False
+            return field.get_default() if field.has_default() else ''
+        if column in self.choices:
+            value = self.choices[column].get(str(raw).lower())
+            if value is None:
+                raise ValidationError(f"'{raw}' is not a valid choice")
+            return value
+        if isinstance(field, models.BooleanField) and isinstance(raw, str):
+            if raw.lower() in TRUE_VALUES:
+                return True
+            if raw.lower() in FALSE_VALUES:
+                return False
+            raise ValidationError(f"'{raw}' is not true or false")
+        if isinstance(field, models.DateField) and isinstance(raw, str):
+            for date_format in DATE_FORMATS:
+                try:
+                    return datetime.strptime(raw, date_format).date()
+                except ValueError:
+                    pass
+        return field.to_python(raw)
+
+    def _resolve_sheep(self, tags):
+        """Fill self.sheep_ids and self.sheep_genders for the given tags with one query"""
+        missing = [tag for tag in tags if tag not in self.sheep_ids]
+        if missing:
+            found = Sheep.objects.using(self.using).filter(tag_number__in=missing)
+            for tag, pk, gender in found.values_list('tag_number', 'pk', 'gender'):
+                self.sheep_ids[tag] = pk
+                self.sheep_genders[pk] = gender
+
+    def _parent_error(self, column, tag, parent_id):
+        """Why the sheep with the tag cannot be the given parent, or None"""
+        gender = self.sheep_genders[parent_id]
+        if gender != PARENT_GENDERS[column]:
+            return f"{column}: sheep '{tag}' is {dict(Sheep.GENDER_CHOICES)[gender].lower()}"
+        return None
+
+    def _is_imported_ancestor(self, ancestor_id, sheep_id):
+        """True if ancestor_id is already an ancestor of sheep_id through parents imported with them"""
+        stack, seen = [sheep_id], set()
+        while stack:
+            for parent_id in self.imported_parents.get(stack.pop(), ()):
+                if parent_id == ancestor_id:
+                    return True
+                if parent_id not in seen:
+                    seen.add(parent_id)
+                    stack.append(parent_id)
+        return False
+
+    def _resolve_breed(self, name):
+        key = name.lower()
+        if key not in self.breed_ids:
+            breed_id = Breed.objects.using(self.using).filter(name__iexact=name).values_list('pk', flat=True).first()
+            if breed_id is None:
+                if self.dry_run:
+                    breed_id = next(self.placeholder_ids)
+                else:
+                    breed_id = Breed.objects.using(self.using).create(name=name).pk
+            self.breed_ids[key] = breed_id
+        return self.breed_ids[key]
+
+    def _import_chunk(self, chunk):
+        tags = set()
+        for _, data, _ in chunk:
+            for column in self.sheep_columns:
+                if data and data.get(column):
+                    tags.add(str(data[column]).strip())
+        if self.kind == 'sheep':
+            for _, data, _ in chunk:
+                if data:
+                    tags.update(str(data.get(column) or '').strip() for column in ('tag_number', *PARENT_COLUMNS))
+            tags.discard('')
+        self._resolve_sheep(tags)
+
+        instances = []
+        parents = []
+        for line, data, error in chunk:
+            self.report.rows += 1
+            if error:
+                self.report.add_error(line, error)
+                continue
+            instance, deferred, errors = self._build(data)
+            if errors:
+                for message in errors:
+                    self.report.add_error(line, message)
+                continue
+            instances.append(instance)
+            parents.append((line, deferred))
+
+        if not instances:
+            return
+        if self.dry_run:
+            for instance in instances:
+                instance.pk = next(self.placeholder_ids)
+        else:
+            with transaction.atomic(using=self.using):
+                self.model.objects.using(self.using).bulk_create(instances, batch_size=self.batch_size)
+                signals.after_bulk_write(self.model, instances, using=self.using)
+        self.report.created += len(instances)
+
+        if self.kind == 'sheep':
+            for instance, (line, deferred) in zip(instances, parents):
+                self.sheep_ids[instance.tag_number] = instance.pk
+                self.sheep_genders[instance.pk] = instance.gender
+                self.imported_parents[instance.pk] = [
+                    parent_id for parent_id in (instance.mother_id, instance.father_id)
+                    if parent_id in self.imported_parents
+                ]
+                self.created_ids.append(instance.pk)
+                linked = [parent_id for parent_id in (instance.mother_id, instance.father_id) if parent_id]
+                self.report.parents_linked += len(linked)
+                if any(deferred):
+                    self.pending_parents.append((line, instance.pk, *deferred))
+
+    def _build(self, data):
+        """Return (unsaved instance, (mother tag, father tag) left for the second pass, errors) for one row"""
+        instance = self.model()
+        errors = []
+        for column in self.columns:
+            if column == 'breed':
+                continue
+            try:
+                # Field.clean runs the blank, max_length and other field validators
+                setattr(instance, column, self.fields[column].clean(self._parse(column, data.get(column)), instance))
+            except ValidationError as error:
+                errors.extend(f"{column}: {message}" for message in error.messages)
+
+        for column, attr in self.sheep_columns.items():
+            tag = str(data.get(column) or '').strip()
+            if not tag:
+                errors.append(f"{column}: a sheep tag is required")
+            elif tag not in self.sheep_ids:
+                errors.append(f"{column}: no sheep with tag '{tag}'")
+            else:
+                setattr(instance, attr, self.sheep_ids[tag])
+
+        deferred = (None, None)
+        if self.kind == 'sheep':
+            tag = instance.tag_number
+            if tag in self.seen_tags or tag in self.sheep_ids:
+                errors.append(f"tag_number: a sheep with tag '{tag}' already exists")
+            breed = str(data.get('breed') or '').strip()
+            if breed:
+                instance.breed_id = self._resolve_breed(breed)
+            else:
+                errors.append("breed: this field is required")
+            deferred = []
+            for column, attr in PARENT_COLUMNS.items():
+                parent_tag = str(data.get(column) or '').strip() or None
+                if parent_tag in self.sheep_ids:
+                    # A sheep already in the flock or the file, which cannot descend from this new one
+                    parent_id = self.sheep_ids[parent_tag]
+                    error = self._parent_error(column, parent_tag, parent_id)
+                    if error:
+                        errors.append(error)
+                    else:
+                        setattr(instance, attr, parent_id)
+                    parent_tag = None
+                elif parent_tag == tag:
+                    errors.append(f"{column}: a sheep cannot be its own parent")
+                deferred.append(parent_tag)
+
+        if not errors and self.kind == 'sheep':
+            self.seen_tags.add(instance.tag_number)
+        return instance, tuple(deferred), errors
+
+    # Second pass
+
+    def _link_parents(self):
+        """Point imported sheep at their mother and father, in chunks"""
+        connection = connections[self.using]
+        for start in range(0, len(self.pending_parents), self.batch_size):
+            chunk = self.pending_parents[start:start + self.batch_size]
+            self._resolve_sheep({tag for _, _, *tags in chunk for tag in tags if tag})
+            updates = []
+            for line, sheep_id, *tags in chunk:
+                parent_ids = []
+                for column, tag in zip(PARENT_COLUMNS, tags):
+                    parent_id = self.sheep_ids.get(tag) if tag else None
+                    if tag and parent_id is None:
+                        self.report.add_error(line, f"{column}: no sheep with tag '{tag}'; imported without it")
+                    elif parent_id is not None:
+                        error = self._parent_error(column, tag, parent_id)
+                        if error is None and self._is_imported_ancestor(sheep_id, parent_id):
+                            error = f"{column}: sheep '{tag}' descends from this one, which cannot be its own ancestor"
+                        if error:
+                            self.report.add_error(line, f"{error}; imported without it")
+                            parent_id = None
+                        elif parent_id in self.imported_parents:
+                            self.imported_parents[sheep_id].append(parent_id)
+                    parent_ids.append(parent_id)
+                linked = [parent_id for parent_id in parent_ids if parent_id]
+                if linked:
+                    updates.append((*parent_ids, sheep_id))
+                    self.report.parents_linked += len(linked)
+            if self.dry_run:
+                continue
+            # One prepared statement per chunk; bulk_update's CASE expressions compile far slower.
+            # A parent set on insert is kept when only the other one was left for this pass.
+            with transaction.atomic(using=self.using), connection.cursor() as cursor:
+                cursor.executemany(
+                    f"UPDATE {Sheep._meta.db_table} "
+                    f"SET mother_id = COALESCE(%s, mother_id), father_id = COALESCE(%s, father_id) WHERE id = %s",
+                    updates,
+                )
+                signals.after_bulk_write(Sheep, [
+                    Sheep(pk=sheep_id, mother_id=mother_id, father_id=father_id)
+                    for mother_id, father_id, sheep_id in updates
+                ], using=self.using, created=False)
+
+    def _finish(self):
+        """Bring the pedigree up to date, which after_bulk_write() leaves to the end of the import"""
+        if self.kind == 'sheep' and self.report.parents_linked:
+            # New sheep only have descendants among themselves
+            pedigree.rebuild_closure(self.created_ids, using=self.using)
+            kinship.invalidate()
+
+
+def import_file(file, kind, format='csv', dry_run=False, batch_size=500, using=None):
+    """Import a text stream; returns an ImportReport"""
+    importer = FlockImporter(kind, dry_run=dry_run, batch_size=batch_size, using=using)
+    return importer.run(read_rows(file, format))
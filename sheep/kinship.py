@@ -0,0 +1,253 @@
+"""
+Inbreeding and kinship coefficients computed from recorded parentage.
+
+The whole pedigree is read with one query into integer-indexed arrays,
+ordered so parents always come before their offspring. From there:
+
+* the coefficient of inbreeding (COI) of an animal is computed with the
+  Meuwissen & Luo (1992) algorithm and memoized, together with the COI
+  of all its ancestors, and
+* kinship with a given ram is computed for every animal at once with
+  Colleau's (2002) indirect method, which multiplies the relationship
+  matrix by a vector without ever building the matrix.
+
+The expected COI of a lamb equals the kinship of its parents. Results are
+cached per pedigree version; any change to parentage bumps the version.
+"""
+import heapq
+import uuid
+from array import array
+
+from django.core.cache import cache
+from django.db import router
+
+from .models import Sheep
+
+VERSION_KEY = 'kinship:version'
+CACHE_TIMEOUT = 60 * 60 * 24
+
+_engine = None
+
+
+def pedigree_version():
+    """Current pedigree version, creating one if the cache has none"""
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(VERSION_KEY, version, None):
+            version = cache.get(VERSION_KEY, version)
+    return version
+
+
+def invalidate():
+    """Discard cached kinship results after parentage changed"""
+    global _engine
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+    _engine = None
+
+
+class KinshipEngine:
+    """
+    Pedigree held as parallel arrays with 1-based indexes.
+
+    Index 0 stands for an unknown parent, so the inner loops never branch
+    on missing parents.
+    """
+
+    def __init__(self, rows, version=None):
+        self.version = version
+        parents = {pk: (mother_id, father_id) for pk, mother_id, father_id in rows}
+        order = self._parents_first(parents)
+        self.ids = [None] + order
+        self.index = {pk: i for i, pk in enumerate(self.ids) if pk is not None}
+        self.size = len(self.ids)
+        self.sire = array('l', [0] * self.size)
+        self.dam = array('l', [0] * self.size)
+        for i, pk in enumerate(order, start=1):
+            mother_id, father_id = parents[pk]
+            self.sire[i] = self.index.get(father_id, 0)
+            self.dam[i] = self.index.get(mother_id, 0)
+        self._coi = array('d', [0.0] * self.size)
+        self._coi[0] = -1.0
+        self._variance = array('d', [0.0] * self.size)
+        self._weight = array('d', [0.0] * self.size)
+        # 0 = not computed, 2 = queued, 1 = computed
+        self._done = array('b', [0] * self.size)
+        self._columns = {}
+
+    @classmethod
+    def load(cls, using=None, version=None):
+        rows = Sheep.objects.using(using or router.db_for_read(Sheep)).values_list('id', 'mother_id', 'father_id')
+        return cls(rows, version=version)
+
+    @staticmethod
+    def _parents_first(parents):
+        """Order ids so every parent precedes its offspring, dropping links that form a cycle"""
+        order = []
+        state = {}
+        for root in parents:
+            if root in state:
+                continue
+            stack = [(root, iter(p for p in parents[root] if p in parents))]
+            state[root] = 'open'
+            while stack:
+                pk, pending = stack[-1]
+                parent = next(pending, None)
+                if parent is None:
+                    stack.pop()
+                    state[pk] = 'done'
+                    order.append(pk)
+                elif parent not in state:
+                    state[parent] = 'open'
+                    stack.append((parent, iter(p for p in parents[parent] if p in parents)))
+                elif state[parent] == 'open':
+                    # Bad data made this sheep its own ancestor; ignore the link
+                    mother_id, father_id = parents[pk]
+                    parents[pk] = (None if mother_id == parent else mother_id,
+                                   None if father_id == parent else father_id)
+        return order
+
+    def _compute_inbreeding(self, indices):
+        """
+        Fill in the COI of the given animals and, first, of all their ancestors.
+
+        Each animal is traced once with Meuwissen & Luo and the result is
+        memoized, so only the part of the pedigree that is actually asked
+        about is ever computed.
+        """
+        sire, dam = self.sire, self.dam
+        coi, variance, weight, done = self._coi, self._variance, self._weight, self._done
+        needed = []
+        stack = [i for i in indices if i and not done[i]]
+        while stack:
+            j = stack.pop()
+            if done[j] == 2:
+                continue
+            done[j] = 2
+            needed.append(j)
+            for parent in (sire[j], dam[j]):
+                if parent and not done[parent]:
+                    stack.append(parent)
+        # Parents have lower indexes, so ascending order computes them first
+        needed.sort()
+        for i in needed:
+            s, d = sire[i], dam[i]
+            # Mendelian sampling variance; coi[0] is -1 so unknown parents need no branch
+            variance[i] = 0.5 - 0.25 * (coi[s] + coi[d])
+            done[i] = 1
+            if s == 0 or d == 0:
+                continue
+            total = 0.0
+            weight[i] = 1.0
+            heap = [-i]
+            queued = {i}
+            while heap:
+                j = -heapq.heappop(heap)
+                for parent in (sire[j], dam[j]):
+                    if parent:
+                        weight[parent] += 0.5 * weight[j]
+                        if parent not in queued:
+                            queued.add(parent)
+                            heapq.heappush(heap, -parent)
+                total += weight[j] * weight[j] * variance[j]
+                weight[j] = 0.0
+            coi[i] = total - 1.0
+
+    @property
+    def inbreeding(self):
+        """{sheep_id: COI} for every animal in the pedigree"""
+        self._compute_inbreeding(range(1, self.size))
+        return {pk: self._coi[i] for pk, i in self.index.items()}
+
+    def coi(self, sheep_id):
+        """COI of one animal; animals missing from the pedigree count as founders"""
+        i = self.index.get(sheep_id)
+        if not i:
+            return 0.0
+        self._compute_inbreeding([i])
+        return self._coi[i]
+
+    def _relationship_column(self, i):
+        """Column i of the numerator relationship matrix A, for every animal (Colleau)"""
+        if i in self._columns:
+            return self._columns[i]
+        self._compute_inbreeding([i])
+        sire, dam, variance = self.sire, self.dam, self._variance
+        # u = T'x with x the unit vector for animal i: only i's ancestors are touched
+        u = array('d', [0.0] * self.size)
+        u[i] = 1.0
+        for j in range(i, 0, -1):
+            if u[j]:
+                u[sire[j]] += 0.5 * u[j]
+                u[dam[j]] += 0.5 * u[j]
+        # w = T D u, where D is only needed on i's ancestors
+        w = array('d', [0.0] * self.size)
+        for j in range(1, self.size):
+            w[j] = 0.5 * (w[sire[j]] + w[dam[j]])
+            if u[j]:
+                w[j] += variance[j] * u[j]
+        self._columns[i] = w
+        return w
+
+    def kinship(self, first_id, second_id):
+        """Coancestry of two animals, which is the expected COI of their offspring"""
+        i, j = self.index.get(first_id), self.index.get(second_id)
+        if not i or not j:
+            return 0.5 if first_id == second_id else 0.0
+        return self._relationship_column(j)[i] / 2
+
+    def kinship_matrix(self, ewe_ids, ram_ids):
+        """{(ewe_id, ram_id): kinship} for every ewe x ram pair"""
+        matrix = {}
+        for ram_id in ram_ids:
+            j = self.index.get(ram_id)
+            column = self._relationship_column(j) if j else None
+            for ewe_id in ewe_ids:
+                i = self.index.get(ewe_id)
+                matrix[(ewe_id, ram_id)] = column[i] / 2 if column is not None and i else 0.0
+        return matrix
+
+
+def get_engine(using=None):
+    """The kinship engine for the current pedigree, reloaded only when parentage changed"""
+    global _engine
+    version = pedigree_version()
+    if _engine is None or _engine.version != version:
+        _engine = KinshipEngine.load(using=using, version=version)
+    return _engine
+
+
+def inbreeding_coefficient(sheep_id):
+    return get_engine().coi(sheep_id)
+
+
+def kinship_matrix(ewe_ids, ram_ids):
+    """
+    Cached ewe x ram kinship, shared between worker processes.
+
+    Each ram's kinship with the requested ewes is cached under the current
+    pedigree version, so editing any mother or father invalidates it.
+    """
+    version = pedigree_version()
+    ewe_ids = list(ewe_ids)
+    keys = {ram_id: f'kinship:{version}:ram:{ram_id}' for ram_id in ram_ids}
+    cached = cache.get_many(keys.values())
+    matrix = {}
+    missing = []
+    for ram_id, key in keys.items():
+        column = cached.get(key)
+        if column is None or any(ewe_id not in column for ewe_id in ewe_ids):
+            missing.append(ram_id)
+            continue
+        for ewe_id in ewe_ids:
+            matrix[(ewe_id, ram_id)] = column[ewe_id]
+    if missing:
+        computed = get_engine().kinship_matrix(ewe_ids, missing)
+        matrix.update(computed)
+        to_cache = {}
+        for ram_id in missing:
+            column = dict(cached.get(keys[ram_id]) or {})
+            column.update({ewe_id: computed[(ewe_id, ram_id)] for ewe_id in ewe_ids})
+            to_cache[keys[ram_id]] = column
+        cache.set_many(to_cache, CACHE_TIMEOUT)
+    return matrix
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from sheep import backup, tasks
+
+
+class Command(BaseCommand):
+    help = ('Back up a SQLite database while the site keeps writing to it, check the copy, '
+            'compress it and delete all but the newest backups')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default',
+                            help='Database alias to back up')
+        parser.add_argument('--pages', type=int, default=backup.BACKUP_PAGES,
+                            help='Pages copied per step; -1 copies the whole database in one step')
+        parser.add_argument('--queue', action='store_true',
+                            help='Leave the backup to the task workers instead of taking it now')
+
+    def handle(self, *args, **options):
+        if options['queue']:
+            task = tasks.enqueue('backup', {'database': options['database']}, unique=True)
+            self.stdout.write(self.style.SUCCESS(f"Queued a backup of {options['database']} as task {task.pk}"))
+            return
+        try:
+            result = backup.backup(options['database'], pages=options['pages'])
+        except backup.BackupError as error:
+            raise CommandError(str(error))
+        restarted = f", started over {result['restarts']} times by saves" if result['restarts'] else ''
+        self.stdout.write(self.style.SUCCESS(
+            f"Backed up {options['database']} to {result['path']} "
+            f"({result['bytes'] / 1024 / 1024:.1f} MB, copied in {result['seconds']:.1f}s{restarted})"
+        ))
@@ -0,0 +1,88 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from sheep import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Time every sheep page and count its SQL queries, optionally checking against a stored baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('routes', nargs='*',
+                            help='URL names to benchmark (defaults to every route)')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Timed requests per route')
+        parser.add_argument('--warmup', type=int, default=1,
+                            help='Untimed requests per route before timing it')
+        parser.add_argument('--user', default=None,
+                            help='Username to request pages as (defaults to the first superuser)')
+        parser.add_argument('--mode', action='append', choices=benchmark.MODES, dest='modes',
+                            help='Time only this mode: cold (page caches off), warm (page caches on) or '
+                                 'revalidated (sending the ETag of an earlier response); repeat for more '
+                                 '(defaults to all three)')
+        parser.add_argument('--baseline', default=None,
+                            help='JSON file of an earlier run; exits with an error on any regression against it')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed p95 slowdown against the baseline, as a fraction')
+        parser.add_argument('--save-baseline', default=None,
+                            help='Write this run to a JSON file, to compare later runs against')
+        parser.add_argument('--database', default=None,
+                            help='Database alias the pages read (defaults to the sheep database)')
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError("--repeat must be at least 1")
+        users = get_user_model().objects.filter(is_active=True)
+        user = (users.filter(username=options['user']) if options['user'] else
+                users.filter(is_superuser=True).order_by('pk')).first()
+        if user is None:
+            raise CommandError("No user to log in as; create one with createsuperuser or pass --user")
+
+        baseline = None
+        if options['baseline']:
+            try:
+                baseline = benchmark.load_baseline(options['baseline'])
+            except (OSError, ValueError) as error:
+                raise CommandError(f"Cannot read {options['baseline']}: {error}")
+            if baseline['flock'] != benchmark.flock_size(options['database']):
+                self.stderr.write(self.style.WARNING(
+                    f"The baseline was recorded on a different flock: {baseline['flock']}"
+                ))
+
+        results = benchmark.run(
+            user, repeat=options['repeat'], warmup=options['warmup'], names=options['routes'],
+            modes=options['modes'] or benchmark.MODES, using=options['database'],
+            stdout=self.stdout if options['verbosity'] > 1 else None,
+        )
+        self.stdout.write(
+            f"{'route':<30} {'mode':<11} {'status':>6} {'queries':>7} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}"
+        )
+        for name, result in results.items():
+            if 'skipped' in result:
+                self.stdout.write(f"{name:<30} skipped: {result['skipped']}")
+                continue
+            label = name
+            for mode in benchmark.MODES:
+                timing = result.get(mode)
+                if timing is None:
+                    continue
+                if 'skipped' in timing:
+                    self.stdout.write(f"{label:<30} {mode:<11} skipped: {timing['skipped']}")
+                else:
+                    self.stdout.write(
+                        f"{label:<30} {mode:<11} {timing['status']:>6} {timing['queries']:>7} "
+                        f"{timing['p50_ms']:>9.1f} {timing['p95_ms']:>9.1f} {timing['max_ms']:>9.1f}"
+                    )
+                # The route is named on its first line only
+                label = ''
+
+        if options['save_baseline']:
+            benchmark.save_baseline(options['save_baseline'], results, using=options['database'])
+            self.stdout.write(self.style.SUCCESS(f"Baseline written to {options['save_baseline']}"))
+        if baseline is not None:
+            regressions = benchmark.compare(results, baseline, tolerance=options['tolerance'])
+            for message in regressions:
+                self.stderr.write(message)
+            if regressions:
+                raise CommandError(f"{len(regressions)} regressions against {options['baseline']}")
+            self.stdout.write(self.style.SUCCESS(f"No regressions against {options['baseline']}"))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from sheep import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Measure read and write throughput of concurrent workers on a copy of the database, '
+            'as plain SQLite and as the settings configure it')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=3,
+                            help='Worker processes, like gunicorn workers')
+        parser.add_argument('--threads', type=int, default=2,
+                            help='Threads per worker process')
+        parser.add_argument('--seconds', type=float, default=10,
+                            help='How long each profile runs')
+        parser.add_argument('--write-share', type=float, default=0.2,
+                            help='Fraction of operations that write')
+        parser.add_argument('--database', default=None,
+                            help='Database alias to copy (defaults to the sheep database)')
+
+    def handle(self, *args, **options):
+        if options['processes'] < 1 or options['threads'] < 1 or options['seconds'] <= 0:
+            raise CommandError("--processes, --threads and --seconds must be positive")
+        if not 0 <= options['write_share'] <= 1:
+            raise CommandError("--write-share must be between 0 and 1")
+        results = benchmark.concurrency(
+            processes=options['processes'], threads=options['threads'], seconds=options['seconds'],
+            write_share=options['write_share'], using=options['database'],
+            stdout=self.stdout if options['verbosity'] > 1 else None,
+        )
+        if not results:
+            raise CommandError("No sheep to read and write; generate a flock first")
+        self.stdout.write(f"{'profile':<12} {'kind':<6} {'per sec':>9} {'locked':>7} "
+                          f"{'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+        for profile, result in results.items():
+            for kind, figures in result.items():
+                self.stdout.write(
+                    f"{profile:<12} {kind:<6} {figures['per_second']:>9.1f} {figures['locked']:>7} "
+                    f"{figures['p50_ms'] or 0:>9.1f} {figures['p95_ms'] or 0:>9.1f} {figures['max_ms'] or 0:>9.1f}"
+                )
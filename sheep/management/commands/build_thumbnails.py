@@ -0,0 +1,54 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.files.storage import storages
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from sheep.thumbnails import IMAGE_FIELDS, generate_derivatives
+
+
+def _process(name, force):
+    """Runs in a worker process; returns (name, files written, error)"""
+    try:
+        return name, generate_derivatives(storages['default'], name, force=force), None
+    except Exception as error:
+        return name, 0, str(error)
+
+
+class Command(BaseCommand):
+    help = 'Create resized JPEG and WebP copies of every uploaded sheep and lambing photo'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes (defaults to the number of CPU cores)')
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate derivatives that already exist')
+
+    def handle(self, *args, **options):
+        names = set()
+        for model, field_name in IMAGE_FIELDS:
+            names.update(
+                model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+                .values_list(field_name, flat=True)
+            )
+        names = sorted(names)
+        # Worker processes must not inherit open database connections
+        connections.close_all()
+
+        processed = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = [executor.submit(_process, name, options['force']) for name in names]
+            for future in as_completed(futures):
+                name, written, error = future.result()
+                if error:
+                    failed += 1
+                    self.stderr.write(f"{name}: {error}")
+                elif written:
+                    processed += 1
+                    if options['verbosity'] > 1:
+                        self.stdout.write(f"{name}: {written} files")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Created thumbnails for {processed} of {len(names)} images ({failed} failed)"
+        ))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from sheep import backup
+
+
+class Command(BaseCommand):
+    help = 'Replace one SQLite database with a consistent copy of another, such as production into dev'
+
+    def add_arguments(self, parser):
+        parser.add_argument('target',
+                            help='Database alias to overwrite, such as dev or main')
+        parser.add_argument('--source', default='production',
+                            help='Database alias to copy')
+        parser.add_argument('--scrub-notes', action='store_true',
+                            help='Blank the notes of every sheep and record in the copy')
+        parser.add_argument('--force', action='store_true',
+                            help=f"Allow overwriting {', '.join(backup.PROTECTED_ALIASES)}")
+
+    def handle(self, *args, **options):
+        try:
+            result = backup.clone(options['source'], options['target'],
+                                  scrub_notes=options['scrub_notes'], force=options['force'])
+        except backup.BackupError as error:
+            raise CommandError(str(error))
+        scrubbed = f", blanked the notes of {result['scrubbed']} rows" if options['scrub_notes'] else ''
+        self.stdout.write(self.style.SUCCESS(
+            f"Copied {options['source']} to {options['target']} in {result['seconds']:.1f}s{scrubbed}"
+        ))
@@ -0,0 +1,43 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from sheep.exporter import CHUNK_SIZE, EXPORT_KINDS, FORMATS, export_chunks
+
+
+class Command(BaseCommand):
+    help = 'Export every sheep, lambing record or health record as CSV, JSON lines or XLSX'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(EXPORT_KINDS), help='What to export')
+        parser.add_argument('path', nargs='?', default='-', help="File to write, or '-' for standard output")
+        parser.add_argument('--format', choices=sorted(FORMATS), default=None,
+                            help='Output format (guessed from the file extension, CSV by default)')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Number of rows to fetch and write at a time')
+        parser.add_argument('--database', default=None,
+                            help='Database alias to export from (defaults to the sheep database)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format']
+        if format is None:
+            extension = os.path.splitext(path)[1].lower().lstrip('.')
+            format = {'ndjson': 'jsonl'}.get(extension, extension) if extension in (*FORMATS, 'ndjson') else 'csv'
+        try:
+            output = sys.stdout.buffer if path == '-' else open(path, 'wb')
+        except OSError as error:
+            raise CommandError(f"Cannot open {path}: {error}")
+
+        written = 0
+        try:
+            for chunk in export_chunks(options['kind'], format, chunk_size=options['chunk_size'],
+                                       using=options['database']):
+                output.write(chunk)
+                written += len(chunk)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+        if path != '-':
+            self.stdout.write(self.style.SUCCESS(f"Wrote {written} bytes of {options['kind']} {format} to {path}"))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from sheep.models import Sheep
+from sheep.synthetic import generate
+
+
+class Command(BaseCommand):
+    help = 'Fill an empty database with a synthetic multi-generation flock and its records'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sheep', type=int, default=10000,
+                            help='Number of sheep to create')
+        parser.add_argument('--years', type=int, default=10,
+                            help='Breeding seasons to simulate, ending this year')
+        parser.add_argument('--health-per-year', type=float, default=2.0,
+                            help='Average health records per sheep for each year it is in the flock')
+        parser.add_argument('--images', type=int, default=0,
+                            help='Number of sheep to give a placeholder photo')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Random seed, for generating the same flock again')
+        parser.add_argument('--skip-rebuild', action='store_true',
+                            help='Leave the pedigree closure, search index, dashboard and productivity figures '
+                                 'for the rebuild commands')
+        parser.add_argument('--database', default=None,
+                            help='Database alias to fill (defaults to the sheep database)')
+
+    def handle(self, *args, **options):
+        if options['sheep'] < 1 or options['years'] < 1:
+            raise CommandError("--sheep and --years must be at least 1")
+        if Sheep.objects.db_manager(options['database']).exists():
+            raise CommandError("The database already holds sheep; generate into an empty database")
+        report = generate(
+            sheep=options['sheep'], years=options['years'], health_per_year=options['health_per_year'],
+            images=options['images'], seed=options['seed'], rebuild=not options['skip_rebuild'],
+            using=options['database'], stdout=self.stdout if options['verbosity'] > 1 else None,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Created {report}"))
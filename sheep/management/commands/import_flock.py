@@ -0,0 +1,50 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from sheep.importer import FORMATS, IMPORT_KINDS, import_file, open_text
+
+
+class Command(BaseCommand):
+    help = 'Import sheep, lambing records or health records from a CSV or JSON-lines file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(IMPORT_KINDS), help='What the file contains')
+        parser.add_argument('path', help="File to import, or '-' to read standard input")
+        parser.add_argument('--format', choices=FORMATS, default=None,
+                            help='Input format (guessed from the file extension by default)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Validate and report errors without saving anything')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of rows to validate and insert per transaction')
+        parser.add_argument('--database', default=None,
+                            help='Database alias to import into (defaults to the sheep database)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format']
+        if format is None:
+            format = 'jsonl' if os.path.splitext(path)[1].lower() in ('.jsonl', '.ndjson') else 'csv'
+        try:
+            stream = open_text(sys.stdin.buffer) if path == '-' else open_text(open(path, 'rb'))
+        except OSError as error:
+            raise CommandError(f"Cannot open {path}: {error}")
+
+        with stream:
+            report = import_file(
+                stream, options['kind'], format=format, dry_run=options['dry_run'],
+                batch_size=options['batch_size'], using=options['database'],
+            )
+
+        for line, message in report.errors:
+            self.stderr.write(f"line {line}: {message}")
+        if report.error_count > len(report.errors):
+            self.stderr.write(f"... and {report.error_count - len(report.errors)} more errors")
+        summary = f"{report.rows} rows read, {report.created} {report.kind} rows imported, {report.skipped} skipped"
+        if report.kind == 'sheep':
+            summary += f", {report.parents_linked} parent links set"
+        if report.dry_run:
+            self.stdout.write(self.style.WARNING(f"Dry run, nothing saved: {summary}"))
+        else:
+            self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from sheep.dashboard import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Recount the home page dashboard figures from the sheep and record tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=None,
+                            help='Database alias to rebuild (defaults to the sheep database)')
+
+    def handle(self, *args, **options):
+        totals = rebuild(using=options['database'])
+        self.stdout.write(self.style.SUCCESS(f"Stored {sum(1 for value in totals.values() if value)} dashboard counts"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from sheep.models import SheepAncestor
+from sheep.pedigree import rebuild_closure
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the ancestor closure table from every sheep\'s mother and father'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=None,
+                            help='Database alias to rebuild (defaults to the sheep database)')
+
+    def handle(self, *args, **options):
+        rebuild_closure(using=options['database'])
+        total = SheepAncestor.objects.db_manager(options['database']).count()
+        self.stdout.write(self.style.SUCCESS(f"Stored {total} ancestor links"))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from sheep.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index for sheep and their records'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of rows to read and index per batch')
+        parser.add_argument('--database', default=None,
+                            help='Database alias to reindex (defaults to the sheep database)')
+
+    def handle(self, *args, **options):
+        total = rebuild_search_index(
+            batch_size=options['batch_size'],
+            using=options['database'],
+            stdout=self.stdout if options['verbosity'] > 1 else None,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Indexed {total} rows"))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from sheep.sync import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Give every row missing from the offline change feed a version, and tombstone rows deleted without one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=None,
+                            help='Database alias to rebuild (defaults to the sheep database)')
+
+    def handle(self, *args, **options):
+        written = rebuild(using=options['database'])
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} change feed entries"))
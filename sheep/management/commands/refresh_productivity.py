@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from sheep.productivity import refresh
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the ewe and sire productivity figures from the lambing and breeding records'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=None,
+                            help='Database alias to refresh (defaults to the sheep database)')
+
+    def handle(self, *args, **options):
+        rows = refresh(using=options['database'])
+        self.stdout.write(self.style.SUCCESS(f"Stored productivity figures for {rows} sheep"))
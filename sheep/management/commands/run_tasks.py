@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from sheep import tasks
+
+
+class Command(BaseCommand):
+    help = ('Run queued background tasks, such as photo resizing, exports and backups, '
+            'in a pool of worker processes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2,
+                            help='Worker processes running tasks side by side')
+        parser.add_argument('--poll', type=float, default=1.0,
+                            help='Seconds an idle worker waits before looking for tasks again')
+        parser.add_argument('--burst', action='store_true',
+                            help='Stop once no task is due instead of waiting for more')
+        parser.add_argument('--database', default=None,
+                            help='Database alias holding the queue')
+
+    def handle(self, *args, **options):
+        if options['processes'] < 1 or options['poll'] <= 0:
+            raise CommandError("--processes and --poll must be positive")
+        verbose = options['verbosity'] > 1
+        if verbose or not options['burst']:
+            self.stdout.write(f"Running tasks in {options['processes']} processes; stop with Ctrl+C")
+        tasks.run_workers(
+            processes=options['processes'], poll=options['poll'], burst=options['burst'],
+            using=options['database'], stdout=self.stdout if verbose else None,
+        )
+        self.stdout.write(self.style.SUCCESS("Task workers stopped"))
@@ -0,0 +1,196 @@
+"""
+Per-request timing, SQL instrumentation and profiling.
+
+RequestMetricsMiddleware wraps every database connection for the length
+of a request and notes each statement and how long it took. It also
+times the rendering of TemplateResponses. Staff users get the figures in
+a Server-Timing header, which browser developer tools show with the
+request's timings.
+
+Requests slower than SHEEP_SLOW_REQUEST_MS are written to the
+'sheep.requests' logger as one JSON line each, with their slowest
+statements. So are requests that run one statement at least
+SHEEP_REPEATED_QUERY_THRESHOLD times, the usual sign of a query made
+once per row (N+1).
+
+Each query only costs a clock read and a list append, so the middleware
+is meant to stay on in production.
+
+RequestProfilerMiddleware runs a single request under cProfile when a
+staff user asks for it; see sheep/profiling.py.
+"""
+import cProfile
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.urls import reverse
+from django.utils import timezone
+
+from . import profiling
+
+logger = logging.getLogger('sheep.requests')
+
+# Statements listed in a log line, slowest first
+SLOWEST_STATEMENTS = 5
+
+# Characters of each statement kept in the log and the header
+SQL_PREVIEW = 500
+HEADER_SQL_PREVIEW = 80
+
+IN_LIST = re.compile(r'\((?:%s, )*%s\)')
+SELECT_LIST = re.compile(r'^SELECT (?:DISTINCT )?.+? FROM ', re.DOTALL)
+
+
+def sql_shape(sql):
+    """A statement with IN lists of any length made alike, so per-row queries group together"""
+    return IN_LIST.sub('(...)', sql)
+
+
+def sql_preview(sql, length=SQL_PREVIEW):
+    """The start of a statement with its column list left out, which is rarely what matters"""
+    return SELECT_LIST.sub('SELECT ... FROM ', sql, count=1)[:length]
+
+
+class RequestMetrics:
+    """What one request spent its time on; also the execute wrapper that measures the SQL"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished = None
+        # (sql, seconds) of every statement, in order
+        self.statements = []
+        self.render_started = None
+        self.render_seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.statements.append((sql, time.perf_counter() - started))
+
+    def rendered(self, response):
+        self.render_seconds += time.perf_counter() - self.render_started
+
+    @property
+    def total_ms(self):
+        return ((self.finished or time.perf_counter()) - self.started) * 1000
+
+    @property
+    def sql_ms(self):
+        return sum(seconds for _, seconds in self.statements) * 1000
+
+    def slowest(self, count=SLOWEST_STATEMENTS):
+        return sorted(self.statements, key=lambda statement: statement[1], reverse=True)[:count]
+
+    def repeated(self, threshold):
+        """[(shape, times run)] of statements run at least threshold times, most repeated first"""
+        shapes = Counter()
+        for sql, times in Counter(sql for sql, _ in self.statements).items():
+            shapes[sql_shape(sql)] += times
+        return [(shape, times) for shape, times in shapes.most_common() if times >= threshold]
+
+
+def _header_text(text):
+    """Text safe inside a quoted Server-Timing description"""
+    text = ' '.join(text.split())
+    return text.replace('\\', '').replace('"', "'")
+
+
+def server_timing(metrics, repeated):
+    entries = [f'sql;dur={metrics.sql_ms:.1f};desc="{len(metrics.statements)} queries"']
+    if metrics.render_started is not None:
+        entries.append(f'render;dur={metrics.render_seconds * 1000:.1f};desc="Templates"')
+    entries.append(f'total;dur={metrics.total_ms:.1f}')
+    for shape, times in repeated[:3]:
+        entries.append(f'repeated;desc="{times}x {_header_text(sql_preview(shape, HEADER_SQL_PREVIEW))}"')
+    return ', '.join(entries)
+
+
+class RequestMetricsMiddleware:
+    """Put first in MIDDLEWARE so the figures cover every other middleware too"""
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'SHEEP_REQUEST_METRICS', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slow_ms = getattr(settings, 'SHEEP_SLOW_REQUEST_MS', 500)
+        self.repeat_threshold = getattr(settings, 'SHEEP_REPEATED_QUERY_THRESHOLD', 10)
+
+    def __call__(self, request):
+        metrics = request.metrics = RequestMetrics()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(metrics))
+            response = self.get_response(request)
+        metrics.finished = time.perf_counter()
+
+        repeated = metrics.repeated(self.repeat_threshold)
+        if metrics.total_ms >= self.slow_ms or repeated:
+            self.log(request, response, metrics, repeated)
+        user = getattr(request, 'user', None)
+        if settings.DEBUG or (user is not None and user.is_staff):
+            response['Server-Timing'] = server_timing(metrics, repeated)
+        return response
+
+    def process_template_response(self, request, response):
+        # Runs after every other middleware's hook, just before the response renders
+        request.metrics.render_started = time.perf_counter()
+        response.add_post_render_callback(request.metrics.rendered)
+        return response
+
+    def log(self, request, response, metrics, repeated):
+        user = getattr(request, 'user', None)
+        logger.warning(json.dumps({
+            'time': timezone.now().isoformat(),
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'user': user.pk if user is not None and user.is_authenticated else None,
+            'duration_ms': round(metrics.total_ms, 1),
+            'queries': len(metrics.statements),
+            'sql_ms': round(metrics.sql_ms, 1),
+            'render_ms': round(metrics.render_seconds * 1000, 1),
+            'slow': metrics.total_ms >= self.slow_ms,
+            'slowest': [
+                {'ms': round(seconds * 1000, 2), 'sql': sql_preview(sql)}
+                for sql, seconds in metrics.slowest()
+            ],
+            'repeated': [{'times': times, 'sql': sql_preview(shape)} for shape, times in repeated],
+        }))
+
+
+class RequestProfilerMiddleware:
+    """Put after AuthenticationMiddleware, which it needs to tell staff apart"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not (profiling.requested(request) and request.user.is_staff):
+            return self.get_response(request)
+        if not profiling.lock.acquire(blocking=False):
+            response = self.get_response(request)
+            response['X-Profile'] = 'busy'
+            return response
+        try:
+            profiler = cProfile.Profile()
+            started = time.perf_counter()
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+            duration_ms = (time.perf_counter() - started) * 1000
+            profile_id = profiling.save(profiler, request, response, duration_ms)
+        finally:
+            profiling.lock.release()
+        response['X-Profile'] = request.build_absolute_uri(reverse('profile-detail', args=[profile_id]))
+        return response
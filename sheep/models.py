@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.db import models
 from django.utils import timezone
 import uuid
@@ -128,6 +129,10 @@ class Sheep(models.Model):
         indexes = [
             models.Index(fields=['tag_number']),
             models.Index(fields=['status']),
+            # Keyset pagination on the sheep list seeks on (status, sort field, id)
+            models.Index(fields=['status', 'updated_at', 'id']),
+            models.Index(fields=['status', 'tag_number', 'id']),
+            models.Index(fields=['status', 'date_of_birth']),
         ]
     
     def __str__(self):
@@ -135,6 +140,26 @@ class Sheep(models.Model):
             return f"{self.tag_number} - {self.name}"
         return self.tag_number
     
+    def save(self, *args, **kwargs):
+        # Every save counts as a modification, for the list's sort and for offline devices
+        self.updated_at = timezone.now()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'updated_at' not in update_fields:
+            kwargs['update_fields'] = [*update_fields, 'updated_at']
+        super().save(*args, **kwargs)
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the loaded parents so a save can tell whether lineage changed
+        instance._loaded_parents = (instance.__dict__.get('mother_id'), instance.__dict__.get('father_id'))
+        return instance
+    
+    @property
+    def parents_changed(self):
+        """True if mother or father differ from what was loaded (always True for new sheep)"""
+        return getattr(self, '_loaded_parents', None) != (self.mother_id, self.father_id)
+    
     @property
     def age(self):
         """Calculate the age of the sheep in days"""
@@ -152,6 +177,28 @@ class Sheep(models.Model):
         return None
 
 
+class SheepAncestor(models.Model):
+    """
+    Materialized ancestor closure: one row per (sheep, ancestor) pair.
+
+    Maintained by sheep.pedigree whenever a sheep's parents change, so the
+    full ancestor or descendant set of any sheep is a single indexed lookup.
+    """
+    descendant = models.ForeignKey(Sheep, on_delete=models.CASCADE, related_name='ancestor_links')
+    ancestor = models.ForeignKey(Sheep, on_delete=models.CASCADE, related_name='descendant_links')
+    # Generations between the two; 1 is a parent. Shortest path when there are several.
+    depth = models.PositiveSmallIntegerField()
+    
+    class Meta:
+        unique_together = ['descendant', 'ancestor']
+        indexes = [
+            models.Index(fields=['ancestor', 'depth']),
+        ]
+    
+    def __str__(self):
+        return f"{self.ancestor} is an ancestor of {self.descendant} ({self.depth} generations)"
+
+
 class SheepImage(models.Model):
     """Model for storing additional sheep images"""
     image = models.ImageField(upload_to=sheep_image_path)
@@ -287,7 +334,153 @@ class HealthRecord(models.Model):
         indexes = [
             models.Index(fields=['date']),
             models.Index(fields=['record_type']),
+            # The health record list filters by type and pages on (date, id)
+            models.Index(fields=['record_type', 'date', 'id']),
+            models.Index(fields=['requires_followup', 'followup_date']),
         ]
     
     def __str__(self):
         return f"{self.get_record_type_display()} for {self.sheep} on {self.date}"
+
+
+class FlockStat(models.Model):
+    """
+    One running count shown on the home page dashboard.
+
+    Kept current by sheep.dashboard as sheep and records are saved and
+    deleted, so the dashboard never has to count the whole flock.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    value = models.BigIntegerField(default=0)
+    
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+
+class SheepProductivity(models.Model):
+    """
+    Lifetime lambing figures of a ewe and progeny figures of a ram.
+
+    A materialized table: sheep.productivity.refresh() rebuilds every row
+    in one statement from the lambing, breeding and sheep tables.
+    """
+    sheep = models.OneToOneField(Sheep, on_delete=models.CASCADE, primary_key=True, related_name='productivity')
+    
+    # As a ewe, from her lambing records
+    lambings = models.PositiveIntegerField(default=0)
+    lambs_born = models.PositiveIntegerField(default=0)
+    lambs_alive = models.PositiveIntegerField(default=0)
+    lambs_dead = models.PositiveIntegerField(default=0)
+    lambing_rate = models.FloatField(null=True, blank=True, help_text="Lambs born per lambing")
+    survival_rate = models.FloatField(null=True, blank=True, help_text="Share of lambs born alive")
+    first_lambing = models.DateField(null=True, blank=True)
+    last_lambing = models.DateField(null=True, blank=True)
+    lambing_interval = models.FloatField(null=True, blank=True, help_text="Average days between consecutive lambings")
+    ewe_rank = models.PositiveIntegerField(null=True, blank=True, help_text="Position among active ewes by lambs born alive per lambing")
+    
+    # As a ram, from Sheep.father and the lambings his breedings led to
+    progeny = models.PositiveIntegerField(default=0)
+    progeny_active = models.PositiveIntegerField(default=0)
+    ewes_bred = models.PositiveIntegerField(default=0)
+    sired_lambings = models.PositiveIntegerField(default=0)
+    sired_lambs_born = models.PositiveIntegerField(default=0)
+    sired_lambs_alive = models.PositiveIntegerField(default=0)
+    sired_survival_rate = models.FloatField(null=True, blank=True, help_text="Share of sired lambs born alive")
+    
+    refreshed_at = models.DateTimeField()
+    
+    class Meta:
+        verbose_name_plural = "sheep productivity"
+        indexes = [
+            models.Index(fields=['ewe_rank']),
+            models.Index(fields=['lambing_rate']),
+            models.Index(fields=['survival_rate']),
+            models.Index(fields=['sired_lambs_alive']),
+        ]
+    
+    def __str__(self):
+        return f"Productivity of {self.sheep}"
+
+
+class SyncChange(models.Model):
+    """
+    The latest change to one row shown by the API, for offline devices.
+
+    Kept by sheep.sync: each save or delete replaces the row's entry with
+    a new one, so the id only grows and doubles as the row's version and
+    as the cursor of the change feed. Deletes stay as tombstones.
+    """
+    kind = models.CharField(max_length=20)
+    object_id = models.PositiveIntegerField()
+    deleted = models.BooleanField(default=False)
+    changed_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        unique_together = ['kind', 'object_id']
+        indexes = [
+            # The latest change of a kind, for conditional GET of whole lists
+            models.Index(fields=['kind', 'id']),
+        ]
+    
+    def __str__(self):
+        action = 'deleted' if self.deleted else 'changed'
+        return f"{self.kind} {self.object_id} {action} (version {self.pk})"
+
+
+class Task(models.Model):
+    """
+    A piece of slow work for the task worker, run outside any request.
+
+    Queued by sheep.tasks.enqueue() and claimed by the processes of the
+    run_tasks command, highest priority first. A task that fails is queued
+    again after a growing delay until it has used up its attempts.
+    """
+    STATUS_CHOICES = [
+        ('QUEUED', 'Queued'),
+        ('RUNNING', 'Running'),
+        ('SUCCEEDED', 'Succeeded'),
+        ('FAILED', 'Failed'),
+    ]
+
+    name = models.CharField(max_length=50)
+    arguments = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='QUEUED')
+    priority = models.IntegerField(default=0, help_text="Higher runs first")
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Refreshed by progress reports, so a task whose worker died can be told apart
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    progress_done = models.PositiveIntegerField(default=0)
+    progress_total = models.PositiveIntegerField(null=True, blank=True)
+    progress_message = models.CharField(max_length=255, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            # The next task to claim
+            models.Index(fields=['status', '-priority', 'run_after', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.get_status_display()})"
+
+    @property
+    def finished(self):
+        return self.status in ('SUCCEEDED', 'FAILED')
+
+    @property
+    def percent(self):
+        """Share of the work done, or None when the task has not said how much there is"""
+        if self.status == 'SUCCEEDED':
+            return 100
+        if not self.progress_total:
+            return None
+        return min(100, round(self.progress_done * 100 / self.progress_total))
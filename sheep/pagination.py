@@ -0,0 +1,107 @@
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.db import models
+
+
+class InvalidCursor(Exception):
+    """Raised when a pagination cursor cannot be decoded"""
+    pass
+
+
+class KeysetPage:
+    """One page of results from a KeysetPaginator"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class KeysetPaginator:
+    """
+    Paginate a queryset with a cursor on (field, id) instead of OFFSET.
+
+    The cost of fetching a page stays the same no matter how deep into the
+    list the user goes, because every page is a range scan that starts at
+    the last row of the previous one. The ordering field must not be null.
+    """
+
+    def __init__(self, queryset, ordering, per_page=50):
+        self.queryset = queryset
+        self.descending = ordering.startswith('-')
+        self.field_name = ordering.lstrip('-')
+        self.field = queryset.model._meta.get_field(self.field_name)
+        self.per_page = per_page
+
+    def encode_cursor(self, obj):
+        if isinstance(obj, dict):
+            # A values() row, which must include the ordering field and 'pk'
+            value, pk = obj[self.field_name], obj['pk']
+            value = value.isoformat() if hasattr(value, 'isoformat') else str(value)
+        else:
+            value, pk = self.field.value_to_string(obj), obj.pk
+        data = json.dumps([value, pk], separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            value, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            return self.field.to_python(value), int(pk)
+        except (ValueError, TypeError, ValidationError):
+            raise InvalidCursor(cursor)
+
+    def _ordered(self, reverse):
+        descending = self.descending != reverse
+        prefix = '-' if descending else ''
+        return self.queryset.order_by(f'{prefix}{self.field_name}', f'{prefix}pk'), descending
+
+    def _seek(self, queryset, cursor, descending):
+        value, pk = self.decode_cursor(cursor)
+        lookup = 'lt' if descending else 'gt'
+        return queryset.filter(
+            models.Q(**{f'{self.field_name}__{lookup}': value}) |
+            models.Q(**{self.field_name: value, f'pk__{lookup}': pk})
+        )
+
+    def page(self, after=None, before=None):
+        """Return the page that follows `after`, or precedes `before`"""
+        backwards = bool(before) and not after
+        queryset, descending = self._ordered(reverse=backwards)
+        cursor = before if backwards else after
+        if cursor:
+            queryset = self._seek(queryset, cursor, descending)
+
+        # Fetch one extra row to learn whether there is another page
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+
+        if not rows:
+            return KeysetPage(rows)
+
+        if backwards:
+            next_cursor = self.encode_cursor(rows[-1])
+            previous_cursor = self.encode_cursor(rows[0]) if has_more else None
+        else:
+            next_cursor = self.encode_cursor(rows[-1]) if has_more else None
+            previous_cursor = self.encode_cursor(rows[0]) if cursor else None
+        return KeysetPage(rows, next_cursor, previous_cursor)
@@ -0,0 +1,184 @@
+"""
+Pedigree queries over the Sheep.mother / Sheep.father self-references.
+
+Ancestor trees and descendant sets are fetched with a single recursive CTE
+instead of walking one generation per query. The SheepAncestor closure
+table is kept current here so the full lineage of a sheep is also available
+as an ordinary indexed join.
+"""
+from django.db import connections, router, transaction
+from django.db.models.expressions import RawSQL
+
+from .models import Breed, Sheep, SheepAncestor
+
+# Guards against runaway recursion if bad data ever makes a sheep its own ancestor
+MAX_DEPTH = 64
+
+# Rows per statement when rebuilding the closure for a set of sheep
+CHUNK_SIZE = 500
+
+SHEEP_TABLE = Sheep._meta.db_table
+CLOSURE_TABLE = SheepAncestor._meta.db_table
+
+# Expands one sheep row into its sire ('s') and dam ('d') parent links
+PARENT_SIDES = "(SELECT 's' AS code UNION ALL SELECT 'd')"
+PARENT_ID = "CASE side.code WHEN 's' THEN s.father_id ELSE s.mother_id END"
+
+ANCESTOR_TREE_SQL = f"""
+    WITH RECURSIVE tree(sheep_id, path) AS (
+        SELECT %s, ''
+        UNION ALL
+        SELECT {PARENT_ID}, tree.path || side.code
+        FROM tree
+        JOIN {SHEEP_TABLE} s ON s.id = tree.sheep_id
+        CROSS JOIN {PARENT_SIDES} AS side
+        WHERE length(tree.path) < %s AND {PARENT_ID} IS NOT NULL
+    )
+    SELECT s.*, tree.path AS pedigree_path
+    FROM tree JOIN {SHEEP_TABLE} s ON s.id = tree.sheep_id
+"""
+
+ANCESTOR_IDS_SQL = f"""
+    WITH RECURSIVE ancestors(id, depth) AS (
+        SELECT mother_id, 1 FROM {SHEEP_TABLE} WHERE id = %s AND mother_id IS NOT NULL
+        UNION
+        SELECT father_id, 1 FROM {SHEEP_TABLE} WHERE id = %s AND father_id IS NOT NULL
+        UNION
+        SELECT {PARENT_ID}, ancestors.depth + 1
+        FROM ancestors
+        JOIN {SHEEP_TABLE} s ON s.id = ancestors.id
+        CROSS JOIN {PARENT_SIDES} AS side
+        WHERE ancestors.depth < %s AND {PARENT_ID} IS NOT NULL
+    )
+    SELECT id FROM ancestors
+"""
+
+DESCENDANT_IDS_SQL = f"""
+    WITH RECURSIVE descendants(id) AS (
+        SELECT id FROM {SHEEP_TABLE} WHERE mother_id = %s OR father_id = %s
+        UNION
+        SELECT s.id FROM {SHEEP_TABLE} s
+        JOIN descendants ON s.mother_id = descendants.id OR s.father_id = descendants.id
+    )
+    SELECT id FROM descendants
+"""
+
+CLOSURE_INSERT_SQL = f"""
+    INSERT INTO {CLOSURE_TABLE} (descendant_id, ancestor_id, depth)
+    WITH RECURSIVE links(descendant_id, ancestor_id, depth) AS (
+        SELECT id, mother_id, 1 FROM {SHEEP_TABLE} WHERE mother_id IS NOT NULL AND {{where}}
+        UNION
+        SELECT id, father_id, 1 FROM {SHEEP_TABLE} WHERE father_id IS NOT NULL AND {{where}}
+        UNION
+        SELECT links.descendant_id, {PARENT_ID}, links.depth + 1
+        FROM links
+        JOIN {SHEEP_TABLE} s ON s.id = links.ancestor_id
+        CROSS JOIN {PARENT_SIDES} AS side
+        WHERE links.depth < {MAX_DEPTH} AND {PARENT_ID} IS NOT NULL
+    )
+    SELECT descendant_id, ancestor_id, MIN(depth) FROM links GROUP BY descendant_id, ancestor_id
+"""
+
+
+def _connection(using=None):
+    return connections[using or router.db_for_write(Sheep)]
+
+
+def ancestor_tree(sheep, generations=4, using=None):
+    """
+    Return {path: Sheep} for the sheep and its ancestors up to `generations` back.
+
+    A path spells out the route from the sheep, one letter per generation:
+    '' is the sheep itself, 's' its sire, 'd' its dam, 'sd' the sire's dam.
+    Each returned sheep also carries a `breed_name` attribute.
+    """
+    queryset = Sheep.objects.using(using or router.db_for_read(Sheep)).raw(
+        f"SELECT t.*, b.name AS breed_name FROM ({ANCESTOR_TREE_SQL}) t "
+        f"JOIN {Breed._meta.db_table} b ON b.id = t.breed_id",
+        [sheep.pk, generations],
+    )
+    return {row.pedigree_path: row for row in queryset}
+
+
+def pedigree_chart(tree, generations):
+    """
+    Lay an ancestor tree out as table rows for a classic pedigree chart.
+
+    Generation g occupies 2**g cells, each spanning 2**(generations - g) rows,
+    with the sire's side above the dam's.
+    """
+    total_rows = 2 ** generations
+    rows = []
+    for row_index in range(total_rows):
+        cells = []
+        for generation in range(1, generations + 1):
+            span = 2 ** (generations - generation)
+            if row_index % span:
+                continue
+            position = row_index // span
+            path = ''.join(
+                'd' if (position >> (generation - 1 - bit)) & 1 else 's'
+                for bit in range(generation)
+            )
+            cells.append({
+                'path': path,
+                'sheep': tree.get(path),
+                'generation': generation,
+                'rowspan': span,
+            })
+        rows.append(cells)
+    return rows
+
+
+def ancestors_queryset(sheep):
+    """All ancestors of a sheep, as a queryset built on one recursive CTE"""
+    return Sheep.objects.filter(pk__in=RawSQL(ANCESTOR_IDS_SQL, [sheep.pk, sheep.pk, MAX_DEPTH]))
+
+
+def descendants_queryset(sheep):
+    """All descendants of a sheep, as a queryset built on one recursive CTE"""
+    return Sheep.objects.filter(pk__in=RawSQL(DESCENDANT_IDS_SQL, [sheep.pk, sheep.pk]))
+
+
+def rebuild_closure(sheep_ids=None, using=None):
+    """
+    Recompute SheepAncestor rows for the given sheep, or for every sheep.
+
+    Only the listed sheep are refreshed; callers that change a sheep's parents
+    must include its descendants too (see rebuild_closure_for).
+    """
+    connection = _connection(using)
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        if sheep_ids is None:
+            cursor.execute(f"DELETE FROM {CLOSURE_TABLE}")
+            cursor.execute(CLOSURE_INSERT_SQL.format(where='1 = 1'))
+            return
+        sheep_ids = list(sheep_ids)
+        for start in range(0, len(sheep_ids), CHUNK_SIZE):
+            chunk = sheep_ids[start:start + CHUNK_SIZE]
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cursor.execute(f"DELETE FROM {CLOSURE_TABLE} WHERE descendant_id IN ({placeholders})", chunk)
+            cursor.execute(CLOSURE_INSERT_SQL.format(where=f"id IN ({placeholders})"), chunk * 2)
+
+
+def descendant_ids(sheep_id, using=None):
+    """Ids of every recorded descendant of a sheep, read from the closure table"""
+    return list(
+        SheepAncestor.objects.using(using or router.db_for_read(SheepAncestor))
+        .filter(ancestor_id=sheep_id)
+        .values_list('descendant_id', flat=True)
+    )
+
+
+def rebuild_closure_for(sheep, using=None):
+    """Refresh the closure after a sheep's parents changed"""
+    rebuild_closure([sheep.pk] + descendant_ids(sheep.pk, using=using), using=using)
+
+
+def would_create_cycle(sheep, parent):
+    """True if making `parent` a parent of `sheep` would make a sheep its own ancestor"""
+    if sheep.pk is None or parent is None:
+        return False
+    if parent.pk == sheep.pk:
+        return True
+    return SheepAncestor.objects.filter(ancestor_id=sheep.pk, descendant_id=parent.pk).exists()
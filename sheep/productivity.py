@@ -0,0 +1,127 @@
+"""
+Ewe and sire productivity, materialized in SheepProductivity.
+
+refresh() recomputes every row with one INSERT ... SELECT. Window
+functions provide the figures that need neighbouring rows:
+- LAG() gives each lambing the date of the ewe's previous one, for
+  lambing intervals
+- ROW_NUMBER() picks, for each lambing, the ewe's latest breeding that
+  fits a gestation, to credit the lambs to that ram
+- RANK() orders the active ewes for culling
+Pages then sort and filter the stored rows through ordinary indexes
+instead of re-aggregating the lambing records on every request.
+"""
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from .models import Sheep, SheepProductivity, LambingRecord, BreedingRecord
+
+# A lambing is credited to a breeding when it falls between GESTATION_MIN_DAYS
+# after the ram went in and GESTATION_MAX_DAYS after he came out
+GESTATION_MIN_DAYS = 138
+GESTATION_MAX_DAYS = 155
+
+# Assumed time with the ram when a breeding has no end date: three heat cycles
+DEFAULT_EXPOSURE_DAYS = 51
+
+PRODUCTIVITY_TABLE = SheepProductivity._meta.db_table
+SHEEP_TABLE = Sheep._meta.db_table
+LAMBING_TABLE = LambingRecord._meta.db_table
+BREEDING_TABLE = BreedingRecord._meta.db_table
+
+REFRESH_SQL = f"""
+    INSERT INTO {PRODUCTIVITY_TABLE} (
+        sheep_id, lambings, lambs_born, lambs_alive, lambs_dead, lambing_rate, survival_rate,
+        first_lambing, last_lambing, lambing_interval, ewe_rank,
+        progeny, progeny_active, ewes_bred, sired_lambings, sired_lambs_born, sired_lambs_alive,
+        sired_survival_rate, refreshed_at
+    )
+    WITH lambing AS (
+        SELECT l.*,
+               julianday(l.date) - julianday(LAG(l.date) OVER (PARTITION BY l.ewe_id ORDER BY l.date, l.id))
+                   AS interval_days
+        FROM {LAMBING_TABLE} l
+    ),
+    ewe AS (
+        SELECT ewe_id AS sheep_id, COUNT(*) AS lambings,
+               SUM(total_born) AS lambs_born, SUM(born_alive) AS lambs_alive, SUM(born_dead) AS lambs_dead,
+               MIN(date) AS first_lambing, MAX(date) AS last_lambing, AVG(interval_days) AS lambing_interval
+        FROM lambing
+        GROUP BY ewe_id
+    ),
+    credited AS (
+        SELECT l.total_born, l.born_alive, b.ram_id,
+               ROW_NUMBER() OVER (PARTITION BY l.id ORDER BY b.date_started DESC, b.id DESC) AS latest
+        FROM {LAMBING_TABLE} l
+        JOIN {BREEDING_TABLE} b ON b.ewe_id = l.ewe_id
+        WHERE b.status != 'CANCELLED'
+          AND julianday(l.date) >= julianday(b.date_started) + %(gestation_min)s
+          AND julianday(l.date) <= julianday(COALESCE(b.date_ended, date(b.date_started, %(exposure)s)))
+                                   + %(gestation_max)s
+    ),
+    sired AS (
+        SELECT ram_id AS sheep_id, COUNT(*) AS sired_lambings,
+               SUM(total_born) AS sired_lambs_born, SUM(born_alive) AS sired_lambs_alive
+        FROM credited
+        WHERE latest = 1
+        GROUP BY ram_id
+    ),
+    bred AS (
+        SELECT ram_id AS sheep_id, COUNT(DISTINCT ewe_id) AS ewes_bred
+        FROM {BREEDING_TABLE}
+        WHERE status != 'CANCELLED'
+        GROUP BY ram_id
+    ),
+    offspring AS (
+        SELECT father_id AS sheep_id, COUNT(*) AS progeny, SUM(status = 'ACTIVE') AS progeny_active
+        FROM {SHEEP_TABLE}
+        WHERE father_id IS NOT NULL
+        GROUP BY father_id
+    )
+    SELECT s.id,
+           COALESCE(ewe.lambings, 0), COALESCE(ewe.lambs_born, 0),
+           COALESCE(ewe.lambs_alive, 0), COALESCE(ewe.lambs_dead, 0),
+           ewe.lambs_born * 1.0 / ewe.lambings,
+           CASE WHEN ewe.lambs_born > 0 THEN ewe.lambs_alive * 1.0 / ewe.lambs_born END,
+           ewe.first_lambing, ewe.last_lambing, ewe.lambing_interval,
+           CASE WHEN ewe.sheep_id IS NOT NULL AND s.status = 'ACTIVE' THEN
+               RANK() OVER (
+                   PARTITION BY ewe.sheep_id IS NOT NULL AND s.status = 'ACTIVE'
+                   ORDER BY ewe.lambs_alive * 1.0 / ewe.lambings DESC, ewe.lambings DESC
+               )
+           END,
+           COALESCE(offspring.progeny, 0), COALESCE(offspring.progeny_active, 0),
+           COALESCE(bred.ewes_bred, 0), COALESCE(sired.sired_lambings, 0),
+           COALESCE(sired.sired_lambs_born, 0), COALESCE(sired.sired_lambs_alive, 0),
+           CASE WHEN sired.sired_lambs_born > 0 THEN sired.sired_lambs_alive * 1.0 / sired.sired_lambs_born END,
+           %(refreshed_at)s
+    FROM {SHEEP_TABLE} s
+    LEFT JOIN ewe ON ewe.sheep_id = s.id
+    LEFT JOIN sired ON sired.sheep_id = s.id
+    LEFT JOIN bred ON bred.sheep_id = s.id
+    LEFT JOIN offspring ON offspring.sheep_id = s.id
+    WHERE ewe.sheep_id IS NOT NULL OR sired.sheep_id IS NOT NULL
+       OR bred.sheep_id IS NOT NULL OR offspring.sheep_id IS NOT NULL
+"""
+
+
+def refresh(using=None):
+    """Recompute every SheepProductivity row; returns how many there are"""
+    connection = connections[using or router.db_for_write(SheepProductivity)]
+    refreshed_at = timezone.now()
+    params = {
+        'gestation_min': GESTATION_MIN_DAYS,
+        'gestation_max': GESTATION_MAX_DAYS,
+        'exposure': f'+{DEFAULT_EXPOSURE_DAYS} days',
+        'refreshed_at': connection.ops.adapt_datetimefield_value(refreshed_at),
+    }
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {PRODUCTIVITY_TABLE}")
+        cursor.execute(REFRESH_SQL, params)
+        return cursor.rowcount
+
+
+def last_refreshed(using=None):
+    """When the table was last refreshed, or None if it never was"""
+    row = SheepProductivity.objects.using(using or router.db_for_read(SheepProductivity)).only('refreshed_at').first()
+    return row.refreshed_at if row else None
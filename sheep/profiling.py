@@ -0,0 +1,138 @@
+"""
+Stored cProfile profiles of single requests.
+
+A staff user asks for one by adding ?profile=1 to a URL or sending an
+X-Profile header; RequestProfilerMiddleware then runs that request under
+cProfile and save() writes the result to SHEEP_PROFILE_DIR as a standard
+.prof file, which snakeviz or `python -m pstats` open directly, with a
+small JSON file beside it holding the URL, time and duration. Only the
+newest SHEEP_PROFILE_KEEP profiles are kept.
+
+A profile only covers the thread it was taken in, and one request per
+process is profiled at a time, so other requests run as usual.
+"""
+import json
+import os
+import pstats
+import re
+import threading
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.utils import timezone
+
+# Taken before profiling a request; other requests asking for a profile meanwhile run unprofiled
+lock = threading.Lock()
+
+PROFILE_ID = re.compile(r'^\d{8}-\d{6}-[0-9a-f]{8}$')
+
+# Sort parameter of the call table -> pstats sort key and label
+SORTS = {
+    'cumulative': ('cumulative', 'Cumulative time'),
+    'tottime': ('tottime', 'Own time'),
+    'ncalls': ('ncalls', 'Calls'),
+}
+
+
+def profile_dir():
+    return str(getattr(settings, 'SHEEP_PROFILE_DIR', settings.BASE_DIR / 'profiles'))
+
+
+def keep():
+    return getattr(settings, 'SHEEP_PROFILE_KEEP', 50)
+
+
+def requested(request):
+    return 'profile' in request.GET or 'HTTP_X_PROFILE' in request.META
+
+
+def path(profile_id, ext='prof'):
+    """File of a stored profile; ids that could not have been stored are refused"""
+    if not PROFILE_ID.match(profile_id):
+        raise FileNotFoundError(profile_id)
+    return os.path.join(profile_dir(), f'{profile_id}.{ext}')
+
+
+def save(profiler, request, response, duration_ms):
+    """Write a finished profile and its details; returns the profile id"""
+    os.makedirs(profile_dir(), exist_ok=True)
+    now = timezone.now()
+    profile_id = f"{now:%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}"
+    profiler.dump_stats(path(profile_id))
+    details = {
+        'id': profile_id,
+        'created': now.isoformat(),
+        'method': request.method,
+        'path': request.get_full_path(),
+        'status': response.status_code,
+        'user': request.user.get_username(),
+        'duration_ms': round(duration_ms, 1),
+    }
+    with open(path(profile_id, 'json'), 'w') as file:
+        json.dump(details, file)
+    prune()
+    return profile_id
+
+
+def prune():
+    """Delete all but the newest SHEEP_PROFILE_KEEP profiles"""
+    for stored in list_profiles()[keep():]:
+        for ext in ('prof', 'json'):
+            try:
+                os.remove(path(stored['id'], ext))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles():
+    """Details of every stored profile, newest first"""
+    try:
+        names = os.listdir(profile_dir())
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in sorted(names, reverse=True):
+        profile_id, ext = os.path.splitext(name)
+        if ext == '.json' and PROFILE_ID.match(profile_id):
+            try:
+                profiles.append(details(profile_id))
+            except (OSError, ValueError):
+                continue
+    return profiles
+
+
+def details(profile_id):
+    with open(path(profile_id, 'json')) as file:
+        data = json.load(file)
+    data['created'] = datetime.fromisoformat(data['created'])
+    return data
+
+
+def call_table(profile_id, sort='cumulative', limit=100):
+    """(total seconds, rows of the slowest functions by the given sort) of a stored profile"""
+    stats = pstats.Stats(path(profile_id))
+    stats.sort_stats(SORTS.get(sort, SORTS['cumulative'])[0])
+    rows = []
+    for function in stats.fcn_list[:limit]:
+        primitive_calls, calls, own_time, cumulative_time, _ = stats.stats[function]
+        filename, line, name = function
+        rows.append({
+            'calls': calls if calls == primitive_calls else f'{calls}/{primitive_calls}',
+            'own_ms': own_time * 1000,
+            'own_per_call_ms': own_time * 1000 / calls if calls else 0,
+            'cumulative_ms': cumulative_time * 1000,
+            'cumulative_per_call_ms': cumulative_time * 1000 / primitive_calls if primitive_calls else 0,
+            'short_file': _short_path(filename),
+            'line': line,
+            'name': name,
+        })
+    return stats.total_tt, rows
+
+
+def _short_path(filename):
+    """Paths below site-packages or the project shown from there"""
+    for marker in ('site-packages' + os.sep, str(settings.BASE_DIR) + os.sep):
+        if marker in filename:
+            return filename.split(marker, 1)[1]
+    return filename
@@ -0,0 +1,72 @@
+"""
+Per-model versions for caching rendered list and detail pages.
+
+Each cached page body is a template fragment keyed on the current version
+of every model it shows, plus the request path. The signals in signals.py
+drop a model's version after any save or delete of one of its rows, so
+the next request renders from the database again, while pages that do
+not show that model keep their cached copy.
+
+The versions and fragments live in the default cache, which settings.py
+points at a directory shared by all gunicorn workers, so a change made
+through one worker is seen by the others.
+
+Caching is off unless SHEEP_RESPONSE_CACHE_TIMEOUT is set to a number of seconds.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+
+def cache_timeout():
+    return getattr(settings, 'SHEEP_RESPONSE_CACHE_TIMEOUT', 0)
+
+
+def enabled():
+    return bool(cache_timeout())
+
+
+def _version_key(model):
+    return f'response-cache:version:{model._meta.label_lower}'
+
+
+def version(*models):
+    """Combined current version of the given models"""
+    keys = [_version_key(model) for model in models]
+    values = cache.get_many(keys)
+    for key in keys:
+        if key not in values:
+            value = uuid.uuid4().hex
+            if not cache.add(key, value, None):
+                value = cache.get(key, value)
+            values[key] = value
+    return '.'.join(values[key] for key in keys)
+
+
+def invalidate(*models, using=None):
+    """
+    Drop the cached pages of the given models once the current transaction commits.
+
+    Waiting for the commit stops another worker from caching a page it
+    rendered from the old rows under the new version.
+    """
+    keys = [_version_key(model) for model in models]
+    transaction.on_commit(lambda: cache.delete_many(keys), using=using)
+
+
+class CachedFragmentMixin:
+    """
+    Adds what a page's {% cache %} fragment is keyed on to the context.
+
+    Set cache_models to every model whose rows appear in the fragment.
+    """
+    cache_models = ()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['response_cache_timeout'] = cache_timeout()
+        if context['response_cache_timeout']:
+            context['response_cache_version'] = version(*self.cache_models)
+        return context
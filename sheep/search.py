@@ -0,0 +1,239 @@
+"""
+Full-text search over sheep and their records, backed by SQLite FTS5.
+
+Every searchable row is mirrored into a single FTS5 table keyed by
+(kind, object_id). The index is kept in sync by the signal handlers in
+sheep/signals.py and can be rebuilt with `manage.py rebuild_search_index`.
+
+FTS5 cannot index the kind and object_id columns, so each entry's rowid
+is worked out from them (see search_rowid()), and replacing or removing
+an entry is a rowid lookup instead of a scan of the whole index.
+"""
+import re
+
+from django.db import connections, router, transaction
+
+from .models import Sheep, HealthRecord, LambingRecord, BreedingRecord
+
+SEARCH_TABLE = 'sheep_search'
+
+# kind -> (model, function returning the title and body text to index)
+SEARCH_SOURCES = {
+    'sheep': (Sheep, lambda s: (
+        f"{s.tag_number} {s.name}",
+        ' '.join([s.color, s.markings, s.notes]),
+    )),
+    'health': (HealthRecord, lambda r: (
+        f"{r.get_record_type_display()} {r.treatment}",
+        ' '.join([r.dosage, r.administered_by, r.notes]),
+    )),
+    'lambing': (LambingRecord, lambda r: (
+        'Lambing',
+        ' '.join([r.complications, r.notes]),
+    )),
+    'breeding': (BreedingRecord, lambda r: (
+        f"Breeding {r.get_status_display()}",
+        r.notes,
+    )),
+}
+
+# kind -> attribute holding the id of the sheep the row belongs to
+SHEEP_ID_ATTR = {
+    'sheep': 'pk',
+    'health': 'sheep_id',
+    'lambing': 'ewe_id',
+    'breeding': 'ewe_id',
+}
+
+# Rowids are object_id * len(KIND_CODES) + the kind's code
+KIND_CODES = {kind: code for code, kind in enumerate(SEARCH_SOURCES)}
+
+_ready_aliases = set()
+
+
+def _kind_for(instance):
+    for kind, (model, _) in SEARCH_SOURCES.items():
+        if isinstance(instance, model):
+            return kind
+    return None
+
+
+def search_rowid(kind, object_id):
+    return object_id * len(KIND_CODES) + KIND_CODES[kind]
+
+
+def _connection(using=None):
+    connection = connections[using or router.db_for_write(Sheep)]
+    if connection.vendor != 'sqlite':
+        return None
+    return connection
+
+
+def ensure_search_index(using=None):
+    """Create the FTS5 table if it does not exist yet"""
+    connection = _connection(using)
+    if connection is None or connection.alias in _ready_aliases:
+        return connection
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+            "kind UNINDEXED, object_id UNINDEXED, sheep_id UNINDEXED, title, body, "
+            "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+    _ready_aliases.add(connection.alias)
+    return connection
+
+
+def _row(kind, instance):
+    _, document = SEARCH_SOURCES[kind]
+    title, body = document(instance)
+    return (search_rowid(kind, instance.pk), kind, instance.pk, getattr(instance, SHEEP_ID_ATTR[kind]), title, body)
+
+
+def _insert(cursor, rows):
+    cursor.executemany(f"INSERT INTO {SEARCH_TABLE}(rowid, kind, object_id, sheep_id, title, body) "
+                       "VALUES (%s, %s, %s, %s, %s, %s)", rows)
+
+
+def _delete(cursor, kind, object_ids):
+    cursor.executemany(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s",
+                       [(search_rowid(kind, object_id),) for object_id in object_ids])
+
+
+def index_object(instance, using=None):
+    """Add or replace the index entry for a single object"""
+    kind = _kind_for(instance)
+    connection = ensure_search_index(using)
+    if kind is None or connection is None:
+        return
+    with connection.cursor() as cursor:
+        _delete(cursor, kind, [instance.pk])
+        _insert(cursor, [_row(kind, instance)])
+
+
+def remove_object(instance, using=None):
+    """Drop the index entry for a single object"""
+    kind = _kind_for(instance)
+    connection = ensure_search_index(using)
+    if kind is None or connection is None:
+        return
+    with connection.cursor() as cursor:
+        _delete(cursor, kind, [instance.pk])
+
+
+def index_objects(instances, using=None, new=False):
+    """
+    Add or replace the index entries for many objects of one model at once.
+
+    Pass new=True for objects that were just created: they cannot have old
+    entries, so there is nothing to delete first.
+    """
+    instances = list(instances)
+    if not instances:
+        return 0
+    kind = _kind_for(instances[0])
+    connection = ensure_search_index(using)
+    if kind is None or connection is None:
+        return 0
+    rows = [_row(kind, instance) for instance in instances]
+    with connection.cursor() as cursor:
+        if not new:
+            _delete(cursor, kind, [row[2] for row in rows])
+        _insert(cursor, rows)
+    return len(rows)
+
+
+def rebuild_search_index(batch_size=1000, using=None, stdout=None):
+    """Drop and repopulate the whole index, reading each model in pk batches"""
+    connection = _connection(using)
+    if connection is None:
+        return 0
+    # FTS5 merges its segments on every commit, which makes committing each batch
+    # a hundred times slower than writing the whole index in one transaction
+    with transaction.atomic(using=connection.alias):
+        return _rebuild_search_index(connection, batch_size, stdout)
+
+
+def _rebuild_search_index(connection, batch_size, stdout):
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+    _ready_aliases.discard(connection.alias)
+    ensure_search_index(connection.alias)
+
+    total = 0
+    for kind, (model, _) in SEARCH_SOURCES.items():
+        queryset = model.objects.using(connection.alias).order_by('pk')
+        last_pk = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            with connection.cursor() as cursor:
+                _insert(cursor, [_row(kind, instance) for instance in batch])
+            last_pk = batch[-1].pk
+            total += len(batch)
+            if stdout:
+                stdout.write(f"Indexed {total} rows ({kind} up to id {last_pk})")
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('optimize')")
+    return total
+
+
+def build_match_query(text):
+    """
+    Turn free text from the search box into a safe FTS5 MATCH expression.
+
+    Each word is quoted so FTS5 operators typed by the user are treated as
+    plain text, and gets a trailing * so partial tags like "23" match "2301".
+    """
+    words = re.findall(r'\w+', text)
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+class SearchResult:
+    """A single ranked search hit"""
+
+    def __init__(self, kind, object_id, sheep_id, rank, snippet):
+        self.kind = kind
+        self.object_id = object_id
+        self.sheep_id = sheep_id
+        self.rank = rank
+        self.snippet = snippet
+        self.object = None
+
+
+def search(text, page=1, per_page=25, using=None):
+    """
+    Return (results, has_next) for one page of hits, best matches first.
+
+    Title matches are weighted above body matches. The matched objects are
+    loaded with one query per kind rather than one query per hit.
+    """
+    match = build_match_query(text)
+    connection = ensure_search_index(using)
+    if not match or connection is None:
+        return [], False
+    offset = (page - 1) * per_page
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT kind, object_id, sheep_id, bm25({SEARCH_TABLE}, 0, 0, 0, 10.0, 1.0) AS rank, "
+            f"snippet({SEARCH_TABLE}, -1, '[', ']', '...', 12) "
+            f"FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s ORDER BY rank LIMIT %s OFFSET %s",
+            [match, per_page + 1, offset],
+        )
+        results = [SearchResult(*row) for row in cursor.fetchall()]
+    has_next = len(results) > per_page
+    results = results[:per_page]
+
+    for kind, (model, _) in SEARCH_SOURCES.items():
+        ids = [result.object_id for result in results if result.kind == kind]
+        if not ids:
+            continue
+        queryset = model.objects.using(connection.alias)
+        if kind != 'sheep':
+            queryset = queryset.select_related('sheep' if kind == 'health' else 'ewe')
+        objects = queryset.in_bulk(ids)
+        for result in results:
+            if result.kind == kind:
+                result.object = objects.get(result.object_id)
+    return [result for result in results if result.object is not None], has_next
@@ -0,0 +1,325 @@
+from django.db import router, transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_save, pre_delete, pre_save, post_delete, post_migrate
+from django.dispatch import receiver
+
+from .models import Breed, Sheep, SheepImage, HealthRecord, LambingRecord, BreedingRecord
+from . import dashboard, detail_cache, kinship, pedigree, response_cache, search, sync, tasks, thumbnails
+
+SEARCHABLE_MODELS = (Sheep, HealthRecord, LambingRecord, BreedingRecord)
+
+
+def update_search_index(sender, instance, using, raw=False, **kwargs):
+    """Keep the full-text index in step with saved objects"""
+    if raw:
+        return
+    search.index_object(instance, using=using)
+
+
+def remove_from_search_index(sender, instance, using, **kwargs):
+    """Drop deleted objects from the full-text index"""
+    search.remove_object(instance, using=using)
+
+
+for model in SEARCHABLE_MODELS:
+    post_save.connect(update_search_index, sender=model, dispatch_uid=f'search-save-{model.__name__}')
+    post_delete.connect(remove_from_search_index, sender=model, dispatch_uid=f'search-delete-{model.__name__}')
+
+
+@receiver(post_migrate)
+def create_search_index(sender, using, **kwargs):
+    """Create the FTS5 table alongside the regular tables"""
+    if sender.name == 'sheep':
+        search.ensure_search_index(using=using)
+
+
+# Sheep shown on the detail page of each kind of record
+DETAIL_CACHE_FIELDS = {
+    HealthRecord: ('sheep_id',),
+    LambingRecord: ('ewe_id',),
+    BreedingRecord: ('ewe_id', 'ram_id'),
+}
+
+
+def _related_sheep_ids(instance):
+    return [getattr(instance, field) for field in DETAIL_CACHE_FIELDS[type(instance)]]
+
+
+def _offspring_ids(sheep_id, using):
+    return list(
+        Sheep.objects.using(using).filter(Q(mother_id=sheep_id) | Q(father_id=sheep_id)).values_list('pk', flat=True)
+    )
+
+
+def _mate_ids(sheep_id, using):
+    breeding = BreedingRecord.objects.using(using).filter(Q(ewe_id=sheep_id) | Q(ram_id=sheep_id))
+    return [mate for pair in breeding.values_list('ewe_id', 'ram_id') for mate in pair if mate != sheep_id]
+
+
+# Runs before update_pedigree, which forgets the parents the sheep was loaded with
+@receiver(post_save, sender=Sheep, dispatch_uid='detail-cache-sheep-save')
+def invalidate_sheep_detail(sender, instance, using, raw=False, **kwargs):
+    """A sheep appears on its own page, its parents', its offspring's and its mates'"""
+    if raw or not detail_cache.enabled():
+        return
+    loaded_parents = getattr(instance, '_loaded_parents', (None, None))
+    detail_cache.invalidate(
+        instance.pk, instance.mother_id, instance.father_id, *loaded_parents,
+        *_offspring_ids(instance.pk, using), *_mate_ids(instance.pk, using),
+        using=using,
+    )
+
+
+@receiver(pre_delete, sender=Sheep, dispatch_uid='detail-cache-sheep-delete')
+def invalidate_deleted_sheep_detail(sender, instance, using, **kwargs):
+    if detail_cache.enabled():
+        detail_cache.invalidate(instance.pk, instance.mother_id, instance.father_id,
+                                *_offspring_ids(instance.pk, using), using=using)
+
+
+def remember_detail_sheep(sender, instance, using, raw=False, **kwargs):
+    """Note which sheep an edited record belonged to before it is reassigned"""
+    if raw or instance.pk is None or not detail_cache.enabled():
+        return
+    fields = DETAIL_CACHE_FIELDS[sender]
+    instance._detail_cache_sheep = sender.objects.using(using).filter(pk=instance.pk).values_list(*fields).first() or ()
+
+
+def invalidate_record_detail(sender, instance, using, raw=False, **kwargs):
+    if raw or not detail_cache.enabled():
+        return
+    detail_cache.invalidate(*_related_sheep_ids(instance), *getattr(instance, '_detail_cache_sheep', ()), using=using)
+
+
+for model in DETAIL_CACHE_FIELDS:
+    pre_save.connect(remember_detail_sheep, sender=model, dispatch_uid=f'detail-cache-pre-save-{model.__name__}')
+    post_save.connect(invalidate_record_detail, sender=model, dispatch_uid=f'detail-cache-save-{model.__name__}')
+    post_delete.connect(invalidate_record_detail, sender=model, dispatch_uid=f'detail-cache-delete-{model.__name__}')
+
+
+@receiver(post_save, sender=Breed, dispatch_uid='detail-cache-breed-save')
+def invalidate_breed_detail(sender, instance, using, raw=False, **kwargs):
+    """Renaming a breed changes the page of every sheep of that breed"""
+    if raw or not detail_cache.enabled():
+        return
+    detail_cache.invalidate(*instance.sheep.using(using).values_list('pk', flat=True), using=using)
+
+
+@receiver(post_save, sender=SheepImage, dispatch_uid='detail-cache-image-save')
+@receiver(pre_delete, sender=SheepImage, dispatch_uid='detail-cache-image-delete')
+def invalidate_image_detail(sender, instance, using, raw=False, **kwargs):
+    if raw or instance.pk is None or not detail_cache.enabled():
+        return
+    detail_cache.invalidate(*instance.sheep_additional.using(using).values_list('pk', flat=True), using=using)
+
+
+@receiver(m2m_changed, sender=Sheep.additional_images.through, dispatch_uid='detail-cache-images-changed')
+def invalidate_images_detail(sender, instance, action, reverse, pk_set, using, **kwargs):
+    """Images added to or removed from a sheep's gallery"""
+    if not detail_cache.enabled():
+        return
+    if action == 'pre_clear' and reverse:
+        # Afterwards there is no telling which sheep the image was taken from
+        detail_cache.invalidate(*instance.sheep_additional.using(using).values_list('pk', flat=True), using=using)
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        sheep_ids = (pk_set or ()) if reverse else (instance.pk,)
+        detail_cache.invalidate(*sheep_ids, using=using)
+
+
+# Models whose rows appear on pages cached by response_cache
+RESPONSE_CACHE_MODELS = (Breed, Sheep, BreedingRecord, LambingRecord, HealthRecord)
+
+
+def invalidate_response_cache(sender, using, **kwargs):
+    """Any saved or deleted row makes every cached page showing its model stale"""
+    if response_cache.enabled():
+        response_cache.invalidate(sender, using=using)
+
+
+for model in RESPONSE_CACHE_MODELS:
+    post_save.connect(invalidate_response_cache, sender=model, dispatch_uid=f'response-cache-save-{model.__name__}')
+    post_delete.connect(invalidate_response_cache, sender=model, dispatch_uid=f'response-cache-delete-{model.__name__}')
+
+
+def record_sync_change(sender, instance, using, raw=False, **kwargs):
+    """Give a saved row a new version in the offline change feed"""
+    if raw:
+        return
+    sync.mark_changed(sender, [instance.pk], using=using)
+
+
+def record_sync_tombstone(sender, instance, using, **kwargs):
+    sync.mark_changed(sender, [instance.pk], deleted=True, using=using)
+
+
+for model in sync.KINDS:
+    post_save.connect(record_sync_change, sender=model, dispatch_uid=f'sync-save-{model.__name__}')
+    post_delete.connect(record_sync_tombstone, sender=model, dispatch_uid=f'sync-delete-{model.__name__}')
+
+
+@receiver(post_save, sender=SheepImage, dispatch_uid='sync-image-save')
+@receiver(pre_delete, sender=SheepImage, dispatch_uid='sync-image-delete')
+def record_sync_image_change(sender, instance, using, raw=False, **kwargs):
+    """A sheep's gallery shows on its page, so a changed photo is a change to the sheep"""
+    if raw or instance.pk is None:
+        return
+    sync.mark_changed(Sheep, list(instance.sheep_additional.using(using).values_list('pk', flat=True)), using=using)
+
+
+@receiver(m2m_changed, sender=Sheep.additional_images.through, dispatch_uid='sync-images-changed')
+def record_sync_gallery_change(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if action == 'pre_clear' and reverse:
+        sheep_ids = instance.sheep_additional.using(using).values_list('pk', flat=True)
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        sheep_ids = (pk_set or ()) if reverse else (instance.pk,)
+    else:
+        return
+    sync.mark_changed(Sheep, list(sheep_ids), using=using)
+
+
+def remember_dashboard_counts(sender, instance, using, **kwargs):
+    dashboard.remember(instance, using=using)
+
+
+def update_dashboard_counts(sender, instance, using, **kwargs):
+    """Move a saved row's dashboard counts from its old values to its new ones"""
+    dashboard.saved(instance, using=using)
+
+
+def remove_dashboard_counts(sender, instance, using, **kwargs):
+    dashboard.deleted(instance, using=using)
+
+
+for model in dashboard.COUNTERS:
+    pre_save.connect(remember_dashboard_counts, sender=model, dispatch_uid=f'dashboard-pre-save-{model.__name__}')
+    post_save.connect(update_dashboard_counts, sender=model, dispatch_uid=f'dashboard-save-{model.__name__}')
+    post_delete.connect(remove_dashboard_counts, sender=model, dispatch_uid=f'dashboard-delete-{model.__name__}')
+
+
+@receiver(post_save, sender=Sheep, dispatch_uid='pedigree-save')
+def update_pedigree(sender, instance, created, using, raw=False, **kwargs):
+    """Refresh the ancestor closure when a sheep's parents change"""
+    if raw:
+        return
+    # A brand-new sheep without parents has no ancestors and no descendants yet
+    if instance.parents_changed and not (created and instance.mother_id is None and instance.father_id is None):
+        pedigree.rebuild_closure_for(instance, using=using)
+        kinship.invalidate()
+    instance._loaded_parents = (instance.mother_id, instance.father_id)
+
+
+@receiver(pre_delete, sender=Sheep, dispatch_uid='pedigree-pre-delete')
+def remember_descendants(sender, instance, using, **kwargs):
+    """Note who descends from a sheep before its closure rows cascade away"""
+    instance._pedigree_descendants = pedigree.descendant_ids(instance.pk, using=using)
+
+
+@receiver(post_delete, sender=Sheep, dispatch_uid='pedigree-delete')
+def update_pedigree_after_delete(sender, instance, using, **kwargs):
+    """Descendants lose every ancestor reached through a deleted sheep"""
+    descendants = getattr(instance, '_pedigree_descendants', None)
+    if descendants:
+        pedigree.rebuild_closure(descendants, using=using)
+    kinship.invalidate()
+
+
+def create_thumbnails(sender, instance, using, raw=False, **kwargs):
+    """Queue the resizing of newly uploaded photos so pages never have to serve the original"""
+    if raw:
+        return
+    for model, field_name in thumbnails.IMAGE_FIELDS:
+        if model is not sender:
+            continue
+        field_file = getattr(instance, field_name)
+        if not field_file or thumbnails.has_derivatives(field_file):
+            continue
+        # Pages fall back to the original until the task worker has resized it
+        tasks.enqueue('thumbnails', {'name': field_file.name}, unique=True, using=using)
+
+
+def _image_fields(model):
+    return [field_name for image_model, field_name in thumbnails.IMAGE_FIELDS if image_model is model]
+
+
+def _delete_thumbnails_on_commit(storage, name, using):
+    # A rolled-back save or delete still shows the photo
+    transaction.on_commit(lambda: thumbnails.delete_derivatives(storage, name), using=using)
+
+
+def remember_images(sender, instance, using, raw=False, **kwargs):
+    """Note the photos a row held before it is saved, so replaced ones can lose their resized copies"""
+    if raw or instance.pk is None:
+        return
+    stored = sender.objects.using(using).filter(pk=instance.pk).values(*_image_fields(sender)).first() or {}
+    instance._stored_images = stored
+
+
+def delete_replaced_thumbnails(sender, instance, using, raw=False, **kwargs):
+    if raw:
+        return
+    for field_name, name in getattr(instance, '_stored_images', {}).items():
+        field_file = getattr(instance, field_name)
+        if name and name != field_file.name:
+            _delete_thumbnails_on_commit(field_file.storage, name, using)
+
+
+def delete_thumbnails(sender, instance, using, **kwargs):
+    """Resized copies of a deleted row's photos are of no further use"""
+    for field_name in _image_fields(sender):
+        field_file = getattr(instance, field_name)
+        if field_file:
+            _delete_thumbnails_on_commit(field_file.storage, field_file.name, using)
+
+
+for model in dict(thumbnails.IMAGE_FIELDS):
+    pre_save.connect(remember_images, sender=model, dispatch_uid=f'thumbnails-pre-save-{model.__name__}')
+    post_save.connect(create_thumbnails, sender=model, dispatch_uid=f'thumbnails-{model.__name__}')
+    post_save.connect(delete_replaced_thumbnails, sender=model, dispatch_uid=f'thumbnails-replaced-{model.__name__}')
+    post_delete.connect(delete_thumbnails, sender=model, dispatch_uid=f'thumbnails-delete-{model.__name__}')
+
+
+def drop_cached_pages(models, sheep_ids=(), using=None):
+    """Re-render, once the transaction commits, the cached pages showing the models and these sheep"""
+    if detail_cache.enabled():
+        detail_cache.invalidate(*sheep_ids, using=using)
+    if response_cache.enabled():
+        response_cache.invalidate(*models, using=using)
+
+
+def _bulk_detail_sheep_ids(model, instances, using):
+    """The sheep whose detail pages show the written rows, as the detail-cache receivers above pick them"""
+    if model is Sheep:
+        sheep_ids = [instance.pk for instance in instances]
+        offspring = Sheep.objects.using(using).filter(Q(mother_id__in=sheep_ids) | Q(father_id__in=sheep_ids))
+        mates = BreedingRecord.objects.using(using).filter(Q(ewe_id__in=sheep_ids) | Q(ram_id__in=sheep_ids))
+        parents = [parent_id for instance in instances for parent_id in (instance.mother_id, instance.father_id)]
+        mate_ids = [pk for pair in mates.values_list('ewe_id', 'ram_id') for pk in pair]
+        return [*sheep_ids, *parents, *offspring.values_list('pk', flat=True), *mate_ids]
+    if model in DETAIL_CACHE_FIELDS:
+        return [sheep_id for instance in instances for sheep_id in _related_sheep_ids(instance)]
+    return []
+
+
+def after_bulk_write(model, instances, using=None, created=True):
+    """
+    Do for rows written with bulk_create(), update() or raw SQL what the
+    receivers above do for each saved row, since none of those send signals.
+
+    instances are the rows written, with at least their pk and the fields
+    linking them to sheep. New rows are added to the search index and the
+    dashboard counts; for changed rows both are left to the caller, which
+    alone knows what the rows held before. Every row gets a new version in
+    the change feed, and the cached pages showing them are dropped once the
+    transaction commits. Call it in the transaction that wrote the rows.
+    """
+    instances = list(instances)
+    if not instances:
+        return
+    using = using or router.db_for_write(model)
+    if created:
+        dashboard.apply(dashboard.total_contributions(instances), using=using)
+        if model in SEARCHABLE_MODELS:
+            search.index_objects(instances, using=using, new=True)
+    sync.mark_changed(model, [instance.pk for instance in instances], using=using)
+    sheep_ids = _bulk_detail_sheep_ids(model, instances, using) if detail_cache.enabled() else ()
+    drop_cached_pages([model], sheep_ids, using=using)
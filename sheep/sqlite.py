@@ -0,0 +1,56 @@
+"""
+Retries of SQLite statements that find the database locked.
+
+SQLite lets one connection write at a time. The production settings
+start every transaction with BEGIN IMMEDIATE, so a save takes the write
+lock before it reads anything and waits up to busy_timeout for another
+save to finish. It never fails halfway through, when it tries to turn a
+read into a write that another save got to first.
+
+A wait can still run out when many saves queue up at once, as they do
+in lambing season. retry_locked() then tries the statement again a few
+times, SHEEP_SQLITE_LOCK_RETRIES in all, waiting a little longer each
+time, before 'database is locked' reaches the user. Only statements run
+outside a transaction are retried, including the BEGIN that opens one:
+they have changed nothing yet when they fail. A statement that fails
+inside a transaction fails the whole transaction, as usual.
+"""
+import random
+import time
+
+from django.conf import settings
+from django.db import OperationalError
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Seconds before the first retry; each later one waits twice as long, give or take a half
+BACKOFF = 0.05
+
+
+def lock_retries():
+    return getattr(settings, 'SHEEP_SQLITE_LOCK_RETRIES', 3)
+
+
+def is_locked(error):
+    return 'database is locked' in str(error) or 'database table is locked' in str(error)
+
+
+def retry_locked(execute, sql, params, many, context):
+    """Execute wrapper that runs a statement again when it finds the database locked"""
+    if context['connection'].in_atomic_block:
+        return execute(sql, params, many, context)
+    retries = lock_retries()
+    for attempt in range(retries + 1):
+        try:
+            return execute(sql, params, many, context)
+        except OperationalError as error:
+            if attempt == retries or not is_locked(error):
+                raise
+            time.sleep(BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+@receiver(connection_created, dispatch_uid='sqlite-retry-locked')
+def install_retry(sender, connection, **kwargs):
+    # First in the list, so wrappers added for the length of a request are still removed last-in first-out
+    if connection.vendor == 'sqlite' and retry_locked not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, retry_locked)
@@ -0,0 +1,208 @@
+"""
+Change feed and batched uploads for devices that keep an offline copy.
+
+Every save or delete of a row the API shows is noted in SyncChange by
+the signals in signals.py. Each object has one entry, and a later change
+replaces it with a new entry under a higher id. That id is the object's
+version, and the highest id a device has seen is its cursor, so
+changes(since) returns exactly the rows created, updated or deleted
+after it. SQLite lets one transaction write at a time, so ids become
+visible in the order they were handed out and a cursor never skips a
+change that commits late.
+
+apply() saves a batch of edits made offline through the same forms as
+the site, in one transaction. An edit to an existing row names the
+version it was made against. If the row has changed on the server since,
+nothing in the batch is saved and the conflict is reported together
+with the row as it is now, for the device to merge.
+"""
+from django.db import DatabaseError, router, transaction
+from django.forms.models import model_to_dict
+from django.utils import timezone
+
+from . import api
+from .models import SyncChange
+
+# Entries written at a time
+BATCH_SIZE = 500
+
+# model -> kind, which is the name of the model's api.Resource
+KINDS = {resource.model: name for name, resource in api.RESOURCES.items()}
+
+
+def mark_changed(model, ids, deleted=False, using=None):
+    """Give each object a new version; returns {object id: version}"""
+    kind = KINDS[model]
+    ids = [object_id for object_id in ids if object_id is not None]
+    using = using or router.db_for_write(SyncChange)
+    changes = SyncChange.objects.using(using)
+    now = timezone.now()
+    versions = {}
+    with transaction.atomic(using=using):
+        for start in range(0, len(ids), BATCH_SIZE):
+            batch = ids[start:start + BATCH_SIZE]
+            changes.filter(kind=kind, object_id__in=batch).delete()
+            created = changes.bulk_create([
+                SyncChange(kind=kind, object_id=object_id, deleted=deleted, changed_at=now) for object_id in batch
+            ])
+            versions.update((change.object_id, change.pk) for change in created)
+    return versions
+
+
+def version(model, object_id, using=None):
+    """Current version of an object, or None if it has none"""
+    return (SyncChange.objects.using(using or router.db_for_read(SyncChange))
+            .filter(kind=KINDS[model], object_id=object_id).values_list('pk', flat=True).first())
+
+
+def rebuild(using=None):
+    """
+    Bring the entries in line with the tables after writes that skipped signals.
+
+    Rows without an entry get one and entries of rows that no longer exist
+    become tombstones. Returns the number of entries written.
+    """
+    using = using or router.db_for_write(SyncChange)
+    written = 0
+    with transaction.atomic(using=using):
+        for model, kind in KINDS.items():
+            logged = set(SyncChange.objects.using(using).filter(kind=kind, deleted=False)
+                         .values_list('object_id', flat=True))
+            existing = set(model.objects.using(using).values_list('pk', flat=True))
+            written += len(mark_changed(model, sorted(existing - logged), using=using))
+            written += len(mark_changed(model, sorted(logged - existing), deleted=True, using=using))
+    return written
+
+
+def changes(since=0, limit=api.DEFAULT_LIMIT, using=None):
+    """
+    Up to limit changes after the cursor since.
+
+    Changed rows come with every API field and their version; deleted rows
+    as tombstones of just id and version. Pass the returned cursor as since
+    to get the next changes; more says whether there are any yet.
+    """
+    using = using or router.db_for_read(SyncChange)
+    # One read transaction, so the rows are as they were when their entries were read
+    with transaction.atomic(using=using):
+        entries = list(SyncChange.objects.using(using).filter(pk__gt=since).order_by('pk')
+                       .values_list('pk', 'kind', 'object_id', 'deleted')[:limit + 1])
+        more = len(entries) > limit
+        entries = entries[:limit]
+        changed, deleted = {}, {}
+        for pk, kind, object_id, is_deleted in entries:
+            if is_deleted:
+                deleted.setdefault(kind, []).append({'id': object_id, 'version': pk})
+            else:
+                changed.setdefault(kind, {})[object_id] = pk
+        rows = {}
+        for kind, versions in changed.items():
+            resource = api.RESOURCES[kind]
+            queryset = resource.model.objects.using(using).filter(pk__in=versions).order_by('pk')
+            rows[kind] = api.serialize(resource, queryset, list(resource.fields))
+            for row in rows[kind]:
+                row['version'] = versions[row['id']]
+    return {
+        'cursor': entries[-1][0] if entries else since,
+        'more': more,
+        'changed': rows,
+        'deleted': deleted,
+    }
+
+
+class EditError(Exception):
+    """An edit that cannot be saved; status is 'conflict' or 'invalid'"""
+
+    def __init__(self, status, message, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+
+def _resolve_refs(fields, created):
+    """Replace {"ref": ...} values with the id of the row an earlier edit in the batch created"""
+    resolved = {}
+    for name, value in fields.items():
+        if isinstance(value, dict) and set(value) == {'ref'}:
+            if value['ref'] not in created:
+                raise EditError('invalid', f"{name}: no earlier edit in this batch created ref {value['ref']!r}")
+            value = created[value['ref']]
+        resolved[name] = value
+    return resolved
+
+
+def _apply_edit(edit, forms, created, using):
+    """Save one edit; returns the result reported for it"""
+    if not isinstance(edit, dict) or edit.get('kind') not in forms:
+        raise EditError('invalid', f"kind must be one of: {', '.join(forms)}")
+    kind = edit['kind']
+    form_class = forms[kind]
+    model = form_class._meta.model
+    fields = edit.get('fields') or {}
+    if not isinstance(fields, dict):
+        raise EditError('invalid', "fields must be an object")
+    editable = [name for name in form_class._meta.fields
+                if not getattr(model._meta.get_field(name), 'upload_to', None)]
+    unknown = [name for name in fields if name not in editable]
+    if unknown:
+        raise EditError('invalid', f"Cannot edit: {', '.join(unknown)}. Choose from: {', '.join(editable)}")
+    fields = _resolve_refs(fields, created)
+
+    instance = None
+    if edit.get('id') is not None:
+        instance = model.objects.using(using).filter(pk=edit['id']).first()
+        current = version(model, edit['id'], using=using)
+        if instance is None or current != edit.get('version'):
+            row = None
+            if instance is not None:
+                row = api.serialize(api.RESOURCES[kind], model.objects.using(using).filter(pk=instance.pk),
+                                    list(api.RESOURCES[kind].fields))[0]
+                row['version'] = current
+            raise EditError('conflict', "Changed on the server since this edit was made", current=row)
+        if edit.get('delete'):
+            instance.delete(using=using)
+            return {'status': 'ok', 'kind': kind, 'id': edit['id'], 'version': version(model, edit['id'], using=using)}
+        # Fields the edit leaves out keep their current values
+        data = model_to_dict(instance, fields=editable)
+        data.update(fields)
+    else:
+        data = fields
+
+    form = form_class(data, instance=instance)
+    if not form.is_valid():
+        raise EditError('invalid', "Invalid fields", errors=form.errors.get_json_data())
+    saved = form.save()
+    if edit.get('ref') is not None:
+        created[edit['ref']] = saved.pk
+    return {'status': 'ok', 'kind': kind, 'id': saved.pk, 'version': version(model, saved.pk, using=using)}
+
+
+def apply(edits, forms, using=None):
+    """
+    Save a batch of offline edits in one transaction, or none of them.
+
+    forms maps each kind to the ModelForm that validates and saves it.
+    Returns (saved, one result per edit). When anything fails, every edit
+    is rolled back and the ones that would have saved are marked 'valid'.
+    """
+    using = using or router.db_for_write(SyncChange)
+    created = {}
+    results = []
+    with transaction.atomic(using=using):
+        for index, edit in enumerate(edits):
+            try:
+                # A savepoint per edit, so a failed one leaves the transaction usable for the rest
+                with transaction.atomic(using=using):
+                    result = _apply_edit(edit, forms, created, using)
+            except EditError as error:
+                result = {'status': error.status, 'message': str(error), **error.details}
+            except DatabaseError as error:
+                result = {'status': 'invalid', 'message': str(error)}
+            results.append({'index': index, 'ref': edit.get('ref') if isinstance(edit, dict) else None, **result})
+        saved = all(result['status'] == 'ok' for result in results)
+        if not saved:
+            transaction.set_rollback(True, using=using)
+            for result, edit in zip(results, edits):
+                if result['status'] == 'ok':
+                    result.update(status='valid', id=edit.get('id'), version=None)
+    return saved, results
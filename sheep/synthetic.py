@@ -0,0 +1,364 @@
+"""
+Synthetic flocks for trying the app out at realistic sizes.
+
+generate() starts a breeding flock and runs it forward one season at a
+time. Each autumn the active ewes go to the rams. About 147 days later
+most of them lamb. Enough lambs are kept to replace the ewes and rams
+that leave, and the rest of the crop is sold at weaning. Every lamb born
+alive becomes a sheep with its mother, father and birth record, so
+lineage runs many generations deep. Each sheep then gets routine health
+records for the years it spent in the flock.
+
+Rows go in with bulk_create, which skips model signals, so the pedigree
+closure, search index, dashboard counts, productivity figures and
+offline change feed are rebuilt from scratch at the end.
+"""
+import datetime
+import math
+import random
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import router, transaction
+from django.utils import timezone
+from PIL import Image, ImageDraw
+
+from . import dashboard, kinship, pedigree, productivity, search, signals, sync
+from .models import (
+    Breed, Sheep, BreedingRecord, LambingRecord, HealthRecord, sheep_image_path,
+)
+
+BREEDS = ('Dorper', 'Katahdin', 'St Croix', 'Suffolk', 'Romney')
+COLORS = ('White', 'White', 'White', 'Black', 'Brown', 'Spotted')
+EWE_NAMES = ('Daisy', 'Clover', 'Bella', 'Maple', 'Hazel', 'Willow', 'Poppy', 'Rosie', 'Ivy', 'Luna')
+RAM_NAMES = ('Duke', 'Samson', 'Bruno', 'Atlas', 'Moose', 'Boris', 'Chief', 'Rocky')
+
+# Ewes put to each ram
+EWES_PER_RAM = 30
+
+# Rams go in on BREEDING_START plus up to two weeks and come out after the exposure period
+BREEDING_START = (10, 1)
+EXPOSURE_DAYS = productivity.DEFAULT_EXPOSURE_DAYS
+GESTATION_DAYS = 147
+
+# Share of exposed ewes that lamb, and the chance of each litter size
+CONCEPTION_RATE = 0.9
+LITTER_SIZES = ((1, 0.4), (2, 0.5), (3, 0.1))
+LAMB_LOSS_RATE = 0.08
+ASSISTED_RATE = 0.1
+
+# Years a kept ewe or ram stays in the flock after her first lambing season
+PRODUCTIVE_YEARS = (3, 8)
+WEANING_DAYS = 120
+
+# Lambs alive per lambing on average, for sizing the starting flock
+LAMBS_PER_LAMBING = sum(size * chance for size, chance in LITTER_SIZES) * (1 - LAMB_LOSS_RATE)
+
+ROUTINE_TREATMENTS = {
+    'VACCINATION': ('CDT', '2 ml'),
+    'PARASITE_TREATMENT': ('Ivermectin drench', '10 ml'),
+    'HOOF_TRIM': ('', ''),
+    'SHEARING': ('', ''),
+}
+AILMENTS = {
+    'ILLNESS': ('Pneumonia', 'Oxytetracycline', '6 ml'),
+    'INJURY': ('Lameness', 'Penicillin', '5 ml'),
+    'MEDICATION': ('Scours', 'Electrolytes', '60 ml'),
+}
+
+PLACEHOLDER_SIZE = (800, 600)
+
+
+class GenerationReport:
+    """Counts of what generate() created"""
+
+    def __init__(self):
+        self.seasons = 0
+        self.sheep = 0
+        self.breeding_records = 0
+        self.lambing_records = 0
+        self.health_records = 0
+        self.images = 0
+
+    def __str__(self):
+        return (
+            f"{self.sheep} sheep over {self.seasons} seasons, {self.breeding_records} breeding records, "
+            f"{self.lambing_records} lambing records, {self.health_records} health records "
+            f"and {self.images} images"
+        )
+
+
+class FlockGenerator:
+    def __init__(self, sheep=10000, years=10, health_per_year=2.0, images=0, seed=None,
+                 batch_size=2000, using=None, today=None):
+        self.target = sheep
+        self.years = years
+        self.health_per_year = health_per_year
+        self.images = images
+        self.random = random.Random(seed)
+        self.batch_size = batch_size
+        self.using = using or router.db_for_write(Sheep)
+        self.today = today or timezone.localdate()
+        self.report = GenerationReport()
+        self.tag_counter = 0
+        self.breed_ids = []
+        # id -> (gender, breed id, date of birth, date joined, date removed or None) of every sheep created
+        self.members = {}
+
+    def run(self, rebuild=True, stdout=None):
+        with transaction.atomic(using=self.using):
+            self.breed_ids = [
+                Breed.objects.using(self.using).get_or_create(name=name)[0].pk for name in BREEDS
+            ]
+            first_season = self.today.year - self.years
+            self._add_founders(first_season)
+            for season in range(first_season, self.today.year + 1):
+                if self.report.sheep >= self.target:
+                    break
+                self._run_season(season)
+                self.report.seasons += 1
+            self._add_health_records()
+            if self.images:
+                self._add_images()
+            if rebuild:
+                self._rebuild(stdout)
+        return self.report
+
+    def _tag(self, year):
+        self.tag_counter += 1
+        return f"{year % 100:02d}-{self.tag_counter:06d}"
+
+    def _departure(self, first_season):
+        """(date removed, status) for a kept sheep; no date while it is still in the flock"""
+        days = 365 * self.random.randint(*PRODUCTIVE_YEARS) + self.random.randint(0, 200)
+        removed = first_season + datetime.timedelta(days=days)
+        if removed > self.today:
+            return None, 'ACTIVE'
+        return removed, self.random.choices(('CULLED', 'SOLD', 'DECEASED'), (5, 3, 2))[0]
+
+    def _sheep(self, gender, born, breed_id, joined=None, kept=True, **fields):
+        """An unsaved Sheep whose final status is already decided"""
+        if kept:
+            removed, status = self._departure(max(joined or born, born + datetime.timedelta(days=365)))
+        else:
+            removed = born + datetime.timedelta(days=WEANING_DAYS + self.random.randint(0, 60))
+            removed, status = (None, 'ACTIVE') if removed > self.today else (removed, 'SOLD')
+        stamp = timezone.make_aware(datetime.datetime.combine(removed or joined or born, datetime.time(12)))
+        cull_candidate = kept and status == 'ACTIVE' and self.random.random() < 0.05
+        if kept:
+            fields.setdefault('name', self.random.choice(EWE_NAMES if gender == 'F' else RAM_NAMES))
+            weight = self.random.uniform(*((110, 220) if gender == 'M' else (100, 170)))
+            fields['weight_current'] = round(weight, 1)
+        return Sheep(
+            tag_number=self._tag(born.year),
+            gender=gender,
+            date_of_birth=born,
+            breed_id=breed_id,
+            weight_birth=round(self.random.uniform(6, 14), 1),
+            color=self.random.choice(COLORS),
+            status=status,
+            date_acquired=joined,
+            date_removed=removed,
+            removal_reason={'SOLD': 'Sold', 'CULLED': 'Age and condition', 'DECEASED': 'Died'}.get(status, ''),
+            cull_candidate=cull_candidate,
+            cull_reason='Poor mothering' if cull_candidate else '',
+            cull_date=removed if status == 'CULLED' else None,
+            created_at=stamp,
+            updated_at=stamp,
+            **fields,
+        )
+
+    def _save_sheep(self, sheep):
+        for animal in Sheep.objects.using(self.using).bulk_create(sheep, batch_size=self.batch_size):
+            self.members[animal.pk] = (
+                animal.gender, animal.breed_id, animal.date_of_birth,
+                animal.date_acquired or animal.date_of_birth, animal.date_removed,
+            )
+        self.report.sheep += len(sheep)
+
+    def _add_founders(self, first_season):
+        """The bought-in starting flock, sized so the seasons that follow reach the target"""
+        # The last season's lambs are not born yet. Sized a little large, so that stopping
+        # at the target rather than running out of seasons decides the final count.
+        seasons = max(1, self.years - 1)
+        ewes = max(2, math.ceil(1.05 * self.target / (1 + seasons * CONCEPTION_RATE * LAMBS_PER_LAMBING)))
+        rams = max(1, ewes // EWES_PER_RAM)
+        joined = datetime.date(first_season, 8, 1)
+        founders = []
+        for gender, count in (('F', ewes), ('M', rams)):
+            for _ in range(count):
+                born = joined - datetime.timedelta(days=self.random.randint(365, 365 * 4))
+                founders.append(self._sheep(gender, born, self.random.choice(self.breed_ids), joined=joined))
+        self._save_sheep(founders[:self.target])
+
+    def _present(self, gender, day, min_age_days):
+        """Ids of sheep of one gender in the flock on a day and at least min_age_days old"""
+        return [
+            sheep_id for sheep_id, (sex, _, born, joined, removed) in self.members.items()
+            if sex == gender and joined <= day and (removed is None or removed > day)
+            and (day - born).days >= min_age_days
+        ]
+
+    def _run_season(self, season):
+        start = datetime.date(season, *BREEDING_START) + datetime.timedelta(days=self.random.randint(0, 14))
+        ewes = self._present('F', start, 365)
+        rams = self._present('M', start, 240)
+        if start > self.today or not ewes or not rams:
+            return
+        end = start + datetime.timedelta(days=EXPOSURE_DAYS)
+
+        breedings, litters = [], []
+        for ewe_id in ewes:
+            ram_id = self.random.choice(rams)
+            lambing_date = None
+            if self.random.random() < 0.02:
+                status = 'CANCELLED'
+            elif end > self.today:
+                status = 'IN_PROGRESS'
+            elif self.random.random() < CONCEPTION_RATE:
+                status = 'SUCCESSFUL'
+                # Settled on the first or second heat
+                conceived = self.random.choice((0, 17)) + self.random.randint(0, 16)
+                lambing_date = start + datetime.timedelta(
+                    days=conceived + GESTATION_DAYS + self.random.randint(-3, 3)
+                )
+            else:
+                status = 'UNSUCCESSFUL'
+            breedings.append(BreedingRecord(
+                ewe_id=ewe_id, ram_id=ram_id, date_started=start,
+                date_ended=end if end <= self.today else None,
+                expected_lambing_date=start + datetime.timedelta(days=GESTATION_DAYS),
+                status=status,
+            ))
+            if lambing_date and lambing_date <= self.today:
+                litters.append((ewe_id, ram_id, lambing_date))
+        BreedingRecord.objects.using(self.using).bulk_create(breedings, batch_size=self.batch_size)
+        self.report.breeding_records += len(breedings)
+
+        # Lambings stop once their lambs would take the flock past the target
+        sizes, weights = zip(*LITTER_SIZES)
+        budget = self.target - self.report.sheep
+        lambings, sires = [], {}
+        for ewe_id, ram_id, date in sorted(litters, key=lambda litter: litter[2]):
+            total = self.random.choices(sizes, weights)[0]
+            dead = sum(self.random.random() < LAMB_LOSS_RATE for _ in range(total))
+            if total - dead > budget:
+                break
+            budget -= total - dead
+            assisted = self.random.random() < ASSISTED_RATE
+            lambings.append(LambingRecord(
+                ewe_id=ewe_id, date=date, total_born=total, born_alive=total - dead, born_dead=dead,
+                assisted=assisted, complications='Malpresentation' if assisted else '',
+            ))
+            sires[ewe_id] = ram_id
+        LambingRecord.objects.using(self.using).bulk_create(lambings, batch_size=self.batch_size)
+        self.report.lambing_records += len(lambings)
+
+        # Enough of the crop is kept to replace the ewes and rams leaving before next season
+        next_start = datetime.date(season + 1, *BREEDING_START)
+        replacements = {
+            gender: sum(1 for sheep_id in present if (self.members[sheep_id][4] or next_start) < next_start)
+            for gender, present in (('F', ewes), ('M', rams))
+        }
+        crop = [(lambing, self.random.choice('MF')) for lambing in lambings for _ in range(lambing.born_alive)]
+        kept = set()
+        for gender in replacements:
+            candidates = [index for index, (_, sex) in enumerate(crop) if sex == gender]
+            kept.update(self.random.sample(candidates, min(replacements[gender], len(candidates))))
+        lambs = []
+        for index, (lambing, gender) in enumerate(crop):
+            lambs.append(self._sheep(
+                gender, lambing.date, self.members[lambing.ewe_id][1], kept=index in kept,
+                mother_id=lambing.ewe_id, father_id=sires[lambing.ewe_id], birth_record_id=lambing.pk,
+            ))
+        self._save_sheep(lambs)
+
+    def _health_record(self, sheep_id, date):
+        """One routine treatment or, less often, an ailment needing a follow-up"""
+        if self.random.random() < 0.8:
+            record_type = self.random.choice(list(ROUTINE_TREATMENTS))
+            treatment, dosage = ROUTINE_TREATMENTS[record_type]
+            return HealthRecord(
+                sheep_id=sheep_id, date=date, record_type=record_type, treatment=treatment,
+                dosage=dosage, administered_by='Owner',
+            )
+        record_type = self.random.choice(list(AILMENTS))
+        condition, treatment, dosage = AILMENTS[record_type]
+        followup_date = date + datetime.timedelta(days=14) if self.random.random() < 0.5 else None
+        return HealthRecord(
+            sheep_id=sheep_id, date=date, record_type=record_type, treatment=treatment,
+            dosage=dosage, administered_by=self.random.choice(('Owner', 'Vet')),
+            # Follow-ups that have come and gone were done
+            requires_followup=followup_date is not None and followup_date >= self.today,
+            followup_date=followup_date,
+            notes=condition,
+        )
+
+    def _add_health_records(self):
+        """About health_per_year records per sheep for each year it was in the flock"""
+        batch = []
+        for sheep_id, (_, _, _, joined, removed) in self.members.items():
+            present_days = ((removed or self.today) - joined).days
+            if present_days <= 0:
+                continue
+            expected = self.health_per_year * present_days / 365
+            count = int(expected) + (self.random.random() < expected % 1)
+            for _ in range(count):
+                date = joined + datetime.timedelta(days=self.random.randrange(present_days))
+                batch.append(self._health_record(sheep_id, date))
+            if len(batch) >= self.batch_size:
+                self._save_health_records(batch)
+                batch = []
+        self._save_health_records(batch)
+
+    def _save_health_records(self, records):
+        HealthRecord.objects.using(self.using).bulk_create(records, batch_size=self.batch_size)
+        self.report.health_records += len(records)
+
+    def _add_images(self):
+        """Give randomly chosen sheep a placeholder photo showing their tag"""
+        chosen = self.random.sample(sorted(self.members), min(self.images, len(self.members)))
+        tags = dict(Sheep.objects.using(self.using).filter(pk__in=chosen).values_list('pk', 'tag_number'))
+        updates = []
+        for sheep_id in chosen:
+            image = Image.new('RGB', PLACEHOLDER_SIZE, tuple(self.random.randint(60, 200) for _ in range(3)))
+            ImageDraw.Draw(image).text((40, 40), tags[sheep_id], fill='white')
+            buffer = BytesIO()
+            image.save(buffer, 'JPEG', quality=80)
+            name = default_storage.save(sheep_image_path(None, 'placeholder.jpg'), ContentFile(buffer.getvalue()))
+            updates.append(Sheep(pk=sheep_id, primary_image=name))
+        Sheep.objects.using(self.using).bulk_update(updates, ['primary_image'], batch_size=self.batch_size)
+        self.report.images = len(updates)
+
+    def _rebuild(self, stdout=None):
+        """
+        Do what the skipped post_save signals would have done.
+
+        Every row is new, so the stores are rebuilt whole rather than fed
+        batch by batch through signals.after_bulk_write().
+        """
+        steps = (
+            ('pedigree closure', lambda: pedigree.rebuild_closure(using=self.using)),
+            ('search index', lambda: search.rebuild_search_index(using=self.using)),
+            ('dashboard counts', lambda: dashboard.rebuild(using=self.using)),
+            ('productivity figures', lambda: productivity.refresh(using=self.using)),
+            ('offline change feed', lambda: sync.rebuild(using=self.using)),
+        )
+        for label, step in steps:
+            if stdout:
+                stdout.write(f"Rebuilding the {label}")
+            step()
+        kinship.invalidate()
+        signals.drop_cached_pages([Breed, Sheep, BreedingRecord, LambingRecord, HealthRecord], self.members,
+                                  using=self.using)
+
+
+def generate(sheep=10000, years=10, health_per_year=2.0, images=0, seed=None, rebuild=True,
+             batch_size=2000, using=None, stdout=None):
+    """Create a synthetic flock; returns a GenerationReport"""
+    generator = FlockGenerator(
+        sheep=sheep, years=years, health_per_year=health_per_year, images=images,
+        seed=seed, batch_size=batch_size, using=using,
+    )
+    return generator.run(rebuild=rebuild, stdout=stdout)
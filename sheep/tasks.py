@@ -0,0 +1,362 @@
+"""
+Background tasks kept in the database and run by the run_tasks command.
+
+Work too slow for a request (resizing photos, building exports,
+recalculating productivity, backups) is queued with enqueue() as a Task
+row, in the same database and transaction as the save that asks for it.
+run_tasks starts a few worker processes. Each one claims the queued task
+with the highest priority whose time has come, runs the function
+registered under its name and stores the result, so no broker is needed.
+
+A task function takes a Progress as its first argument, to report how
+far it has got; the task page polls those figures. A task that raises is
+queued again after RETRY_DELAY seconds, doubled on each further attempt,
+until it has used its max_attempts. A task whose worker died while
+running it is treated the same once its heartbeat is older than
+SHEEP_TASK_TIMEOUT seconds, or as soon as a worker on the same machine
+sees that the process is gone.
+
+With SHEEP_TASKS_EAGER on, enqueue() runs the task before returning,
+which suits tests and a development server without a worker.
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connections, router
+from django.db.models import F
+from django.utils import timezone
+
+from . import backup, exporter, productivity, thumbnails
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+# Seconds before a failed task is tried again; doubled on each further attempt
+RETRY_DELAY = 30
+
+# Seconds between checks for stale and expired tasks in the worker's main process
+MAINTENANCE_INTERVAL = 60
+
+# name -> (function, label shown on the task page, priority, max attempts)
+TASKS = {}
+
+
+def register(name, label, priority=0, max_attempts=3):
+    """Make a function available to enqueue() under a name"""
+    def decorator(function):
+        TASKS[name] = (function, label, priority, max_attempts)
+        return function
+    return decorator
+
+
+def label(name):
+    return TASKS[name][1] if name in TASKS else name
+
+
+def eager():
+    return getattr(settings, 'SHEEP_TASKS_EAGER', False)
+
+
+def task_timeout():
+    return getattr(settings, 'SHEEP_TASK_TIMEOUT', 3600)
+
+
+def keep_days():
+    return getattr(settings, 'SHEEP_TASK_KEEP_DAYS', 7)
+
+
+def file_dir():
+    return str(getattr(settings, 'SHEEP_TASK_FILE_DIR', settings.BASE_DIR / 'task_files'))
+
+
+def file_path(name):
+    """Path of a file a task wrote; names with a directory part are refused"""
+    if not name or os.path.basename(name) != name:
+        raise FileNotFoundError(name)
+    return os.path.join(file_dir(), name)
+
+
+class Progress:
+    """Passed to every task function, to report how much of its work is done"""
+
+    # Seconds between writes of the figures; the last ones are always written when the task ends
+    INTERVAL = 1.0
+
+    def __init__(self, task, using=None):
+        self.task = task
+        self.using = using
+        self.saved_at = time.monotonic()
+
+    def __call__(self, done, total=None, message=None):
+        self.task.progress_done = done
+        if total is not None:
+            self.task.progress_total = total
+        if message is not None:
+            self.task.progress_message = message[:255]
+        if time.monotonic() - self.saved_at >= self.INTERVAL:
+            self.save()
+
+    def save(self):
+        Task.objects.using(self.using).filter(pk=self.task.pk).update(
+            progress_done=self.task.progress_done,
+            progress_total=self.task.progress_total,
+            progress_message=self.task.progress_message,
+            heartbeat_at=timezone.now(),
+        )
+        self.saved_at = time.monotonic()
+
+
+def enqueue(name, arguments=None, priority=None, user=None, delay=0, unique=False, using=None):
+    """
+    Queue a registered task; returns the Task, already finished when SHEEP_TASKS_EAGER is on.
+
+    With unique, a task of the same name and arguments that is still
+    queued or running is returned instead of queueing another.
+    """
+    if name not in TASKS:
+        raise ValueError(f"No task called {name!r}; choose from: {', '.join(TASKS)}")
+    _, _, default_priority, max_attempts = TASKS[name]
+    using = using or router.db_for_write(Task)
+    arguments = arguments or {}
+    if unique:
+        pending = Task.objects.using(using).filter(name=name, arguments=arguments, status__in=('QUEUED', 'RUNNING'))
+        existing = pending.first()
+        if existing is not None:
+            return existing
+    task = Task.objects.using(using).create(
+        name=name,
+        arguments=arguments,
+        priority=default_priority if priority is None else priority,
+        max_attempts=max_attempts,
+        run_after=timezone.now() + timedelta(seconds=delay),
+        created_by=user if user is not None and user.is_authenticated else None,
+    )
+    if eager():
+        while task.status == 'QUEUED':
+            Task.objects.using(using).filter(pk=task.pk).update(
+                status='RUNNING', worker='eager', started_at=timezone.now(), attempts=F('attempts') + 1,
+            )
+            task.refresh_from_db()
+            execute(task, using=using)
+    return task
+
+
+def claim(worker, using=None):
+    """Mark the next task due as running by this worker and return it, or None if none is due"""
+    using = using or router.db_for_write(Task)
+    tasks = Task.objects.using(using)
+    now = timezone.now()
+    candidate = (tasks.filter(status='QUEUED', run_after__lte=now)
+                 .order_by('-priority', 'run_after', 'pk').values_list('pk', 'attempts').first())
+    if candidate is None:
+        return None
+    pk, attempts = candidate
+    # Not in one transaction: SQLite cannot turn its read into a write while another worker
+    # writes, and fails at once instead of waiting. Another worker may have claimed it since,
+    # or even run it and queued it again, which the attempts tell.
+    claimed = tasks.filter(pk=pk, status='QUEUED', attempts=attempts).update(
+        status='RUNNING', worker=worker, started_at=now, heartbeat_at=now, attempts=attempts + 1,
+    )
+    return tasks.get(pk=pk) if claimed else None
+
+
+def _failed(task, error, using):
+    """Queue a task that failed again, or give up on it once it has used its attempts"""
+    now = timezone.now()
+    if task.attempts < task.max_attempts:
+        fields = {'status': 'QUEUED', 'run_after': now + timedelta(seconds=RETRY_DELAY * 2 ** (task.attempts - 1))}
+    else:
+        fields = {'status': 'FAILED', 'finished_at': now}
+    Task.objects.using(using).filter(pk=task.pk).update(error=error, heartbeat_at=now, **fields)
+    for name, value in fields.items():
+        setattr(task, name, value)
+    task.error = error
+
+
+def execute(task, using=None):
+    """Run a claimed task and store how it ended"""
+    using = using or router.db_for_write(Task)
+    progress = Progress(task, using)
+    try:
+        if task.name not in TASKS:
+            raise LookupError(f"No task called {task.name!r}")
+        function = TASKS[task.name][0]
+        result = function(progress, **task.arguments)
+    except Exception:
+        logger.warning("Task %s (%s) failed on attempt %s", task.pk, task.name, task.attempts, exc_info=True)
+        progress.save()
+        _failed(task, traceback.format_exc(), using)
+        return task
+    task.status = 'SUCCEEDED'
+    task.finished_at = timezone.now()
+    task.result = result
+    Task.objects.using(using).filter(pk=task.pk).update(
+        status=task.status, finished_at=task.finished_at, heartbeat_at=task.finished_at, result=result,
+        progress_done=task.progress_done, progress_total=task.progress_total,
+        progress_message=task.progress_message, error='',
+    )
+    return task
+
+
+def _worker_gone(worker):
+    """True if a worker name belongs to a process on this machine that no longer exists"""
+    host, _, pid = worker.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def requeue_stale(using=None):
+    """Retry or fail running tasks whose worker stopped reporting or died; returns how many there were"""
+    using = using or router.db_for_write(Task)
+    cutoff = timezone.now() - timedelta(seconds=task_timeout())
+    running = Task.objects.using(using).filter(status='RUNNING').exclude(worker='eager')
+    stale = [task for task in running if task.heartbeat_at < cutoff or _worker_gone(task.worker)]
+    for task in stale:
+        _failed(task, f"The worker running it ({task.worker}) stopped reporting", using)
+    return len(stale)
+
+
+def prune(using=None):
+    """Delete tasks that finished more than SHEEP_TASK_KEEP_DAYS ago, and the files they wrote"""
+    using = using or router.db_for_write(Task)
+    cutoff = timezone.now() - timedelta(days=keep_days())
+    expired = Task.objects.using(using).filter(status__in=('SUCCEEDED', 'FAILED'), finished_at__lt=cutoff)
+    for result in expired.exclude(result=None).values_list('result', flat=True):
+        if isinstance(result, dict) and result.get('file'):
+            try:
+                os.remove(file_path(result['file']))
+            except FileNotFoundError:
+                pass
+    return expired.delete()[0]
+
+
+def work(worker, poll=1.0, burst=False, stop=None, using=None):
+    """Run tasks one after another until stop is set, or, in a burst, until none is due"""
+    done = 0
+    while stop is None or not stop.is_set():
+        task = claim(worker, using=using)
+        if task is None:
+            if burst:
+                break
+            if stop is None:
+                time.sleep(poll)
+            else:
+                stop.wait(poll)
+            continue
+        execute(task, using=using)
+        done += 1
+        # As at the end of a request, so CONN_MAX_AGE and health checks apply
+        close_old_connections()
+    return done
+
+
+def _worker_process(index, poll, burst, stop, using):
+    # Ctrl-C reaches the whole process group; let the main process decide when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    work(f"{socket.gethostname()}:{os.getpid()}", poll=poll, burst=burst, stop=stop, using=using)
+    connections.close_all()
+
+
+def run_workers(processes=2, poll=1.0, burst=False, using=None, stdout=None):
+    """
+    Run tasks in a pool of worker processes until SIGTERM or SIGINT.
+
+    Each process finishes the task it is running before it stops. Processes
+    that die are replaced. In a burst, returns once no task is due.
+    """
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+    stopping = []
+    # Only note the signal: setting the Event here could deadlock with the wait below
+    previous = {sig: signal.signal(sig, lambda *args: stopping.append(True)) for sig in (signal.SIGTERM, signal.SIGINT)}
+
+    def start(index):
+        process = context.Process(target=_worker_process, args=(index, poll, burst, stop, using), daemon=False)
+        process.start()
+        return process
+
+    try:
+        requeue_stale(using=using)
+        # Forked processes must not share the parent's connections
+        connections.close_all()
+        pool = [start(index) for index in range(processes)]
+        maintained = time.monotonic()
+        while not stopping and any(process.is_alive() for process in pool):
+            time.sleep(poll)
+            died = [index for index, process in enumerate(pool)
+                    if not process.is_alive() and process.exitcode != 0 and not burst]
+            for index in died:
+                if stdout:
+                    stdout.write(f"Worker {pool[index].pid} exited with {pool[index].exitcode}; starting another")
+                pool[index] = start(index)
+            if died or time.monotonic() - maintained >= MAINTENANCE_INTERVAL:
+                # Tasks the dead workers were running are tried again
+                requeue_stale(using=using)
+                prune(using=using)
+                connections.close_all()
+                maintained = time.monotonic()
+        stop.set()
+        for process in pool:
+            process.join()
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+
+
+# The tasks
+
+@register('thumbnails', 'Resizing a photo', priority=10)
+def create_thumbnails(progress, name, force=False):
+    """Resized copies of one uploaded photo"""
+    if not default_storage.exists(name):
+        return {'written': 0, 'message': "The photo was deleted before it could be resized"}
+    written = thumbnails.generate_derivatives(default_storage, name, force=force)
+    return {'written': written}
+
+
+@register('refresh-productivity', 'Recalculating productivity', priority=5)
+def refresh_productivity(progress):
+    progress(0, message="Recalculating ewe and sire productivity")
+    rows = productivity.refresh()
+    return {'rows': rows, 'message': f"Productivity figures recalculated for {rows} sheep."}
+
+
+@register('export', 'Preparing an export', priority=5)
+def export_flock(progress, kind, format):
+    """An export written to a file for the task page to offer, instead of streamed to one request"""
+    if kind not in exporter.EXPORT_KINDS or format not in exporter.FORMATS:
+        raise ValueError(f"Unknown export {kind}.{format}")
+    os.makedirs(file_dir(), exist_ok=True)
+    _, extension = exporter.FORMATS[format]
+    download_name = f"flock-{kind}-{timezone.localdate():%Y-%m-%d}.{extension}"
+    name = f"{progress.task.pk}-{download_name}"
+    written = 0
+    with open(file_path(name), 'wb') as file:
+        for chunk in exporter.export_chunks(kind, format):
+            file.write(chunk)
+            written += len(chunk)
+            progress(written, message=f"{written / 1024 / 1024:.1f} MB written")
+    return {'file': name, 'download_name': download_name, 'bytes': written, 'message': "The export is ready."}
+
+
+@register('backup', 'Backing up the database', max_attempts=2)
+def backup_database(progress, database='default'):
+    progress(0, message=f"Backing up {database}")
+    result = backup.backup(database)
+    return {'path': result['path'], 'bytes': result['bytes'], 'message': f"Backed up {database}."}
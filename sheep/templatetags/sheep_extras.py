@@ -1,5 +1,7 @@
 from django import template
 
+from sheep import thumbnails
+
 register = template.Library()
 
 @register.filter
@@ -9,3 +11,19 @@ def get_item(dictionary, key):
     Usage: {{ dict|get_item:key }}
     """
     return dictionary.get(key, None)
+
+@register.inclusion_tag('sheep/responsive_image.html')
+def responsive_image(image, alt='', css_class='img-fluid rounded', sizes='100vw', style=''):
+    """
+    Render an uploaded photo as a <picture> with WebP and JPEG srcsets.
+    Usage: {% responsive_image sheep.primary_image sheep.tag_number sizes="(min-width: 768px) 33vw, 100vw" %}
+    Photos without derivatives yet are served as the original.
+    """
+    context = {'image': image, 'alt': alt, 'css_class': css_class, 'sizes': sizes, 'style': style}
+    if thumbnails.has_derivatives(image):
+        context.update({
+            'webp_srcset': thumbnails.srcset(image, 'webp'),
+            'jpeg_srcset': thumbnails.srcset(image, 'jpg'),
+            'fallback_url': image.storage.url(thumbnails.derivative_name(image.name, thumbnails.THUMBNAIL_WIDTHS[1], 'jpg')),
+        })
+    return context
@@ -1,3 +1,1535 @@
-from django.test import TestCase
+import datetime
+import gzip
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import zipfile
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import OperationalError, connection, connections
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import (
+    backup, benchmark, breeding_plan, bulk, dashboard, detail_cache, exporter, importer, kinship, middleware, pedigree,
+    productivity, profiling, response_cache, search, sqlite, sync, synthetic, tasks, thumbnails,
+)
+from .models import (
+    Breed, Sheep, SheepAncestor, BreedingRecord, LambingRecord, HealthRecord, FlockStat, SheepProductivity, Task,
+)
+from .pagination import KeysetPaginator, InvalidCursor
+from .views import SheepForm
+
+# The tests' own cache, so they never read or fill the site's cache directory
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def make_sheep(tag, breed, gender='F', **fields):
+    return Sheep.objects.create(tag_number=tag, breed=breed, gender=gender, **fields)
+
+
+def count_queries(client, url):
+    with CaptureQueriesContext(connection) as captured:
+        response = client.get(url)
+    return response, len(captured)
+
+
+@override_settings(CACHES=TEST_CACHES, SHEEP_RESPONSE_CACHE_TIMEOUT=0)
+class SheepListTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.breed = Breed.objects.create(name='Dorper')
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+        cls.ewe = make_sheep('E1', cls.breed)
+        cls.ram = make_sheep('R1', cls.breed, gender='M')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def add_lambs(self, count, start=0):
+        for number in range(start, start + count):
+            make_sheep(f'L{number:03}', self.breed, mother=self.ewe, father=self.ram)
+
+    def test_pages_cover_every_sheep_once_in_both_directions(self):
+        self.add_lambs(12)
+        # Ties on the sort field are broken by id
+        Sheep.objects.update(updated_at=datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc))
+        paginator = KeysetPaginator(Sheep.objects.all(), '-updated_at', per_page=5)
+
+        pages = [paginator.page()]
+        while pages[-1].has_next:
+            pages.append(paginator.page(after=pages[-1].next_cursor))
+        forward = [sheep.pk for page in pages for sheep in page]
+        self.assertEqual(forward, list(Sheep.objects.order_by('-updated_at', '-pk').values_list('pk', flat=True)))
+        self.assertEqual([len(page) for page in pages], [5, 5, 4])
+        self.assertFalse(pages[0].has_previous)
+
+        backward = [paginator.page(before=pages[-1].previous_cursor)]
+        while backward[-1].has_previous:
+            backward.append(paginator.page(before=backward[-1].previous_cursor))
+        self.assertEqual([[s.pk for s in page] for page in backward],
+                         [[s.pk for s in page] for page in reversed(pages[:-1])])
+
+    def test_undecodable_cursor(self):
+        paginator = KeysetPaginator(Sheep.objects.all(), 'tag_number')
+        with self.assertRaises(InvalidCursor):
+            paginator.decode_cursor('not-a-cursor')
+        response = self.client.get(reverse('sheep-list'), {'after': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_sort_by_tag(self):
+        self.add_lambs(3)
+        response = self.client.get(reverse('sheep-list'), {'sort': 'tag_number'})
+        tags = [sheep.tag_number for sheep in response.context['page']]
+        self.assertEqual(tags, sorted(tags))
+
+    def test_queries_do_not_grow_with_the_page(self):
+        self.add_lambs(2)
+        _, few = count_queries(self.client, reverse('sheep-list'))
+        self.add_lambs(30, start=2)
+        response, many = count_queries(self.client, reverse('sheep-list'))
+        self.assertEqual(len(response.context['page']), 34)
+        self.assertEqual(few, many)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.breed = Breed.objects.create(name='Katahdin')
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+        cls.ewe = make_sheep('2301', cls.breed, name='Clover', markings='white blaze')
+
+    def hits(self, text):
+        results, _ = search.search(text)
+        return [(result.kind, result.object_id) for result in results]
+
+    def test_match_query_quotes_every_word(self):
+        self.assertEqual(search.build_match_query('23 blaze'), '"23"* "blaze"*')
+        self.assertEqual(search.build_match_query('tag:"2301" OR NEAR(a b) -c'),
+                         '"tag"* "2301"* "OR"* "NEAR"* "a"* "b"* "c"*')
+        self.assertEqual(search.build_match_query('"*-()'), '')
+
+    def test_fts_syntax_is_searched_as_text(self):
+        self.assertEqual(self.hits('clover"'), [('sheep', self.ewe.pk)])
+        self.assertEqual(self.hits('NOT clover'), [])
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('search'), {'q': 'title:clover AND ("'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_partial_tags_and_records(self):
+        record = HealthRecord.objects.create(sheep=self.ewe, date=datetime.date(2024, 3, 1),
+                                             record_type='VACCINATION', treatment='CDT booster')
+        self.assertEqual(self.hits('23'), [('sheep', self.ewe.pk)])
+        self.assertEqual(self.hits('booster'), [('health', record.pk)])
+
+    def test_saves_and_deletes_replace_entries(self):
+        self.ewe.name = 'Daisy'
+        self.ewe.save()
+        self.assertEqual(self.hits('clover'), [])
+        self.assertEqual(self.hits('daisy'), [('sheep', self.ewe.pk)])
+        self.ewe.delete()
+        self.assertEqual(self.hits('daisy'), [])
+
+    def test_rowids_are_unique_across_kinds(self):
+        rowids = {search.search_rowid(kind, object_id) for kind in search.KIND_CODES for object_id in range(1, 50)}
+        self.assertEqual(len(rowids), len(search.KIND_CODES) * 49)
+
+    def test_rebuild_matches_the_signals(self):
+        HealthRecord.objects.create(sheep=self.ewe, date=datetime.date(2024, 3, 1),
+                                    record_type='ILLNESS', notes='blaze of fever')
+        before = sorted(self.hits('blaze'))
+        self.assertEqual(search.rebuild_search_index(), 2)
+        self.assertEqual(sorted(self.hits('blaze')), before)
+        self.assertEqual(len(before), 2)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SheepBirthYearListTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.breed = Breed.objects.create(name='Dorper')
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+        for index, year in enumerate([2019, 2020, 2021, 2022, 2022]):
+            make_sheep(f'Y{index}', cls.breed, date_of_birth=datetime.date(year, 4, 1))
+        make_sheep('SOLD', cls.breed, date_of_birth=datetime.date(2018, 4, 1), status='SOLD')
+        make_sheep('UNKNOWN', cls.breed)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_groups_count_each_year_newest_first(self):
+        response = self.client.get(reverse('sheep-by-birth-year'))
+        groups = response.context['year_groups']
+        self.assertEqual([(group['year'], group['count']) for group in groups],
+                         [(2022, 2), (2021, 1), (2020, 1), (2019, 1)])
+        self.assertEqual([group['expanded'] for group in groups], [True, True, True, False])
+        self.assertEqual([sheep.tag_number for sheep in groups[0]['sheep_list']], ['Y3', 'Y4'])
+
+    def test_inactive_sheep_on_request(self):
+        response = self.client.get(reverse('sheep-by-birth-year'), {'active_only_submitted': '1'})
+        self.assertEqual(response.context['year_groups'][-1]['year'], 2018)
+
+    def test_one_year_loaded_on_its_own(self):
+        response = self.client.get(reverse('sheep-by-birth-year'), {'year': '2022', 'partial': '1'})
+        self.assertTemplateUsed(response, 'sheep/sheep_birthyear_table.html')
+        self.assertEqual(len(response.context['filtered_sheep']), 2)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class PedigreeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        breed = Breed.objects.create(name='Dorper')
+        cls.grandsire = make_sheep('GS', breed, gender='M')
+        cls.granddam = make_sheep('GD', breed)
+        cls.sire = make_sheep('S', breed, gender='M', mother=cls.granddam, father=cls.grandsire)
+        cls.dam = make_sheep('D', breed)
+        cls.lamb = make_sheep('L', breed, gender='M', mother=cls.dam, father=cls.sire)
+
+    def closure(self):
+        return set(SheepAncestor.objects.values_list('descendant__tag_number', 'ancestor__tag_number', 'depth'))
+
+    def test_ancestor_tree_paths(self):
+        tree = pedigree.ancestor_tree(self.lamb, generations=2)
+        self.assertEqual({path: sheep.tag_number for path, sheep in tree.items()},
+                         {'': 'L', 's': 'S', 'd': 'D', 'ss': 'GS', 'sd': 'GD'})
+        self.assertEqual(tree['ss'].breed_name, 'Dorper')
+        self.assertEqual(set(pedigree.ancestor_tree(self.lamb, generations=1)), {'', 's', 'd'})
+
+    def test_chart_puts_the_sire_side_first(self):
+        rows = pedigree.pedigree_chart({}, 2)
+        self.assertEqual([[(cell['path'], cell['rowspan']) for cell in row] for row in rows],
+                         [[('s', 2), ('ss', 1)], [('sd', 1)], [('d', 2), ('ds', 1)], [('dd', 1)]])
+
+    def test_ancestors_and_descendants(self):
+        self.assertEqual(set(pedigree.ancestors_queryset(self.lamb).values_list('tag_number', flat=True)),
+                         {'S', 'D', 'GS', 'GD'})
+        self.assertEqual(set(pedigree.descendants_queryset(self.grandsire).values_list('tag_number', flat=True)),
+                         {'S', 'L'})
+
+    def test_closure_follows_parent_changes(self):
+        self.assertEqual(self.closure(), {
+            ('S', 'GS', 1), ('S', 'GD', 1),
+            ('L', 'S', 1), ('L', 'D', 1), ('L', 'GS', 2), ('L', 'GD', 2),
+        })
+        self.sire.father = None
+        self.sire.save()
+        self.assertNotIn(('L', 'GS', 2), self.closure())
+        self.granddam.delete()
+        self.assertEqual(self.closure(), {('L', 'S', 1), ('L', 'D', 1)})
+
+    def test_rebuild_matches_the_signals(self):
+        before = self.closure()
+        SheepAncestor.objects.all().delete()
+        pedigree.rebuild_closure()
+        self.assertEqual(self.closure(), before)
+
+    def test_a_sheep_cannot_be_its_own_ancestor(self):
+        self.assertTrue(pedigree.would_create_cycle(self.grandsire, self.lamb))
+        self.assertTrue(pedigree.would_create_cycle(self.lamb, self.lamb))
+        self.assertFalse(pedigree.would_create_cycle(self.lamb, self.grandsire))
+        form = SheepForm({
+            'tag_number': 'GS', 'gender': 'M', 'breed': self.grandsire.breed_id, 'father': self.lamb.pk,
+            'status': 'ACTIVE', 'body_type': 'GOOD', 'udder_type': 'GOOD', 'feet_type': 'GOOD',
+        }, instance=self.grandsire)
+        self.assertFalse(form.is_valid())
+        self.assertIn('father', form.errors)
+
+
+class KinshipEngineTests(SimpleTestCase):
+    # (id, mother, father): full sibs 3 and 4 of founders 1 and 2, their
+    # inbred offspring 5, and 7, a half sib of 3 and 4 through sire 1
+    ROWS = [(1, None, None), (2, None, None), (3, 2, 1), (4, 2, 1), (5, 3, 4), (6, None, None), (7, 6, 1)]
+
+    def setUp(self):
+        self.engine = kinship.KinshipEngine(self.ROWS)
+
+    def test_inbreeding(self):
+        self.assertEqual(self.engine.coi(5), 0.25)
+        self.assertEqual(self.engine.coi(3), 0.0)
+        self.assertEqual(self.engine.coi(99), 0.0)
+        self.assertEqual(self.engine.inbreeding, {1: 0, 2: 0, 3: 0, 4: 0, 5: 0.25, 6: 0, 7: 0})
+
+    def test_kinship(self):
+        cases = [
+            ((1, 2), 0.0),
+            ((3, 4), 0.25),
+            ((3, 7), 0.125),
+            ((1, 3), 0.25),
+            ((5, 1), 0.25),
+            ((6, 6), 0.5),
+            ((5, 5), 0.625),
+            ((99, 99), 0.5),
+            ((99, 1), 0.0),
+        ]
+        for pair, expected in cases:
+            with self.subTest(pair=pair):
+                self.assertAlmostEqual(self.engine.kinship(*pair), expected)
+
+    def test_matrix_matches_pairs(self):
+        matrix = self.engine.kinship_matrix([3, 5, 99], [4, 7])
+        for (ewe_id, ram_id), value in matrix.items():
+            self.assertAlmostEqual(value, self.engine.kinship(ewe_id, ram_id))
+
+    def test_parents_come_first_and_cycles_are_dropped(self):
+        engine = kinship.KinshipEngine([(5, 3, 4), (4, 2, 1), (3, 2, 1), (2, None, None), (1, None, None)])
+        self.assertEqual(engine.coi(5), 0.25)
+        looped = kinship.KinshipEngine([(1, 2, None), (2, 1, None)])
+        self.assertEqual(looped.coi(1), 0.0)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class KinshipCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        breed = Breed.objects.create(name='Dorper')
+        cls.ram = make_sheep('R', breed, gender='M')
+        cls.ewe = make_sheep('E', breed)
+        cls.daughter = make_sheep('D', breed)
+
+    def setUp(self):
+        kinship.invalidate()
+
+    def test_parentage_changes_reach_cached_results(self):
+        pair = (self.daughter.pk, self.ram.pk)
+        self.assertEqual(kinship.kinship_matrix([self.daughter.pk], [self.ram.pk]), {pair: 0.0})
+        self.daughter.father = self.ram
+        self.daughter.mother = self.ewe
+        self.daughter.save()
+        self.assertEqual(kinship.kinship_matrix([self.daughter.pk], [self.ram.pk]), {pair: 0.25})
+        # More ewes for a ram that is already cached
+        matrix = kinship.kinship_matrix([self.ewe.pk, self.daughter.pk], [self.ram.pk])
+        self.assertEqual(matrix, {(self.ewe.pk, self.ram.pk): 0.0, pair: 0.25})
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BreedingPlanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        breed = Breed.objects.create(name='Dorper')
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+        cls.ram_a = make_sheep('RA', breed, gender='M')
+        cls.ram_b = make_sheep('RB', breed, gender='M')
+        dam = make_sheep('DAM', breed)
+        # Daughters of ram A may only go to ram B
+        cls.daughters = [make_sheep(f'DA{n}', breed, mother=dam, father=cls.ram_a).pk for n in range(2)]
+        cls.stranger = make_sheep('X', breed).pk
+
+    def setUp(self):
+        kinship.invalidate()
+
+    def test_related_pairs_are_never_proposed(self):
+        plan = breeding_plan.plan_breeding_groups([*self.daughters, self.stranger],
+                                                  [self.ram_a.pk, self.ram_b.pk], capacity=2)
+        self.assertEqual(plan.assignment, {self.daughters[0]: self.ram_b.pk, self.daughters[1]: self.ram_b.pk,
+                                           self.stranger: self.ram_a.pk})
+        self.assertEqual(plan.total_kinship, 0)
+        self.assertEqual(plan.unassigned, [])
+
+    def test_ewes_left_over_when_rams_are_full(self):
+        plan = breeding_plan.plan_breeding_groups([*self.daughters, self.stranger],
+                                                  [self.ram_a.pk, self.ram_b.pk], capacity=1)
+        self.assertEqual(plan.assignment[self.stranger], self.ram_a.pk)
+        self.assertEqual(len(plan.unassigned), 1)
+        self.assertIn(plan.unassigned[0], self.daughters)
+
+    def test_a_closer_limit_still_finds_the_cheapest_plan(self):
+        plan = breeding_plan.plan_breeding_groups([self.daughters[0]], [self.ram_a.pk, self.ram_b.pk],
+                                                  capacity=1, max_kinship=0.5)
+        self.assertEqual(plan.assignment, {self.daughters[0]: self.ram_b.pk})
+
+    def test_accepting_the_plan_creates_records(self):
+        dashboard.rebuild()
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('breeding-plan'), {
+            'pair': [f'{self.daughters[0]}:{self.ram_b.pk}', f'{self.stranger}:{self.ram_a.pk}'],
+            'date_started': '2024-09-01', 'status': 'PLANNED',
+        })
+        self.assertRedirects(response, reverse('breeding-record-list'))
+        self.assertEqual(set(BreedingRecord.objects.values_list('ewe_id', 'ram_id')),
+                         {(self.daughters[0], self.ram_b.pk), (self.stranger, self.ram_a.pk)})
+        self.assertEqual(dashboard.summary()['pending_breedings'], 2)
+        self.assertEqual(len(search.search('breeding planned')[0]), 2)
+
+
+@override_settings(CACHES=TEST_CACHES, SHEEP_DETAIL_CACHE_TIMEOUT=600)
+class SheepDetailCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        breed = Breed.objects.create(name='Dorper')
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+        cls.ewe = make_sheep('E1', breed)
+        cls.ram = make_sheep('RAM-ONE', breed, gender='M')
+        cls.lamb = make_sheep('L1', breed, mother=cls.ewe)
+        BreedingRecord.objects.create(ewe=cls.ewe, ram=cls.ram, date_started=datetime.date(2024, 9, 1))
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def assertDropsVersionOf(self, sheep, change):
+        before = detail_cache.version(sheep.pk)
+        with self.captureOnCommitCallbacks() as callbacks:
+            change()
+            # Not until the transaction commits
+            self.assertEqual(detail_cache.version(sheep.pk), before)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(detail_cache.version(sheep.pk), before)
+
+    def test_versions_are_dropped_on_commit(self):
+        def rename(sheep):
+            def change():
+                sheep.name = 'renamed'
+                sheep.save()
+            return change
+
+        self.assertEqual(detail_cache.version(self.ewe.pk), detail_cache.version(self.ewe.pk))
+        self.assertDropsVersionOf(self.ewe, rename(self.ewe))
+        # Parent, offspring and mate pages list the sheep
+        self.assertDropsVersionOf(self.ewe, rename(self.lamb))
+        self.assertDropsVersionOf(self.lamb, rename(self.ewe))
+        self.assertDropsVersionOf(self.ewe, rename(self.ram))
+        self.assertDropsVersionOf(self.ram, rename(self.ewe))
+        self.assertDropsVersionOf(self.ewe, lambda: HealthRecord.objects.create(
+            sheep=self.ewe, date=datetime.date(2024, 3, 1), record_type='HOOF_TRIM'))
+
+    def test_bulk_writes_drop_the_same_versions_as_saves(self):
+        self.assertDropsVersionOf(self.lamb, lambda: bulk.treat([self.lamb.pk], {
+            'date': datetime.date(2024, 3, 1), 'record_type': 'HOOF_TRIM'}))
+        self.assertDropsVersionOf(self.ram, lambda: breeding_plan.create_breeding_records(
+            [(self.lamb.pk, self.ram.pk)], datetime.date(2025, 9, 1)))
+        self.assertDropsVersionOf(self.ewe, lambda: bulk.update_sheep([self.lamb.pk], {'status': 'SOLD'}))
+        self.assertDropsVersionOf(self.ram, lambda: bulk.update_sheep([self.ewe.pk], {'cull_candidate': True}))
+
+    def test_cached_page_shows_a_mate_saved_since(self):
+        url = reverse('sheep-detail', args=[self.ewe.pk])
+        _, first = count_queries(self.client, url)
+        response, cached = count_queries(self.client, url)
+        self.assertContains(response, 'RAM-ONE')
+        self.assertLess(cached, first)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ram.tag_number = 'RAM-RETAGGED'
+            self.ram.save()
+        self.assertContains(self.client.get(url), 'RAM-RETAGGED')
+
+
+class ThumbnailTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = FileSystemStorage(location=directory.name, base_url='/media/')
+
+    def save_photo(self, width, height):
+        buffer = BytesIO()
+        Image.new('RGB', (width, height), 'white').save(buffer, 'JPEG')
+        return self.storage.save('sheep_images/photo.jpg', ContentFile(buffer.getvalue()))
+
+    def sizes(self, name):
+        sizes = {}
+        for width in thumbnails.THUMBNAIL_WIDTHS:
+            for ext in thumbnails.FORMATS:
+                with self.storage.open(thumbnails.derivative_name(name, width, ext)) as derivative:
+                    sizes[(width, ext)] = Image.open(derivative).size
+        return sizes
+
+    def test_every_width_in_both_formats(self):
+        name = self.save_photo(2000, 1000)
+        self.assertEqual(thumbnails.generate_derivatives(self.storage, name), 6)
+        self.assertEqual(self.sizes(name), {
+            (1280, 'jpg'): (1280, 640), (1280, 'webp'): (1280, 640),
+            (640, 'jpg'): (640, 320), (640, 'webp'): (640, 320),
+            (320, 'jpg'): (320, 160), (320, 'webp'): (320, 160),
+        })
+        # Done once unless forced
+        self.assertEqual(thumbnails.generate_derivatives(self.storage, name), 0)
+        self.assertEqual(thumbnails.generate_derivatives(self.storage, name, force=True), 6)
+
+    def test_small_photos_are_not_enlarged(self):
+        name = self.save_photo(500, 400)
+        thumbnails.generate_derivatives(self.storage, name)
+        sizes = self.sizes(name)
+        self.assertEqual(sizes[(1280, 'jpg')], (500, 400))
+        self.assertEqual(sizes[(320, 'webp')], (320, 256))
+
+    def test_derivative_names_and_removal(self):
+        self.assertEqual(thumbnails.derivative_name('sheep_images/ab12.png', 640, 'webp'),
+                         'sheep_images/derivatives/ab12-640w.webp')
+        name = self.save_photo(800, 600)
+        thumbnails.generate_derivatives(self.storage, name)
+        thumbnails.delete_derivatives(self.storage, name)
+        self.assertEqual(self.storage.listdir('sheep_images/derivatives'), ([], []))
+
+
+@override_settings(CACHES=TEST_CACHES, SHEEP_TASKS_EAGER=True)
+class PhotoCleanupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.breed = Breed.objects.create(name='Dorper')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def photo(self):
+        buffer = BytesIO()
+        Image.new('RGB', (800, 600), 'white').save(buffer, 'JPEG')
+        return ContentFile(buffer.getvalue(), name='photo.jpg')
+
+    def derivatives(self, field_file):
+        return [field_file.storage.exists(thumbnails.derivative_name(field_file.name, width, ext))
+                for width in thumbnails.THUMBNAIL_WIDTHS for ext in thumbnails.FORMATS]
+
+    def test_replaced_and_deleted_photos_lose_their_resized_copies(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            ewe = make_sheep('E1', self.breed, primary_image=self.photo())
+        first = ewe.primary_image
+        self.assertTrue(all(self.derivatives(first)))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ewe.primary_image = self.photo()
+            ewe.save()
+        self.assertFalse(any(self.derivatives(first)))
+        self.assertTrue(all(self.derivatives(ewe.primary_image)))
+
+        # An unchanged photo keeps them
+        with self.captureOnCommitCallbacks(execute=True):
+            ewe.name = 'Daisy'
+            ewe.save()
+        self.assertTrue(all(self.derivatives(ewe.primary_image)))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ewe.delete()
+        self.assertFalse(any(self.derivatives(ewe.primary_image)))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class HealthRecordListTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        breed = Breed.objects.create(name='Dorper')
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+        cls.clover = make_sheep('C1', breed, name='Clover')
+        cls.daisy = make_sheep('D1', breed, name='Daisy')
+        today = datetime.date.today()
+        cls.overdue = HealthRecord.objects.create(
+            sheep=cls.clover, date=today - datetime.timedelta(days=10), record_type='ILLNESS',
+            requires_followup=True, followup_date=today - datetime.timedelta(days=1))
+        cls.old = HealthRecord.objects.create(
+            sheep=cls.daisy, date=today - datetime.timedelta(days=200), record_type='VACCINATION')
+        HealthRecord.objects.bulk_create([
+            HealthRecord(sheep=cls.daisy, date=today - datetime.timedelta(days=400 + n), record_type='SHEARING')
+            for n in range(60)
+        ])
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def listed(self, **filters):
+        response = self.client.get(reverse('health-record-list'), filters)
+        return [record.pk for record in response.context['health_records']]
+
+    def test_filters(self):
+        self.assertEqual(self.listed(record_type='ILLNESS'), [self.overdue.pk])
+        self.assertEqual(self.listed(sheep='clo'), [self.overdue.pk])
+        self.assertEqual(self.listed(days='365'), [self.overdue.pk, self.old.pk])
+        self.assertEqual(self.listed(followup='overdue'), [self.overdue.pk])
+        self.assertEqual(self.listed(record_type='VACCINATION', date_to=str(datetime.date.today())), [self.old.pk])
+        # Bad values are left out rather than failing the page
+        self.assertEqual(len(self.listed(record_type='ILLNESS', date_from='not a date')), 1)
+
+    def test_pages_keep_the_filters(self):
+        response = self.client.get(reverse('health-record-list'), {'record_type': 'SHEARING'})
+        self.assertEqual(len(response.context['health_records']), 50)
+        self.assertEqual(response.context['filter_query'], 'record_type=SHEARING')
+        response = self.client.get(reverse('health-record-list'), {
+            'record_type': 'SHEARING', 'after': response.context['page'].next_cursor, 'partial': '1'})
+        self.assertTemplateUsed(response, 'sheep/health_record_table.html')
+        self.assertEqual(len(response.context['health_records']), 10)
+        self.assertFalse(response.context['page'].has_next)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.breed = Breed.objects.create(name='Dorper')
+
+    def run_import(self, text, kind='sheep', format='csv', **options):
+        return importer.import_file(StringIO(text), kind, format=format, **options)
+
+    def test_lambs_may_come_before_their_parents(self):
+        dashboard.rebuild()
+        text = (
+            "tag_number,gender,breed,date_of_birth,mother,father,status\n"
+            "L1,F,Dorper,03/15/2024,D1,S1,Active\n"
+            "D1,Female,dorper,2020-01-01,,,\n"
+            "S1,M,Katahdin,,,,\n"
+        )
+        # A dry run only reads, so it never takes the write lock
+        with CaptureQueriesContext(connection) as captured:
+            dry_run = self.run_import(text, dry_run=True, batch_size=2)
+        self.assertEqual([query['sql'] for query in captured if not query['sql'].startswith('SELECT')], [])
+        self.assertEqual((dry_run.rows, dry_run.created, dry_run.parents_linked, dry_run.errors), (3, 3, 2, []))
+        self.assertFalse(Breed.objects.filter(name='Katahdin').exists())
+
+        report = self.run_import(text, batch_size=2)
+        self.assertEqual((report.rows, report.created, report.parents_linked, report.errors), (3, 3, 2, []))
+        lamb = Sheep.objects.get(tag_number='L1')
+        self.assertEqual((lamb.mother.tag_number, lamb.father.tag_number), ('D1', 'S1'))
+        self.assertEqual(lamb.date_of_birth, datetime.date(2024, 3, 15))
+        self.assertEqual(Sheep.objects.get(tag_number='D1').breed, self.breed)
+        self.assertEqual(Sheep.objects.get(tag_number='S1').breed.name, 'Katahdin')
+        self.assertEqual(set(lamb.ancestor_links.values_list('ancestor__tag_number', flat=True)), {'D1', 'S1'})
+        self.assertEqual(dashboard.summary()['active'], 3)
+        self.assertEqual([result.object_id for result in search.search('L1')[0]], [lamb.pk])
+
+    def test_bad_rows_are_reported(self):
+        text = (
+            "tag_number,gender,breed,mother,father\n"
+            "A,F,Dorper,B,\n"
+            "B,F,Dorper,A,\n"
+            "C,F,Dorper,,A\n"
+            "A,F,Dorper,,\n"
+            "D,X,Dorper,,\n"
+            "E,F,,,\n"
+        )
+        expected = [
+            (3, "mother: sheep 'A' descends from this one, which cannot be its own ancestor; imported without it"),
+            (4, "father: sheep 'A' is female"),
+            (5, "tag_number: a sheep with tag 'A' already exists"),
+            (6, "gender: 'X' is not a valid choice"),
+            (7, "breed: this field is required"),
+        ]
+        dry_run = self.run_import(text, dry_run=True, batch_size=2)
+        self.assertEqual(sorted(dry_run.errors), expected)
+        self.assertFalse(Sheep.objects.exists())
+
+        report = self.run_import(text, batch_size=2)
+        self.assertEqual(sorted(report.errors), expected)
+        self.assertEqual((report.created, report.skipped), (2, 4))
+        self.assertEqual(dict(Sheep.objects.values_list('tag_number', 'mother__tag_number')), {'A': 'B', 'B': None})
+
+    def test_records_name_their_sheep_by_tag(self):
+        make_sheep('D1', self.breed)
+        report = self.run_import(
+            '{"ewe": "D1", "date": "2024-03-01", "total_born": 2, "born_alive": 2, "assisted": "yes"}\n'
+            '{"ewe": "NOPE", "date": "2024-03-01"}\n'
+            'not json\n',
+            kind='lambing', format='jsonl',
+        )
+        self.assertEqual(report.created, 1)
+        self.assertEqual([line for line, _ in report.errors], [2, 3])
+        self.assertEqual(report.errors[0][1], "ewe: no sheep with tag 'NOPE'")
+        record = LambingRecord.objects.get()
+        self.assertEqual((record.ewe.tag_number, record.total_born, record.assisted), ('D1', 2, True))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        breed = Breed.objects.create(name='Dorper')
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+        dam = make_sheep('D1', breed, date_of_birth=datetime.date(2020, 2, 1), weight_current='150.50',
+                         notes='Quiet, "easy" lamber\nfrom the Smith flock')
+        sire = make_sheep('S1', breed, gender='M', status='SOLD', cull_candidate=True)
+        lamb = make_sheep('L1', breed, gender='M', mother=dam, father=sire, date_of_birth=datetime.date(2024, 3, 1))
+        LambingRecord.objects.create(ewe=dam, date=datetime.date(2024, 3, 1), total_born=2, born_alive=1, born_dead=1)
+        HealthRecord.objects.create(sheep=lamb, date=datetime.date(2024, 4, 1), record_type='VACCINATION',
+                                    treatment='CDT', requires_followup=True, followup_date=datetime.date(2024, 5, 1))
+
+    def export(self, kind, format):
+        return b''.join(exporter.export_chunks(kind, format, chunk_size=2)).decode('utf-8')
+
+    def test_exports_import_again(self):
+        for format in ('csv', 'jsonl'):
+            with self.subTest(format=format):
+                exports = {kind: self.export(kind, format) for kind in exporter.EXPORT_KINDS}
+                Sheep.objects.all().delete()
+                for kind in ('sheep', 'lambing', 'health'):
+                    report = importer.import_file(StringIO(exports[kind]), kind, format=format)
+                    self.assertEqual(report.errors, [])
+                self.assertEqual({kind: self.export(kind, format) for kind in exporter.EXPORT_KINDS}, exports)
+
+    def test_every_imported_sheep_column_survives_a_round_trip(self):
+        _, columns, _ = importer.IMPORT_KINDS['sheep']
+        # The breed column holds the breed's name
+        fields = ['breed__name', *(column for column in columns if column != 'breed')]
+        Sheep.objects.filter(tag_number='L1').update(
+            name='Pip', weight_birth='9.25', color='Black', markings='Star', date_acquired=datetime.date(2024, 3, 2),
+            date_removed=datetime.date(2024, 9, 1), removal_reason='Sold at the barn', cull_date=datetime.date(2024, 8, 1),
+            cull_reason='Light', bottle_lamb=True, bottle_lamb_reason='Dam had one teat', body_type='FAIR',
+            udder_type='FAIR', feet_type='FAIR', notes='Friendly',
+        )
+        before = {sheep['tag_number']: sheep for sheep in Sheep.objects.values(*fields)}
+        exported = self.export('sheep', 'csv')
+        self.assertEqual(set(columns) - set(exported.splitlines()[0].split(',')), set())
+        Sheep.objects.all().delete()
+        self.assertEqual(importer.import_file(StringIO(exported), 'sheep').errors, [])
+        after = {sheep['tag_number']: sheep for sheep in Sheep.objects.values(*fields)}
+        self.assertEqual(after, before)
+
+    def test_sheep_rows_carry_lineage_and_totals(self):
+        rows = [json.loads(line) for line in self.export('sheep', 'jsonl').splitlines()]
+        self.assertEqual([row['tag_number'] for row in rows], ['D1', 'L1', 'S1'])
+        lamb, dam = rows[1], rows[0]
+        self.assertEqual((lamb['mother'], lamb['father'], lamb['latest_health_type']), ('D1', 'S1', 'VACCINATION'))
+        self.assertEqual((dam['lambings'], dam['lambs_born'], dam['lambs_born_alive']), (1, 2, 1))
+        self.assertEqual(dam['weight_current'], 150.5)
+
+    def test_xlsx_is_a_workbook(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('flock-export', args=['health', 'xlsx']))
+        self.assertIn('attachment; filename="flock-health-', response['Content-Disposition'])
+        with zipfile.ZipFile(BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertIn('<sheet name="Health"', archive.read('xl/workbook.xml').decode())
+            sheet = archive.read('xl/worksheets/sheet1.xml').decode()
+        self.assertIn('<t xml:space="preserve">record_type</t>', sheet)
+        # 2024-04-01 as a spreadsheet date serial
+        self.assertIn('<c s="1"><v>45383</v></c>', sheet)
+        self.assertIn('<c t="b"><v>1</v></c>', sheet)
+
+    def test_unknown_export(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('flock-export', args=['breeds', 'csv'])).status_code, 404)
+
+
+@override_settings(CACHES=TEST_CACHES, SHEEP_RESPONSE_CACHE_TIMEOUT=600)
+class ResponseCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        breed = Breed.objects.create(name='Dorper')
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+        cls.ewe = make_sheep('E1', breed)
+        cls.ram = make_sheep('R1', breed, gender='M')
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def breed(self, ewe):
+        return BreedingRecord.objects.create(ewe=ewe, ram=self.ram, date_started=datetime.date(2024, 9, 1))
+
+    def test_only_the_saved_model_gets_a_new_version(self):
+        breeding, health = response_cache.version(BreedingRecord), response_cache.version(HealthRecord)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.breed(self.ewe)
+        self.assertEqual(response_cache.version(BreedingRecord), breeding)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(response_cache.version(BreedingRecord), breeding)
+        self.assertEqual(response_cache.version(HealthRecord), health)
+        self.assertEqual(len(response_cache.version(BreedingRecord, Sheep).split('.')), 2)
+
+    def test_lists_are_served_from_the_cache_until_a_change(self):
+        self.breed(self.ewe)
+        url = reverse('breeding-record-list')
+        _, first = count_queries(self.client, url)
+        response, cached = count_queries(self.client, url)
+        self.assertLess(cached, first)
+        self.assertNotContains(response, '>E2<')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.breed(make_sheep('E2', self.ram.breed))
+        self.assertContains(self.client.get(url), '>E2<')
+
+    @override_settings(SHEEP_RESPONSE_CACHE_TIMEOUT=0)
+    def test_lists_join_the_sheep_they_show(self):
+        self.breed(self.ewe)
+        LambingRecord.objects.create(ewe=self.ewe, date=datetime.date(2024, 3, 1))
+        few = {name: count_queries(self.client, reverse(name))[1] for name in ('breeding-record-list', 'lambing-record-list')}
+        for number in range(5):
+            ewe = make_sheep(f'E{number + 2}', self.ram.breed)
+            self.breed(ewe)
+            LambingRecord.objects.create(ewe=ewe, date=datetime.date(2024, 3, 1))
+        many = {name: count_queries(self.client, reverse(name))[1] for name in few}
+        self.assertEqual(many, few)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class DashboardTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dorper = Breed.objects.create(name='Dorper')
+        cls.katahdin = Breed.objects.create(name='Katahdin')
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+        cls.ewe = make_sheep('E1', cls.dorper)
+        cls.ram = make_sheep('R1', cls.dorper, gender='M')
+        make_sheep('E2', cls.katahdin)
+
+    def setUp(self):
+        dashboard.rebuild()
+
+    def stored(self):
+        return {name: value for name, value in FlockStat.objects.values_list('name', 'value') if value}
+
+    def assertMatchesRecount(self):
+        stored = self.stored()
+        self.assertEqual(stored, {name: value for name, value in dashboard.rebuild().items() if value})
+
+    def test_saves_move_counts(self):
+        today = datetime.date.today()
+        self.ewe.status = 'SOLD'
+        self.ewe.breed = self.katahdin
+        self.ewe.save()
+        lambing = LambingRecord.objects.create(ewe=self.ewe, date=today, total_born=2, born_alive=2)
+        lambing.born_alive = 1
+        lambing.save()
+        health = HealthRecord.objects.create(sheep=self.ram, date=today, record_type='ILLNESS', requires_followup=True)
+        BreedingRecord.objects.create(ewe=self.ewe, ram=self.ram, date_started=today, status='IN_PROGRESS')
+
+        summary = dashboard.summary(today=today)
+        self.assertEqual(summary['active'], 2)
+        self.assertEqual(summary['breeds'], [('Dorper', 1), ('Katahdin', 1)])
+        self.assertEqual((summary['lambings'], summary['lambs_born'], summary['lambs_alive']), (1, 2, 1))
+        self.assertEqual((summary['open_followups'], summary['pending_breedings']), (1, 1))
+        self.assertMatchesRecount()
+
+        health.requires_followup = False
+        health.save()
+        lambing.delete()
+        self.ram.delete()
+        summary = dashboard.summary(today=today)
+        self.assertEqual((summary['active'], summary['lambings'], summary['open_followups']), (1, 0, 0))
+        self.assertMatchesRecount()
+
+    def test_counts_rebuild_themselves_when_missing(self):
+        FlockStat.objects.all().delete()
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('home'))
+        self.assertEqual(response.context['dashboard']['active'], 3)
+        self.assertTrue(FlockStat.objects.filter(name=dashboard.BUILT).exists())
+
+    def test_saves_that_change_nothing_counted_write_nothing(self):
+        self.ewe.name = 'Clover'
+        with CaptureQueriesContext(connection) as captured:
+            dashboard.remember(self.ewe)
+            dashboard.saved(self.ewe)
+        self.assertEqual(len(captured), 1)
+        self.assertMatchesRecount()
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ProductivityTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        breed = Breed.objects.create(name='Dorper')
+        cls.ewe_a = make_sheep('A', breed)
+        cls.ewe_b = make_sheep('B', breed)
+        cls.ewe_c = make_sheep('C', breed, status='SOLD')
+        cls.ram_1 = make_sheep('R1', breed, gender='M')
+        cls.ram_2 = make_sheep('R2', breed, gender='M')
+        make_sheep('LAMB', breed, mother=cls.ewe_a, father=cls.ram_1)
+        for ewe, date, born, alive in [
+            (cls.ewe_a, datetime.date(2023, 3, 1), 2, 2),
+            (cls.ewe_a, datetime.date(2024, 3, 11), 3, 2),
+            (cls.ewe_b, datetime.date(2024, 3, 1), 1, 1),
+            (cls.ewe_c, datetime.date(2024, 3, 1), 3, 3),
+        ]:
+            LambingRecord.objects.create(ewe=ewe, date=date, total_born=born, born_alive=alive, born_dead=born - alive)
+        # Both breedings of ewe A fit her 2024 lambing; the later one gets the credit
+        for ewe, ram, started, status in [
+            (cls.ewe_a, cls.ram_2, datetime.date(2023, 9, 1), 'SUCCESSFUL'),
+            (cls.ewe_a, cls.ram_1, datetime.date(2023, 10, 1), 'SUCCESSFUL'),
+            (cls.ewe_b, cls.ram_2, datetime.date(2023, 10, 1), 'CANCELLED'),
+        ]:
+            BreedingRecord.objects.create(ewe=ewe, ram=ram, date_started=started, status=status)
+
+    def test_refresh(self):
+        self.assertIsNone(productivity.last_refreshed())
+        self.assertEqual(productivity.refresh(), 5)
+        rows = {row.sheep.tag_number: row for row in SheepProductivity.objects.select_related('sheep')}
+        a = rows['A']
+        self.assertEqual((a.lambings, a.lambs_born, a.lambs_alive, a.lambs_dead), (2, 5, 4, 1))
+        self.assertEqual((a.lambing_rate, a.survival_rate, a.lambing_interval), (2.5, 0.8, 376))
+        self.assertEqual((a.first_lambing, a.last_lambing), (datetime.date(2023, 3, 1), datetime.date(2024, 3, 11)))
+        # Active ewes by lambs alive per lambing; sold ones are not ranked
+        self.assertEqual((a.ewe_rank, rows['B'].ewe_rank, rows['C'].ewe_rank), (1, 2, None))
+        self.assertIsNone(rows['B'].lambing_interval)
+
+        r1, r2 = rows['R1'], rows['R2']
+        self.assertEqual((r1.progeny, r1.progeny_active, r1.ewes_bred), (1, 1, 1))
+        self.assertEqual((r1.sired_lambings, r1.sired_lambs_born, r1.sired_lambs_alive), (1, 3, 2))
+        self.assertAlmostEqual(r1.sired_survival_rate, 2 / 3)
+        self.assertEqual((r2.ewes_bred, r2.sired_lambings, r2.sired_survival_rate), (1, 0, None))
+        self.assertIsNotNone(productivity.last_refreshed())
+
+    def test_refresh_replaces_every_row(self):
+        productivity.refresh()
+        LambingRecord.objects.filter(ewe=self.ewe_b).delete()
+        productivity.refresh()
+        self.assertFalse(SheepProductivity.objects.filter(sheep=self.ewe_b).exists())
+        self.assertEqual(SheepProductivity.objects.get(sheep=self.ewe_c).lambings, 1)
+
+
+@override_settings(CACHES=TEST_CACHES, SHEEP_RESPONSE_CACHE_TIMEOUT=600, SHEEP_DETAIL_CACHE_TIMEOUT=600)
+class SyntheticFlockTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.report = synthetic.generate(sheep=80, years=3, health_per_year=1.0, seed=7)
+        cls.user = get_user_model().objects.create_superuser('admin', password='pw')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_generated_flock_is_consistent(self):
+        self.assertEqual(self.report.sheep, Sheep.objects.count())
+        self.assertEqual(self.report.lambing_records, LambingRecord.objects.count())
+        self.assertEqual(self.report.seasons, 4)
+        self.assertFalse(Sheep.objects.filter(mother__gender='M').exists())
+        self.assertFalse(Sheep.objects.filter(father__gender='F').exists())
+        self.assertTrue(Sheep.objects.filter(mother__isnull=False, father__isnull=False).exists())
+        stored = dict(FlockStat.objects.values_list('name', 'value'))
+        self.assertEqual({name: value for name, value in stored.items() if value},
+                         {name: value for name, value in dashboard.rebuild().items() if value})
+
+    def test_pages_are_timed_cold_warm_and_revalidated(self):
+        results = benchmark.run(self.user, repeat=2, names=['sheep-list', 'sheep-detail'])
+        self.assertEqual(list(results), ['sheep-list', 'sheep-detail'])
+        for name, result in results.items():
+            with self.subTest(route=name):
+                self.assertEqual({mode: result[mode]['status'] for mode in benchmark.MODES},
+                                 {'cold': 200, 'warm': 200, 'revalidated': 304})
+                self.assertLess(result['warm']['queries'], result['cold']['queries'])
+        results = benchmark.run(self.user, repeat=1, names=['sheep-list'], modes=('cold',))
+        self.assertEqual(set(results['sheep-list']), {'url', 'cold'})
+
+    def test_compare_checks_each_mode(self):
+        def timing(status=200, queries=5, p95_ms=10.0):
+            return {'status': status, 'queries': queries, 'p50_ms': p95_ms, 'p95_ms': p95_ms, 'max_ms': p95_ms}
+
+        baseline = {'results': {
+            'sheep-list': {'url': '/', 'cold': timing(), 'warm': timing(queries=3), 'revalidated': timing(304, 2)},
+            'sheep-detail': {'url': None, 'skipped': 'no sample data'},
+        }}
+        results = {
+            'sheep-list': {'url': '/', 'cold': timing(p95_ms=100.0), 'warm': timing(queries=4),
+                           'revalidated': timing(200, 2, p95_ms=12.0)},
+            'sheep-detail': {'url': '/1/', 'cold': timing()},
+        }
+        self.assertEqual(benchmark.compare(results, baseline), [
+            'sheep-list (cold): p95 10.0 -> 100.0 ms',
+            'sheep-list (warm): 3 -> 4 queries',
+            'sheep-list (revalidated): status 304 -> 200',
+        ])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class RequestMetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = get_user_model().objects.create_user('boss', password='pw', is_staff=True)
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+
+    def test_statements_grouped_by_shape(self):
+        self.assertEqual(middleware.sql_shape('SELECT * FROM t WHERE id IN (%s, %s, %s)'),
+                         'SELECT * FROM t WHERE id IN (...)')
+        self.assertEqual(middleware.sql_preview('SELECT a, b, c FROM t WHERE x = %s'), 'SELECT ... FROM t WHERE x = %s')
+        metrics = middleware.RequestMetrics()
+        metrics.statements = [
+            ('SELECT 1 FROM t WHERE id IN (%s)', 0.001),
+            ('SELECT 1 FROM t WHERE id IN (%s, %s)', 0.003),
+            ('SELECT 2', 0.002),
+        ]
+        self.assertEqual(metrics.repeated(2), [('SELECT 1 FROM t WHERE id IN (...)', 2)])
+        self.assertEqual([sql for sql, _ in metrics.slowest(2)], ['SELECT 1 FROM t WHERE id IN (%s, %s)', 'SELECT 2'])
+
+    def test_staff_get_a_server_timing_header(self):
+        self.client.force_login(self.user)
+        self.assertFalse(self.client.get(reverse('home')).has_header('Server-Timing'))
+        self.client.force_login(self.staff)
+        header = self.client.get(reverse('home'))['Server-Timing']
+        self.assertRegex(header, r'^sql;dur=[0-9.]+;desc="\d+ queries", render;dur=[0-9.]+;desc="Templates", total;dur=')
+
+    @override_settings(SHEEP_SLOW_REQUEST_MS=0)
+    def test_slow_requests_are_logged(self):
+        self.client.force_login(self.user)
+        with self.assertLogs('sheep.requests', 'WARNING') as logs:
+            self.client.get(reverse('home'), {'page': '1'})
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertEqual((entry['path'], entry['status'], entry['user'], entry['slow']),
+                         ('/?page=1', 200, self.user.pk, True))
+        self.assertEqual(len(entry['slowest']), min(entry['queries'], middleware.SLOWEST_STATEMENTS))
+
+
+@override_settings(CACHES=TEST_CACHES, SHEEP_PROFILE_KEEP=2)
+class RequestProfileTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = get_user_model().objects.create_user('boss', password='pw', is_staff=True)
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(SHEEP_PROFILE_DIR=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_only_staff_are_profiled(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('home'), {'profile': '1'})
+        self.assertFalse(response.has_header('X-Profile'))
+        self.assertEqual(profiling.list_profiles(), [])
+
+    def test_profiles_are_stored_and_shown(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('home'), HTTP_X_PROFILE='1')
+        [profile] = profiling.list_profiles()
+        self.assertEqual(response['X-Profile'], f"http://testserver{reverse('profile-detail', args=[profile['id']])}")
+        self.assertEqual((profile['path'], profile['status'], profile['user']), ('/', 200, 'boss'))
+
+        response = self.client.get(reverse('profile-detail', args=[profile['id']]), {'sort': 'tottime'})
+        self.assertEqual(response.context['sort'], 'tottime')
+        self.assertTrue(response.context['rows'])
+        response = self.client.get(reverse('profile-download', args=[profile['id']]))
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        self.assertEqual(self.client.get(reverse('profile-detail', args=['..etc'])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('profile-detail', args=['20240101-000000-00000000'])).status_code, 404)
+
+    def test_only_the_newest_are_kept(self):
+        self.client.force_login(self.staff)
+        ids = [self.client.get(reverse('home'), {'profile': '1'})['X-Profile'].rstrip('/').rsplit('/', 1)[1]
+               for _ in range(3)]
+        self.assertEqual(sorted(profile['id'] for profile in profiling.list_profiles()), sorted(ids)[1:])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ApiTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.breed = Breed.objects.create(name='Dorper')
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+        cls.ewe = make_sheep('E1', cls.breed)
+        cls.ram = make_sheep('R1', cls.breed, gender='M')
+        cls.lambs = [make_sheep(f'L{number}', cls.breed, mother=cls.ewe, father=cls.ram) for number in range(5)]
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_anonymous_requests_get_a_json_401(self):
+        self.client.logout()
+        response = self.client.get(reverse('api-sheep-list'))
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json(), {'error': 'Authentication required'})
+
+    def test_pages_follow_the_next_and_previous_links(self):
+        url, tags = f"{reverse('api-sheep-list')}?fields=tag_number&sort=tag_number&limit=3", []
+        while url:
+            page = self.client.get(url).json()
+            tags += [row['tag_number'] for row in page['results']]
+            last, url = page, page['next']
+        self.assertEqual(tags, sorted(Sheep.objects.values_list('tag_number', flat=True)))
+        previous = self.client.get(last['previous']).json()
+        self.assertEqual([row['tag_number'] for row in previous['results']], tags[-4:-1])
+
+    def test_fields_and_expanded_relations(self):
+        url = f"{reverse('api-sheep-list')}?fields=tag_number&expand=mother,father&gender=F&limit=10"
+        response, queries = count_queries(self.client, url)
+        rows = response.json()['results']
+        self.assertEqual(len(rows), 1 + len(self.lambs))
+        lamb = next(row for row in rows if row['tag_number'] == 'L0')
+        self.assertEqual(set(lamb), {'tag_number', 'mother', 'father'})
+        self.assertEqual(lamb['mother']['tag_number'], 'E1')
+        self.assertEqual(lamb['father']['gender'], 'M')
+
+        # The related sheep are read in one query for the page, not per row
+        more = make_sheep('L9', self.breed, mother=self.ewe, father=self.ram)
+        self.addCleanup(more.delete)
+        self.assertEqual(count_queries(self.client, url)[1], queries)
+
+    def test_one_row(self):
+        response = self.client.get(reverse('api-sheep-detail', args=[self.ewe.pk]), {'fields': 'id,tag_number'})
+        self.assertEqual(response.json(), {'id': self.ewe.pk, 'tag_number': 'E1'})
+        self.assertEqual(self.client.get(reverse('api-sheep-detail', args=[0])).status_code, 404)
+
+    def test_bad_requests_are_explained(self):
+        for params in ({'fields': 'tag_number,secret'}, {'expand': 'notes'}, {'limit': '0'},
+                       {'sort': 'name'}, {'after': 'garbage'}, {'gender': 'X'}):
+            response = self.client.get(reverse('api-sheep-list'), params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('error', response.json())
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SyncTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.breed = Breed.objects.create(name='Dorper')
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+        cls.ewe = make_sheep('E1', cls.breed)
+        cls.ram = make_sheep('R1', cls.breed, gender='M')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def new_sheep(self, tag, **fields):
+        return {'tag_number': tag, 'gender': 'F', 'breed': self.breed.pk, 'status': 'ACTIVE',
+                'body_type': 'GOOD', 'udder_type': 'GOOD', 'feet_type': 'GOOD', **fields}
+
+    def post(self, *edits):
+        return self.client.post(reverse('api-changes'), json.dumps({'edits': edits}), content_type='application/json')
+
+    def test_the_feed_returns_each_change_once(self):
+        feed = self.client.get(reverse('api-changes')).json()
+        self.assertEqual({row['tag_number'] for row in feed['changed']['sheep']}, {'E1', 'R1'})
+        self.assertFalse(feed['more'])
+
+        self.ewe.name = 'Daisy'
+        self.ewe.save()
+        ram_id = self.ram.pk
+        self.ram.delete()
+        feed = self.client.get(reverse('api-changes'), {'since': feed['cursor']}).json()
+        [row] = feed['changed']['sheep']
+        self.assertEqual((row['name'], row['version']), ('Daisy', sync.version(Sheep, self.ewe.pk)))
+        self.assertEqual([tombstone['id'] for tombstone in feed['deleted']['sheep']], [ram_id])
+
+        feed = self.client.get(reverse('api-changes'), {'since': feed['cursor']}).json()
+        self.assertEqual((feed['changed'], feed['deleted']), ({}, {}))
+        self.assertEqual(self.client.get(reverse('api-changes'), {'since': 'x'}).status_code, 400)
+
+    def test_pages_of_changes(self):
+        feeds, cursor, more = [], 0, True
+        while more:
+            feeds.append(self.client.get(reverse('api-changes'), {'since': cursor, 'limit': 1}).json())
+            cursor, more = feeds[-1]['cursor'], feeds[-1]['more']
+        # The breed and both sheep, one per page
+        self.assertEqual(len(feeds), 3)
+        ids = [row['id'] for feed in feeds for row in feed['changed'].get('sheep', [])]
+        self.assertCountEqual(ids, [self.ewe.pk, self.ram.pk])
+
+    def test_a_batch_can_refer_to_rows_it_creates(self):
+        response = self.post(
+            {'kind': 'sheep', 'ref': 'lamb', 'fields': self.new_sheep('L1', mother=self.ewe.pk)},
+            {'kind': 'health', 'fields': {'sheep': {'ref': 'lamb'}, 'date': '2024-03-01', 'record_type': 'VACCINATION'}},
+        )
+        self.assertEqual(response.status_code, 200)
+        lamb = Sheep.objects.get(tag_number='L1')
+        self.assertEqual([result['status'] for result in response.json()['results']], ['ok', 'ok'])
+        self.assertEqual(response.json()['results'][0]['version'], sync.version(Sheep, lamb.pk))
+        self.assertTrue(HealthRecord.objects.filter(sheep=lamb).exists())
+
+    def test_a_conflict_saves_nothing(self):
+        stale = sync.version(Sheep, self.ewe.pk)
+        self.ewe.name = 'Daisy'
+        self.ewe.save()
+        response = self.post(
+            {'kind': 'sheep', 'fields': self.new_sheep('L1')},
+            {'kind': 'sheep', 'id': self.ewe.pk, 'version': stale, 'fields': {'name': 'Clover'}},
+        )
+        self.assertEqual(response.status_code, 409)
+        created, conflict = response.json()['results']
+        self.assertEqual(created['status'], 'valid')
+        self.assertEqual(conflict['status'], 'conflict')
+        self.assertEqual(conflict['current']['name'], 'Daisy')
+        self.assertFalse(Sheep.objects.filter(tag_number='L1').exists())
+        self.assertEqual(Sheep.objects.get(pk=self.ewe.pk).name, 'Daisy')
+
+        response = self.post({'kind': 'sheep', 'id': self.ewe.pk, 'version': sync.version(Sheep, self.ewe.pk),
+                              'fields': {'gender': 'X'}})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('gender', response.json()['results'][0]['errors'])
+
+    def test_planned_breedings_are_in_the_feed(self):
+        cursor = self.client.get(reverse('api-changes')).json()['cursor']
+        [record] = breeding_plan.create_breeding_records([(self.ewe.pk, self.ram.pk)], datetime.date(2024, 9, 1))
+        feed = self.client.get(reverse('api-changes'), {'since': cursor}).json()
+        self.assertEqual([row['id'] for row in feed['changed']['breeding']], [record.pk])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.breed = Breed.objects.create(name='Dorper')
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+        cls.ewe = make_sheep('E1', cls.breed)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def fetch(self, url):
+        # The first page sets the CSRF cookie, which the ETag of later ones depends on
+        self.client.get(url)
+        return self.client.get(url)
+
+    def revalidate(self, url, response):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_unchanged_pages_are_not_sent_again(self):
+        url = reverse('sheep-detail', args=[self.ewe.pk])
+        response = self.fetch(url)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('no-cache', response['Cache-Control'])
+        cache.clear()
+        _, full = count_queries(self.client, url)
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(self.revalidate(url, response).status_code, 304)
+        # The stamp's queries, not the page's own
+        self.assertLess(len(captured), full)
+
+        self.ewe.name = 'Daisy'
+        self.ewe.save()
+        changed = self.revalidate(url, response)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+
+    def test_lists_revalidate_by_date(self):
+        url = reverse('sheep-list')
+        response = self.fetch(url)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        self.assertEqual(self.revalidate(url, response).status_code, 304)
+        make_sheep('E2', self.breed)
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+    def test_logging_in_again_gets_a_fresh_page(self):
+        url = reverse('sheep-detail', args=[self.ewe.pk])
+        response = self.fetch(url)
+        self.client.post(reverse('login'), {'username': 'shepherd', 'password': 'pw'})
+        # The copy from before holds a CSRF token that is no longer good
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+    @override_settings(SHEEP_CONDITIONAL_GET=False)
+    def test_can_be_turned_off(self):
+        response = self.client.get(reverse('sheep-detail', args=[self.ewe.pk]))
+        self.assertFalse(response.has_header('ETag'))
+
+
+@override_settings(SHEEP_SQLITE_LOCK_RETRIES=2)
+@mock.patch('sheep.sqlite.time.sleep')
+class SqliteRetryTests(SimpleTestCase):
+    def run_statement(self, *outcomes, in_atomic_block=False):
+        """Run a statement whose executions fail or return in turn; returns (result, executions)"""
+        outcomes = list(outcomes)
+
+        def execute(sql, params, many, context):
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        context = {'connection': SimpleNamespace(in_atomic_block=in_atomic_block)}
+        total = len(outcomes)
+        try:
+            result = sqlite.retry_locked(execute, 'UPDATE sheep_sheep SET name = %s', ['Daisy'], False, context)
+        finally:
+            executions = total - len(outcomes)
+        return result, executions
+
+    def test_locked_statements_are_run_again(self, sleep):
+        locked = OperationalError('database is locked')
+        self.assertEqual(self.run_statement(locked, locked, 'done'), ('done', 3))
+        self.assertEqual(sleep.call_count, 2)
+        # Each wait is twice the last, give or take a half
+        for attempt, call in enumerate(sleep.call_args_list):
+            self.assertTrue(0.5 <= call.args[0] / (sqlite.BACKOFF * 2 ** attempt) <= 1.5)
+
+    def test_retries_run_out(self, sleep):
+        locked = OperationalError('database is locked')
+        with self.assertRaises(OperationalError):
+            self.run_statement(locked, locked, locked, 'never')
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_other_errors_are_not_retried(self, sleep):
+        with self.assertRaisesMessage(OperationalError, 'no such table'):
+            self.run_statement(OperationalError('no such table: sheep_flock'), 'never')
+        sleep.assert_not_called()
+
+    def test_statements_inside_a_transaction_are_not_retried(self, sleep):
+        with self.assertRaises(OperationalError):
+            self.run_statement(OperationalError('database is locked'), 'never', in_atomic_block=True)
+        sleep.assert_not_called()
+
+
+class BackupTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings_override = override_settings(SHEEP_BACKUP_DIR=os.path.join(self.directory, 'backups'), SHEEP_BACKUP_KEEP=2)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.database = os.path.join(self.directory, 'flock.sqlite3')
+        database = sqlite3.connect(self.database)
+        database.executescript("CREATE TABLE sheep (tag TEXT); INSERT INTO sheep VALUES ('E1'), ('E2');")
+        database.close()
+        databases = mock.patch.dict(connections.settings, {
+            'flock': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': self.database},
+            'copy': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(self.directory, 'copy.sqlite3')},
+            'elsewhere': {'ENGINE': 'django.db.backends.postgresql', 'NAME': 'flock'},
+        })
+        databases.start()
+        self.addCleanup(databases.stop)
+
+    def test_backups_are_whole_checked_copies(self):
+        result = backup.backup('flock', pages=1)
+        self.assertEqual(list(backup.list_backups('flock')), [result['path']])
+        restored = os.path.join(self.directory, 'restored.sqlite3')
+        with gzip.open(result['path']) as source, open(restored, 'wb') as target:
+            target.write(source.read())
+        database = sqlite3.connect(restored)
+        self.addCleanup(database.close)
+        self.assertEqual(database.execute('SELECT tag FROM sheep ORDER BY tag').fetchall(), [('E1',), ('E2',)])
+        self.assertEqual(backup.check_integrity(restored), [])
+        # Only the gzipped copy is left behind
+        self.assertEqual(os.listdir(backup.backup_dir()), [os.path.basename(result['path'])])
+
+    def test_only_the_newest_are_kept(self):
+        os.makedirs(backup.backup_dir())
+        names = [f'flock-2024010{day}-000000.sqlite3.gz' for day in range(1, 5)] + ['other-20240101-000000.sqlite3.gz']
+        for name in names:
+            open(os.path.join(backup.backup_dir(), name), 'wb').close()
+        backup.rotate('flock')
+        self.assertEqual(sorted(os.listdir(backup.backup_dir())), sorted(names[2:]))
+
+    def test_databases_that_cannot_be_backed_up(self):
+        for alias, message in (('nowhere', 'No database called'), ('elsewhere', 'not a SQLite database'),
+                               ('copy', 'has no database file')):
+            with self.assertRaisesMessage(backup.BackupError, message):
+                backup.backup(alias)
+
+    def test_clones_refuse_to_overwrite_production(self):
+        with mock.patch.dict(connections.settings, {'production': connections.settings['copy']}):
+            with self.assertRaisesMessage(backup.BackupError, 'without force'):
+                backup.clone('flock', 'production')
+        with self.assertRaisesMessage(backup.BackupError, 'the same database'):
+            backup.clone('flock', 'flock')
+
+
+@override_settings(CACHES=TEST_CACHES, SHEEP_TASKS_EAGER=False)
+class TaskTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+
+    def setUp(self):
+        self.calls = []
+
+        def count(progress, fail=0):
+            self.calls.append(fail)
+            progress(len(self.calls), 2, message="Counting")
+            if len(self.calls) <= fail:
+                raise RuntimeError("Not yet")
+            return {'calls': len(self.calls)}
+
+        original = dict(tasks.TASKS)
+        self.addCleanup(lambda: (tasks.TASKS.clear(), tasks.TASKS.update(original)))
+        tasks.register('count', 'Counting', priority=1, max_attempts=2)(count)
+        tasks.register('urgent', 'Counting first', priority=9)(count)
+
+    def test_due_tasks_run_highest_priority_first(self):
+        later = tasks.enqueue('urgent', delay=60)
+        routine = tasks.enqueue('count')
+        urgent = tasks.enqueue('urgent')
+        self.assertEqual(tasks.claim('worker'), urgent)
+        self.assertEqual(tasks.claim('worker'), routine)
+        self.assertIsNone(tasks.claim('worker'))
+        self.assertEqual(Task.objects.get(pk=later.pk).status, 'QUEUED')
+
+    def test_unique_tasks_are_queued_once(self):
+        first = tasks.enqueue('count', {'fail': 0}, unique=True)
+        self.assertEqual(tasks.enqueue('count', {'fail': 0}, unique=True), first)
+        self.assertNotEqual(tasks.enqueue('count', {'fail': 1}, unique=True), first)
+        with self.assertRaisesMessage(ValueError, "No task called 'shear'"):
+            tasks.enqueue('shear')
+
+    def test_failed_tasks_are_retried_later_then_given_up(self):
+        queued = tasks.enqueue('count', {'fail': 5})
+        with self.assertLogs('sheep.tasks', 'WARNING'):
+            tasks.execute(tasks.claim('worker'))
+        task = Task.objects.get(pk=queued.pk)
+        self.assertEqual((task.status, task.attempts), ('QUEUED', 1))
+        self.assertIn('RuntimeError: Not yet', task.error)
+        self.assertGreater(task.run_after, timezone.now() + datetime.timedelta(seconds=tasks.RETRY_DELAY - 5))
+        self.assertIsNone(tasks.claim('worker'))
+
+        Task.objects.filter(pk=task.pk).update(run_after=timezone.now())
+        with self.assertLogs('sheep.tasks', 'WARNING'):
+            tasks.execute(tasks.claim('worker'))
+        task = Task.objects.get(pk=queued.pk)
+        self.assertEqual((task.status, task.attempts), ('FAILED', 2))
+        self.assertIsNotNone(task.finished_at)
+
+    @override_settings(SHEEP_TASKS_EAGER=True)
+    def test_eager_tasks_are_finished_when_queued(self):
+        with self.assertLogs('sheep.tasks', 'WARNING'):
+            task = tasks.enqueue('count', {'fail': 1}, user=self.user)
+        self.assertEqual((task.status, task.attempts, task.result), ('SUCCEEDED', 2, {'calls': 2}))
+        self.assertEqual((task.progress_done, task.progress_total, task.progress_message), (2, 2, "Counting"))
+
+        self.client.force_login(self.user)
+        status = self.client.get(reverse('api-task-detail', args=[task.pk])).json()
+        self.assertEqual((status['status'], status['label'], status['progress']['percent']), ('SUCCEEDED', 'Counting', 100))
+
+    def test_tasks_of_dead_workers_are_tried_again(self):
+        task = tasks.enqueue('count')
+        tasks.claim('worker')
+        Task.objects.filter(pk=task.pk).update(heartbeat_at=timezone.now() - datetime.timedelta(hours=2))
+        self.assertEqual(tasks.requeue_stale(), 1)
+        self.assertEqual(Task.objects.get(pk=task.pk).status, 'QUEUED')
+
+    def test_old_finished_tasks_are_deleted(self):
+        old, recent = tasks.enqueue('count'), tasks.enqueue('count')
+        Task.objects.update(status='SUCCEEDED', finished_at=timezone.now())
+        Task.objects.filter(pk=old.pk).update(finished_at=timezone.now() - datetime.timedelta(days=30))
+        self.assertEqual(tasks.prune(), 1)
+        self.assertEqual(list(Task.objects.values_list('pk', flat=True)), [recent.pk])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BulkTreatmentTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.breed = Breed.objects.create(name='Dorper')
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+        for tag in ('E1', 'E2', 'E3'):
+            make_sheep(tag, cls.breed)
+        make_sheep('S1', cls.breed, status='SOLD')
+
+    def setUp(self):
+        cache.clear()
+        dashboard.rebuild()
+        self.client.force_login(self.user)
+
+    def treatment(self, **fields):
+        return {'date': '2024-03-01', 'record_type': 'PARASITE_TREATMENT', 'treatment': 'Ivermectin drench',
+                'status': 'ACTIVE', **fields}
+
+    def test_listed_tags_are_checked(self):
+        response = self.client.post(reverse('health-record-bulk'), self.treatment(tags='E1, S1 X9'))
+        errors = response.context['form'].errors['tags']
+        self.assertEqual(errors, ["Not in the flock: X9", "Left out by the status, breed or birth year chosen: S1 (Sold)"])
+        self.assertFalse(HealthRecord.objects.exists())
+
+    def test_preview_saves_nothing(self):
+        response = self.client.post(reverse('health-record-bulk'), self.treatment(preview='1'))
+        self.assertEqual(response.context['count'], 3)
+        self.assertEqual([tag for tag, _ in response.context['preview']], ['E1', 'E2', 'E3'])
+        self.assertFalse(HealthRecord.objects.exists())
+
+    def test_every_selected_sheep_is_treated(self):
+        cursor = sync.changes()['cursor']
+        response = self.client.post(reverse('health-record-bulk'), self.treatment(requires_followup='on'))
+        self.assertRedirects(response, f"{reverse('health-record-list')}?record_type=PARASITE_TREATMENT",
+                             fetch_redirect_response=False)
+        records = HealthRecord.objects.order_by('sheep__tag_number')
+        self.assertEqual([record.sheep.tag_number for record in records], ['E1', 'E2', 'E3'])
+        self.assertEqual({record.treatment for record in records}, {'Ivermectin drench'})
+
+        # What the signals would have done for each record
+        stored = {name: value for name, value in FlockStat.objects.values_list('name', 'value') if value}
+        self.assertEqual(stored, {name: value for name, value in dashboard.rebuild().items() if value})
+        self.assertEqual(dashboard.summary()['open_followups'], 3)
+        self.assertCountEqual([row['id'] for row in sync.changes(cursor)['changed']['health']],
+                              records.values_list('pk', flat=True))
+        results, _ = search.search('drench')
+        self.assertEqual(len(results), 3)
+
+    def test_sheep_changed_after_the_check_stop_the_batch(self):
+        Sheep.objects.filter(tag_number='E2').update(status='SOLD')
+        with self.assertRaisesMessage(bulk.BulkError, "E2 (Sold)"):
+            bulk.treat_selection(self.treatment(), status='ACTIVE', tags=['E1', 'E2'])
+        self.assertFalse(HealthRecord.objects.exists())
+        self.assertEqual(bulk.parse_tags('E1,E2;\nE1  E3'), ['E1', 'E2', 'E3'])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SheepBulkActionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.breed = Breed.objects.create(name='Dorper')
+        cls.user = get_user_model().objects.create_user('shepherd', password='pw')
+        cls.ewe = make_sheep('E1', cls.breed, date_of_birth=datetime.date(2020, 4, 1))
+        cls.lambs = [make_sheep(f'L{number}', cls.breed, mother=cls.ewe, date_of_birth=datetime.date(2023, 4, 1))
+                     for number in range(3)]
+
+    def setUp(self):
+        cache.clear()
+        dashboard.rebuild()
+        self.client.force_login(self.user)
+
+    def act(self, action, sheep, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('sheep-bulk-action'), {
+                'action': action, 'sheep': [animal.pk for animal in sheep], 'next': reverse('sheep-list'), **fields,
+            }, follow=True)
+
+    def test_selling_a_batch(self):
+        cursor = sync.changes()['cursor']
+        self.client.get(reverse('sheep-detail', args=[self.ewe.pk]))
+        response = self.act('SOLD', self.lambs[:2], date='2024-05-01', reason='Sale barn')
+        self.assertContains(response, "2 sheep marked as sold.")
+        sold = Sheep.objects.filter(status='SOLD')
+        self.assertEqual(list(sold.values_list('tag_number', 'date_removed', 'removal_reason')), [
+            ('L0', datetime.date(2024, 5, 1), 'Sale barn'), ('L1', datetime.date(2024, 5, 1), 'Sale barn'),
+        ])
+        # The dashboard, the change feed and the mother's cached page all see the sale
+        self.assertEqual(dashboard.summary()['active'], 2)
+        stored = {name: value for name, value in FlockStat.objects.values_list('name', 'value') if value}
+        self.assertEqual(stored, {name: value for name, value in dashboard.rebuild().items() if value})
+        self.assertCountEqual([row['id'] for row in sync.changes(cursor)['changed']['sheep']],
+                              [lamb.pk for lamb in self.lambs[:2]])
+        self.assertEqual(self.client.get(reverse('sheep-detail', args=[self.ewe.pk])).content.count(b'Sold'), 2)
+
+    def test_one_problem_stops_the_batch(self):
+        Sheep.objects.filter(pk=self.lambs[0].pk).update(status='SOLD')
+        response = self.act('CULLED', self.lambs)
+        self.assertContains(response, "Only active sheep can be removed from the flock: L0")
+        response = self.act('SOLD', self.lambs[1:], date='2022-01-01')
+        self.assertContains(response, "Born after Jan 01, 2022: L1, L2")
+        self.assertEqual(Sheep.objects.filter(status='ACTIVE').count(), 3)
+
+    def test_the_check_and_the_update_share_one_transaction(self):
+        open_savepoints = {}
+
+        def recording(name, function):
+            def wrapper(*args, **kwargs):
+                open_savepoints[name] = list(connection.savepoint_ids)
+                return function(*args, **kwargs)
+            return wrapper
+
+        baseline = list(connection.savepoint_ids)
+        with mock.patch('sheep.bulk.problems', recording('check', bulk.problems)), \
+                mock.patch('sheep.bulk.update_sheep', recording('update', bulk.update_sheep)):
+            bulk.apply_action([lamb.pk for lamb in self.lambs], 'SOLD')
+        self.assertGreater(len(open_savepoints['check']), len(baseline))
+        self.assertEqual(open_savepoints['update'], open_savepoints['check'])
+
+    def test_returning_to_active_and_cull_flags(self):
+        Sheep.objects.filter(pk__in=[self.lambs[0].pk, self.lambs[1].pk]).update(status='SOLD')
+        Sheep.objects.filter(pk=self.lambs[2].pk).update(status='DECEASED')
+        response = self.act('ACTIVE', self.lambs)
+        self.assertContains(response, "3 sheep returned to active (previously 1 deceased, 2 sold).")
+        self.act('flag-cull', self.lambs[:1], reason='Poor feet')
+        self.assertEqual(list(Sheep.objects.filter(cull_candidate=True).values_list('tag_number', 'cull_reason')),
+                         [('L0', 'Poor feet')])
+        response = self.act('clear-cull', self.lambs[:2])
+        self.assertContains(response, "Not flagged for culling: L1")
+
+    def test_the_cached_list_holds_no_visitors_csrf_token(self):
+        self.client.get(reverse('sheep-list'))
+        other = get_user_model().objects.create_user('helper', password='pw')
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(other)
+        page = client.get(reverse('sheep-list')).content.decode()
+        tokens = set(re.findall(r'name="csrfmiddlewaretoken" value="([^"]+)"', page))
+        self.assertTrue(tokens)
+        for token in tokens:
+            response = client.post(reverse('sheep-bulk-action'), {'csrfmiddlewaretoken': token})
+            self.assertEqual(response.status_code, 302)
@@ -0,0 +1,100 @@
+"""
+Resized copies of uploaded sheep and lambing photos.
+
+Every original gets a JPEG and a WebP derivative at each width in
+THUMBNAIL_WIDTHS, stored next to it under a `derivatives/` folder:
+
+    sheep_images/3f2a....jpg
+    sheep_images/derivatives/3f2a...-640w.jpg
+    sheep_images/derivatives/3f2a...-640w.webp
+
+Templates list them in a srcset (see the responsive_image tag) so browsers
+download the smallest copy that fills the slot instead of the phone original.
+"""
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+from .models import Sheep, SheepImage, LambingRecord, LambingImage
+
+THUMBNAIL_WIDTHS = (320, 640, 1280)
+
+# Pillow save options per derivative format
+FORMATS = {
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+}
+
+# Image fields that get derivatives
+IMAGE_FIELDS = (
+    (Sheep, 'primary_image'),
+    (SheepImage, 'image'),
+    (LambingRecord, 'primary_image'),
+    (LambingImage, 'image'),
+)
+
+
+def derivative_name(name, width, ext):
+    """Storage name of one derivative of the original stored as `name`"""
+    folder, filename = os.path.split(name)
+    stem = os.path.splitext(filename)[0]
+    return os.path.join(folder, 'derivatives', f'{stem}-{width}w.{ext}')
+
+
+def has_derivatives(field_file):
+    """True if the smallest derivative exists, which is written last"""
+    if not field_file:
+        return False
+    return field_file.storage.exists(derivative_name(field_file.name, THUMBNAIL_WIDTHS[0], 'webp'))
+
+
+def generate_derivatives(storage, name, force=False):
+    """
+    Write every derivative of one stored original; returns how many were written.
+
+    Widths are produced largest first, each resized from the previous one,
+    and JPEG decoding is scaled down up front, so a 20 MB photo is never
+    handled at full resolution more than once.
+    """
+    if not force and storage.exists(derivative_name(name, THUMBNAIL_WIDTHS[0], 'webp')):
+        return 0
+    with storage.open(name, 'rb') as original:
+        image = Image.open(original)
+        # Let the JPEG decoder skip detail that no derivative will keep
+        image.draft('RGB', (max(THUMBNAIL_WIDTHS), max(THUMBNAIL_WIDTHS)))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGB')
+
+    written = 0
+    for width in sorted(THUMBNAIL_WIDTHS, reverse=True):
+        if image.width > width:
+            image.thumbnail((width, image.height), Image.LANCZOS)
+        # webp is saved after jpg so has_derivatives only sees finished sets
+        for ext, (pil_format, options) in FORMATS.items():
+            buffer = BytesIO()
+            image.save(buffer, pil_format, **options)
+            target = derivative_name(name, width, ext)
+            if storage.exists(target):
+                storage.delete(target)
+            storage.save(target, ContentFile(buffer.getvalue()))
+            written += 1
+    return written
+
+
+def delete_derivatives(storage, name):
+    """Remove every derivative of one stored original, once it is replaced or its row deleted"""
+    for width in THUMBNAIL_WIDTHS:
+        for ext in FORMATS:
+            target = derivative_name(name, width, ext)
+            if storage.exists(target):
+                storage.delete(target)
+
+
+def srcset(field_file, ext):
+    """srcset attribute value listing every derivative of an image in one format"""
+    return ', '.join(
+        f'{field_file.storage.url(derivative_name(field_file.name, width, ext))} {width}w'
+        for width in THUMBNAIL_WIDTHS
+    )
@@ -12,10 +12,13 @@ urlpatterns = [
     # Sheep URLs
     path('sheep/', views.SheepListView.as_view(), name='sheep-list'),
     path('sheep/new/', views.SheepCreateView.as_view(), name='sheep-create'),
+    path('sheep/bulk/', views.sheep_bulk_action, name='sheep-bulk-action'),
     path('sheep/<int:pk>/', views.SheepDetailView.as_view(), name='sheep-detail'),
     path('sheep/<int:pk>/edit/', views.SheepUpdateView.as_view(), name='sheep-update'),
     path('sheep/<int:pk>/delete/', views.SheepDeleteView.as_view(), name='sheep-delete'),
     path('sheep/<int:pk>/add-image/', views.SheepImageCreateView.as_view(), name='sheep-add-image'),
+    path('sheep/<int:pk>/pedigree/', views.SheepPedigreeView.as_view(), name='sheep-pedigree'),
+    path('sheep/<int:pk>/descendants.csv', views.sheep_descendants_export, name='sheep-descendants-export'),
     
     # Sheep Image URLs
     path('sheep/images/<int:pk>/delete/', views.SheepImageDeleteView.as_view(), name='sheep-delete-image'),
@@ -27,6 +30,9 @@ urlpatterns = [
     path('breeding/<int:pk>/edit/', views.BreedingRecordUpdateView.as_view(), name='breeding-record-update'),
     path('breeding/<int:pk>/delete/', views.BreedingRecordDeleteView.as_view(), name='breeding-record-delete'),
     path('breeding/<int:pk>/duplicate/', views.duplicate_breeding_record, name='breeding-record-duplicate'),
+    path('breeding/plan/', views.BreedingPlanView.as_view(), name='breeding-plan'),
+    path('breeding/kinship/', views.MatingKinshipView.as_view(), name='mating-kinship'),
+    path('breeding/expected-inbreeding/', views.expected_inbreeding, name='expected-inbreeding'),
     path('sheep/<int:pk>/breeding-record/create/', views.EweBreedingRecordCreateView.as_view(), name='ewe-breeding-record-create'),
     
     # Lambing Record URLs
@@ -37,6 +43,7 @@ urlpatterns = [
     path('lambing/<int:pk>/delete/', views.LambingRecordDeleteView.as_view(), name='lambing-record-delete'),
     path('lambing/<int:pk>/add-image/', views.LambingImageCreateView.as_view(), name='lambing-add-image'),
     path('sheep/<int:pk>/lambing-record/create/', views.EweLambingRecordCreateView.as_view(), name='ewe-lambing-record-create'),
+    path('lambing/productivity/', views.ProductivityView.as_view(), name='productivity'),
     
     # Lambing Image URLs
     path('lambing/images/<int:pk>/delete/', views.LambingImageDeleteView.as_view(), name='lambing-delete-image'),
@@ -44,6 +51,7 @@ urlpatterns = [
     # Health Record URLs
     path('health/', views.HealthRecordListView.as_view(), name='health-record-list'),
     path('health/new/', views.HealthRecordCreateView.as_view(), name='health-record-create'),
+    path('health/bulk/', views.BulkTreatmentView.as_view(), name='health-record-bulk'),
     path('health/<int:pk>/', views.HealthRecordDetailView.as_view(), name='health-record-detail'),
     path('health/<int:pk>/edit/', views.HealthRecordUpdateView.as_view(), name='health-record-update'),
     path('health/<int:pk>/delete/', views.HealthRecordDeleteView.as_view(), name='health-record-delete'),
@@ -53,4 +61,37 @@ urlpatterns = [
     
     # Sheep birth year list URL
     path('sheep/by-birth-year/', views.SheepBirthYearListView.as_view(), name='sheep-by-birth-year'),
+    
+    # Search URL
+    path('search/', views.SearchView.as_view(), name='search'),
+    
+    # Bulk import URL
+    path('import/', views.FlockImportView.as_view(), name='flock-import'),
+    
+    # Export URL
+    path('export/<str:kind>.<str:format>', views.flock_export, name='flock-export'),
+    path('export/<str:kind>.<str:format>/background/', views.flock_export_task, name='flock-export-task'),
+    
+    # JSON API URLs
+    path('api/v1/breeds/', views.BreedApiView.as_view(), name='api-breed-list'),
+    path('api/v1/breeds/<int:pk>/', views.BreedApiView.as_view(), name='api-breed-detail'),
+    path('api/v1/sheep/', views.SheepApiView.as_view(), name='api-sheep-list'),
+    path('api/v1/sheep/<int:pk>/', views.SheepApiView.as_view(), name='api-sheep-detail'),
+    path('api/v1/breeding/', views.BreedingRecordApiView.as_view(), name='api-breeding-record-list'),
+    path('api/v1/breeding/<int:pk>/', views.BreedingRecordApiView.as_view(), name='api-breeding-record-detail'),
+    path('api/v1/lambing/', views.LambingRecordApiView.as_view(), name='api-lambing-record-list'),
+    path('api/v1/lambing/<int:pk>/', views.LambingRecordApiView.as_view(), name='api-lambing-record-detail'),
+    path('api/v1/health/', views.HealthRecordApiView.as_view(), name='api-health-record-list'),
+    path('api/v1/health/<int:pk>/', views.HealthRecordApiView.as_view(), name='api-health-record-detail'),
+    path('api/v1/changes/', views.SyncView.as_view(), name='api-changes'),
+    path('api/v1/tasks/<int:pk>/', views.TaskApiView.as_view(), name='api-task-detail'),
+    
+    # Background task URLs
+    path('tasks/<int:pk>/', views.TaskDetailView.as_view(), name='task-detail'),
+    path('tasks/<int:pk>/download/', views.task_download, name='task-download'),
+    
+    # Request profile URLs
+    path('profiles/', views.profile_list, name='profile-list'),
+    path('profiles/<str:profile_id>/', views.profile_detail, name='profile-detail'),
+    path('profiles/<str:profile_id>.prof', views.profile_download, name='profile-download'),
 ]
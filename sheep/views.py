@@ -1,14 +1,30 @@
+from datetime import timedelta
 from math import trunc
 from django.shortcuts import render, redirect, get_object_or_404
-from django.urls import reverse_lazy
-from django.views.generic import ListView, CreateView, UpdateView, DeleteView, DetailView
+import csv
+import json
+from urllib.parse import urlencode
+
+from django.http import FileResponse, Http404, JsonResponse, StreamingHttpResponse
+from django.urls import reverse, reverse_lazy
+from django.views.generic import ListView, CreateView, UpdateView, DeleteView, DetailView, TemplateView, View
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib import admin
 from django.contrib import messages
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+from django.utils.http import url_has_allowed_host_and_scheme
+from django.views.decorators.http import require_POST
 from django.db import models
+from django.db.models.functions import ExtractYear
 
-from .models import Breed, Sheep, SheepImage, BreedingRecord, LambingRecord, LambingImage, HealthRecord
+from .models import Breed, Sheep, SheepAncestor, SheepImage, SheepProductivity, BreedingRecord, LambingRecord, LambingImage, HealthRecord, Task
+from .pagination import KeysetPaginator, InvalidCursor
+from .conditional import ConditionalGetMixin, conditional_get
+from .response_cache import CachedFragmentMixin
+from . import api, breeding_plan, bulk, conditional, detail_cache, exporter, importer, kinship, pedigree, productivity, profiling, search, sync, tasks
 from django import forms
 
 # Create your views here.
@@ -21,16 +37,18 @@ class BreedForm(forms.ModelForm):
             'description': forms.Textarea(attrs={'rows': 4}),
         }
 
-class BreedListView(LoginRequiredMixin, ListView):
+class BreedListView(LoginRequiredMixin, ConditionalGetMixin, ListView):
     model = Breed
     template_name = 'sheep/breed_list.html'
     context_object_name = 'breeds'
     ordering = ['name']
+    conditional_models = (Breed,)
 
-class BreedDetailView(LoginRequiredMixin, DetailView):
+class BreedDetailView(LoginRequiredMixin, ConditionalGetMixin, CachedFragmentMixin, DetailView):
     model = Breed
     template_name = 'sheep/breed_detail.html'
     context_object_name = 'breed'
+    cache_models = conditional_models = (Breed, Sheep)
 
 class BreedCreateView(LoginRequiredMixin, CreateView):
     model = Breed
@@ -92,27 +110,53 @@ class SheepForm(forms.ModelForm):
         # Filter mother and father fields to show only appropriate gender
         self.fields['mother'].queryset = Sheep.objects.filter(gender='F').order_by('tag_number')
         self.fields['father'].queryset = Sheep.objects.filter(gender='M').order_by('tag_number')
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        # Refuse parents that would make the sheep its own ancestor
+        for field in ['mother', 'father']:
+            if pedigree.would_create_cycle(self.instance, cleaned_data.get(field)):
+                self.add_error(field, "A sheep cannot be its own ancestor.")
+        return cleaned_data
 
-class SheepListView(LoginRequiredMixin, ListView):
+class SheepListView(LoginRequiredMixin, ConditionalGetMixin, CachedFragmentMixin, ListView):
     model = Sheep
     template_name = 'sheep/sheep_list.html'
     context_object_name = 'sheep_list'
     ordering = ['-updated_at']
+    cache_models = conditional_models = (Sheep, Breed)
+    page_size = 50
+    sort_choices = ['tag_number', '-tag_number', 'updated_at', '-updated_at']
+    
+    def get_sort(self):
+        sort_param = self.request.GET.get('sort')
+        if sort_param in self.sort_choices:
+            return sort_param
+        return self.ordering[0]
     
     def get_queryset(self):
-        queryset = super().get_queryset()
+        queryset = super().get_queryset().select_related('mother', 'father', 'breed')
         status_filter = self.request.GET.get('status')
         if not status_filter:
             status_filter = 'ACTIVE'
         queryset = queryset.filter(status=status_filter)
-        sort_param = self.request.GET.get('sort')
-        if sort_param in ['tag_number', '-tag_number', 'updated_at', '-updated_at']:
-            queryset = queryset.order_by(sort_param)
         return queryset
     
     def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
+        # Page with a (sort field, id) cursor so deep pages cost the same as the first
+        paginator = KeysetPaginator(self.object_list, self.get_sort(), per_page=self.page_size)
+        after, before = self.request.GET.get('after'), self.request.GET.get('before')
+        try:
+            if after or before:
+                paginator.decode_cursor(after or before)
+        except InvalidCursor:
+            raise Http404("Invalid page cursor")
+        # Fetched when the template first uses it, so a cached page body costs no query
+        page = SimpleLazyObject(lambda: paginator.page(after=after, before=before))
+        context = super().get_context_data(object_list=page, **kwargs)
+        context['page'] = page
         context['status_choices'] = Sheep.STATUS_CHOICES
+        context['bulk_actions'] = [(action, label) for action, (label, _) in bulk.SHEEP_ACTIONS.items()]
         if not self.request.GET.get('status'):
             context['current_status'] = 'ACTIVE'
         else:
@@ -129,35 +173,95 @@ class SheepListView(LoginRequiredMixin, ListView):
             context['current_sort_dir'] = 'asc'
         return context
 
-class SheepDetailView(LoginRequiredMixin, DetailView):
+class SheepBulkActionForm(forms.Form):
+    action = forms.ChoiceField(choices=[(action, label) for action, (label, _) in bulk.SHEEP_ACTIONS.items()])
+    sheep = forms.ModelMultipleChoiceField(queryset=Sheep.objects.all(),
+                                           error_messages={'required': "Select at least one sheep."})
+    date = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    reason = forms.CharField(required=False, widget=forms.Textarea(attrs={'rows': 2}))
+
+@login_required
+@require_POST
+def sheep_bulk_action(request):
+    """Apply a status change or cull flag to the sheep ticked on the list"""
+    next_url = request.POST.get('next')
+    if not next_url or not url_has_allowed_host_and_scheme(next_url, {request.get_host()}, request.is_secure()):
+        next_url = reverse('sheep-list')
+    form = SheepBulkActionForm(request.POST)
+    if not form.is_valid():
+        for errors in form.errors.values():
+            for error in errors:
+                messages.error(request, error)
+        return redirect(next_url)
+    action = form.cleaned_data['action']
+    try:
+        summary = bulk.apply_action([sheep.pk for sheep in form.cleaned_data['sheep']], action,
+                                    date=form.cleaned_data['date'], reason=form.cleaned_data['reason'])
+    except bulk.BulkError as error:
+        # One problem with any sheep stops the whole batch
+        for problem in error.problems:
+            messages.error(request, problem)
+        return redirect(next_url)
+    statuses = dict(Sheep.STATUS_CHOICES)
+    previously = ', '.join(f"{count} {statuses[status].lower()}" for status, count in sorted(summary['previous'].items()))
+    message = f"{summary['updated']} sheep {bulk.SHEEP_ACTIONS[action][1]}"
+    messages.success(request, f"{message} (previously {previously})." if action == 'ACTIVE' else f"{message}.")
+    return redirect(next_url)
+
+class SheepDetailView(LoginRequiredMixin, ConditionalGetMixin, DetailView):
     model = Sheep
     template_name = 'sheep/sheep_detail.html'
     context_object_name = 'sheep'
     
+    def get_queryset(self):
+        return super().get_queryset().select_related('breed', 'mother', 'father')
+    
+    def get_etag(self, request, *args, **kwargs):
+        pk = self.kwargs['pk']
+        sheep = Sheep.objects.filter(pk=pk).values('mother_id', 'father_id', 'breed_id').first()
+        if sheep is None:
+            return None
+        breeding = BreedingRecord.objects.filter(models.Q(ewe=pk) | models.Q(ram=pk))
+        # Offspring and mates are listed by tag and status, so their own changes count too
+        return conditional.etag(request, 'sheep', conditional.rows_stamp(
+            (Sheep, [pk, sheep['mother_id'], sheep['father_id']]),
+            (Sheep, Sheep.objects.filter(models.Q(mother=pk) | models.Q(father=pk)).values('pk')),
+            (Sheep, breeding.values('ewe')),
+            (Sheep, breeding.values('ram')),
+            (Breed, [sheep['breed_id']]),
+            (BreedingRecord, breeding.values('pk')),
+            (LambingRecord, LambingRecord.objects.filter(ewe=pk).values('pk')),
+            (HealthRecord, HealthRecord.objects.filter(sheep=pk).values('pk')),
+        ))
+    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        sheep = self.get_object()
+        sheep = self.object
         
-        # Get offspring
-        context['offspring'] = Sheep.objects.filter(
+        # Querysets stay lazy so a cached page body never runs them
+        offspring = Sheep.objects.filter(
             models.Q(mother=sheep) | models.Q(father=sheep)
         ).order_by('-date_of_birth')
+        context['offspring'] = offspring
+        context['offspring_with_lambing'] = offspring
         
         # Get breeding records
         if sheep.gender == 'F':
-            context['breeding_records'] = BreedingRecord.objects.filter(ewe=sheep).order_by('-date_started')
+            context['breeding_records'] = BreedingRecord.objects.filter(ewe=sheep).select_related('ram').order_by('-date_started')
             context['lambing_records'] = LambingRecord.objects.filter(ewe=sheep).order_by('-date')
         else:
-            context['breeding_records'] = BreedingRecord.objects.filter(ram=sheep).order_by('-date_started')
+            context['breeding_records'] = BreedingRecord.objects.filter(ram=sheep).select_related('ewe').order_by('-date_started')
             context['lambing_records'] = None
         
         # Get health records
-        context['offspring_with_lambing'] = Sheep.objects.filter(
-                models.Q(mother=sheep) | models.Q(father=sheep)).order_by('-date_of_birth')
         context['health_records'] = HealthRecord.objects.filter(sheep=sheep).order_by('-date')
         
         # Get images
-        context['images'] = SheepImage.objects.filter(sheep_additional=sheep)
+        context['images'] = sheep.additional_images.all()
+        
+        context['detail_cache_timeout'] = detail_cache.cache_timeout()
+        if context['detail_cache_timeout']:
+            context['detail_cache_version'] = detail_cache.version(sheep.pk)
         
         return context
 
@@ -240,94 +344,170 @@ class SheepDeleteView(LoginRequiredMixin, DeleteView):
         return super().get_success_url()
 
 # New View: List sheep grouped by birth year
-class SheepBirthYearListView(LoginRequiredMixin, ListView):
+class SheepBirthYearListView(LoginRequiredMixin, ConditionalGetMixin, ListView):
     model = Sheep
     template_name = 'sheep/sheep_birthyear_list.html'
+    partial_template_name = 'sheep/sheep_birthyear_table.html'
     context_object_name = 'sheep_list'
+    conditional_models = (Sheep, Breed)
+    # Year groups rendered with the page; older years load as they scroll into view
+    expanded_groups = 3
+
+    def get_active_only(self):
+        # First check if the form was submitted using our hidden field
+        if self.request.GET.get('active_only_submitted'):
+            # Form was submitted, checkbox state is determined by presence of active_only
+            return self.request.GET.get('active_only') == 'true'
+        # Form was not submitted yet, default to showing active only
+        return True
+
+    def get_selected_year(self):
+        selected_year = self.request.GET.get('year')
+        if selected_year and selected_year.isdigit():
+            return int(selected_year)
+        return None
 
     def get_queryset(self):
-        # We'll handle filtering in get_context_data for more flexibility
-        # Just return all sheep with birth dates
-        return Sheep.objects.exclude(date_of_birth__isnull=True).order_by('-date_of_birth')
+        queryset = Sheep.objects.exclude(date_of_birth__isnull=True).select_related('breed')
+        if self.get_active_only():
+            queryset = queryset.filter(status='ACTIVE')
+        return queryset.order_by('gender', 'tag_number')
+
+    def get_template_names(self):
+        if self.request.GET.get('partial') and self.get_selected_year():
+            return [self.partial_template_name]
+        return super().get_template_names()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        queryset = self.object_list
         
         # Get all unique years from sheep birth dates
-        all_years = Sheep.objects.exclude(date_of_birth__isnull=True).dates('date_of_birth', 'year')
-        context['available_years'] = sorted([date.year for date in all_years], reverse=True)
-        
-        # Get the selected year (if any)
-        selected_year = self.request.GET.get('year')
-        
-        # Check if only active sheep should be shown
-        # First check if the form was submitted using our hidden field
-        active_only_submitted = self.request.GET.get('active_only_submitted')
-        if active_only_submitted:
-            # Form was submitted, checkbox state is determined by presence of active_only
-            active_only = self.request.GET.get('active_only') == 'true'
-        else:
-            # Form was not submitted yet, default to showing active only
-            active_only = True
-        context['active_only'] = active_only
-        
-        # Filter sheep list based on the active_only parameter
-        sheep_list = context['sheep_list']
-        if active_only:
-            sheep_list = [sheep for sheep in sheep_list if sheep.status == 'ACTIVE']
+        all_years = Sheep.objects.exclude(date_of_birth__isnull=True).dates('date_of_birth', 'year', order='DESC')
+        context['available_years'] = [date.year for date in all_years]
+        context['active_only'] = self.get_active_only()
         
-        if selected_year and selected_year.isdigit():
+        selected_year = self.get_selected_year()
+        context['selected_year'] = selected_year
+        if selected_year:
             # User has selected a specific year
-            selected_year = int(selected_year)
-            context['selected_year'] = selected_year
-            
-            # Filter sheep for the selected year
-            filtered_sheep = []
-            for sheep in sheep_list:
-                if sheep.date_of_birth and sheep.date_of_birth.year == selected_year:
-                    filtered_sheep.append(sheep)
-            
-            # Sort filtered sheep by gender and tag number, same as year groups
-            filtered_sheep = sorted(filtered_sheep, key=lambda x: (x.gender, x.tag_number))
-            
-            context['filtered_sheep'] = filtered_sheep
+            context['filtered_sheep'] = queryset.filter(date_of_birth__year=selected_year)
             context['year_groups'] = None  # No need for groups when filtering by year
         else:
-            # User is viewing all years - group sheep by birth year
-            context['selected_year'] = None
-            year_groups = []
-            
-            # Group sheep by birth year
-            sheep_by_year = {}
-            for sheep in sheep_list:
-                if sheep.date_of_birth:
-                    year = sheep.date_of_birth.year
-                    if year not in sheep_by_year:
-                        sheep_by_year[year] = []
-                    sheep_by_year[year].append(sheep)
-                else:
-                    if 'Unknown' not in sheep_by_year:
-                        sheep_by_year['Unknown'] = []
-                    sheep_by_year['Unknown'].append(sheep)
-            
-            # Convert to list of (year, sheep_list) tuples and sort by year (descending)
-            for year in sorted(sheep_by_year.keys(), reverse=True):
-                sheep_count = len(sheep_by_year[year])
-                year_groups.append({
-                    'year': year,
-                    'sheep_list': sheep_by_year[year],
-                    'count': sheep_count
-                })
-            
-            # for each year group, sort by male/female and the by tag number
-            for year_group in year_groups:
-                year_group['sheep_list'] = sorted(year_group['sheep_list'], key=lambda x: (x.gender, x.tag_number))
-            
-            context['year_groups'] = year_groups
+            # User is viewing all years - count sheep per birth year in the database
+            year_counts = (
+                queryset.annotate(year=ExtractYear('date_of_birth'))
+                .values('year')
+                .annotate(count=models.Count('id'))
+                .order_by('-year')
+            )
+            # Each group's sheep are fetched only when the group is rendered or loaded
+            context['year_groups'] = [
+                {
+                    'year': row['year'],
+                    'count': row['count'],
+                    'sheep_list': queryset.filter(date_of_birth__year=row['year']),
+                    'expanded': index < self.expanded_groups,
+                }
+                for index, row in enumerate(year_counts)
+            ]
             context['filtered_sheep'] = None
         
         return context
 
+# Pedigree Views
+class SheepPedigreeView(LoginRequiredMixin, DetailView):
+    model = Sheep
+    template_name = 'sheep/sheep_pedigree.html'
+    context_object_name = 'sheep'
+    default_generations = 4
+    max_generations = 6
+    
+    def get_generations(self):
+        generations = self.request.GET.get('generations', '')
+        if generations.isdigit():
+            return min(max(int(generations), 1), self.max_generations)
+        return self.default_generations
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        generations = self.get_generations()
+        tree = pedigree.ancestor_tree(self.object, generations)
+        context['generations'] = generations
+        context['generation_choices'] = range(1, self.max_generations + 1)
+        context['pedigree_rows'] = pedigree.pedigree_chart(tree, generations)
+        context['root'] = tree.get('')
+        context['inbreeding'] = kinship.inbreeding_coefficient(self.object.pk) * 100
+        # Descendant counts per generation straight from the closure table
+        context['descendant_generations'] = (
+            SheepAncestor.objects.filter(ancestor=self.object)
+            .values('depth')
+            .annotate(count=models.Count('id'))
+            .order_by('depth')
+        )
+        return context
+
+
+class Echo:
+    """File-like object whose write() just returns the value, for streaming CSV"""
+    def write(self, value):
+        return value
+
+
+@login_required
+@conditional_get(*conditional.model_validators(lambda request, pk: (Sheep, Breed)))
+def sheep_descendants_export(request, pk):
+    sheep = get_object_or_404(Sheep, pk=pk)
+    links = (
+        SheepAncestor.objects.filter(ancestor=sheep)
+        .select_related('descendant__breed', 'descendant__mother', 'descendant__father')
+        .order_by('depth', 'descendant__tag_number')
+    )
+    
+    def rows():
+        yield ['generation', 'tag_number', 'name', 'gender', 'date_of_birth', 'breed', 'status',
+               'mother_tag', 'father_tag']
+        for link in links.iterator(chunk_size=500):
+            child = link.descendant
+            yield [link.depth, child.tag_number, child.name, child.gender, child.date_of_birth or '',
+                   child.breed.name, child.status,
+                   child.mother.tag_number if child.mother else '',
+                   child.father.tag_number if child.father else '']
+    
+    writer = csv.writer(Echo())
+    response = StreamingHttpResponse((writer.writerow(row) for row in rows()), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{sheep.tag_number}-descendants.csv"'
+    return response
+
+
+# Models whose rows appear in each kind of export
+EXPORT_MODELS = {
+    'sheep': (Sheep, Breed, LambingRecord, HealthRecord),
+    'lambing': (LambingRecord, Sheep),
+    'health': (HealthRecord, Sheep),
+}
+
+@login_required
+@conditional_get(*conditional.model_validators(lambda request, kind, format: EXPORT_MODELS.get(kind)))
+def flock_export(request, kind, format):
+    """Stream every sheep, lambing record or health record as CSV, JSON lines or XLSX"""
+    if kind not in exporter.EXPORT_KINDS or format not in exporter.FORMATS:
+        raise Http404("Unknown export")
+    content_type, extension = exporter.FORMATS[format]
+    response = StreamingHttpResponse(exporter.export_chunks(kind, format), content_type=content_type)
+    filename = f"flock-{kind}-{timezone.localdate():%Y-%m-%d}.{extension}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+@login_required
+@require_POST
+def flock_export_task(request, kind, format):
+    """Write an export to a file in the background, for exports too large to wait for"""
+    if kind not in exporter.EXPORT_KINDS or format not in exporter.FORMATS:
+        raise Http404("Unknown export")
+    task = tasks.enqueue('export', {'kind': kind, 'format': format}, user=request.user)
+    return redirect(task_url(task, next_url=request.POST.get('next')))
+
 # Sheep Image Form
 class SheepImageForm(forms.ModelForm):
     class Meta:
@@ -404,14 +584,15 @@ class BreedingRecordForm(forms.ModelForm):
             'notes': forms.Textarea(attrs={'rows': 4}),
         }
 
-class BreedingRecordListView(LoginRequiredMixin, ListView):
+class BreedingRecordListView(LoginRequiredMixin, ConditionalGetMixin, CachedFragmentMixin, ListView):
     model = BreedingRecord
     template_name = 'sheep/breeding_record_list.html'
     context_object_name = 'breeding_records'
     ordering = ['-date_started']
+    cache_models = conditional_models = (BreedingRecord, Sheep)
     
     def get_queryset(self):
-        queryset = super().get_queryset()
+        queryset = super().get_queryset().select_related('ewe', 'ram')
         status_filter = self.request.GET.get('status')
         if status_filter:
             queryset = queryset.filter(status=status_filter)
@@ -423,14 +604,30 @@ class BreedingRecordListView(LoginRequiredMixin, ListView):
         context['current_status'] = self.request.GET.get('status', '')
         return context
 
-class BreedingRecordDetailView(LoginRequiredMixin, DetailView):
+class BreedingRecordDetailView(LoginRequiredMixin, ConditionalGetMixin, DetailView):
     model = BreedingRecord
     template_name = 'sheep/breeding_record_detail.html'
     context_object_name = 'breeding_record'
     
+    def get_etag(self, request, *args, **kwargs):
+        pk = self.kwargs['pk']
+        pair = BreedingRecord.objects.filter(pk=pk).values_list('ewe_id', 'ram_id').first()
+        if pair is None:
+            return None
+        pair = list(pair)
+        # Expected inbreeding depends on every ancestor of the pair
+        return conditional.etag(request, 'breeding', conditional.rows_stamp(
+            (BreedingRecord, [pk]),
+            (Sheep, pair),
+            (Sheep, SheepAncestor.objects.filter(descendant__in=pair).values('ancestor')),
+            (Breed, Sheep.objects.filter(pk__in=pair).values('breed')),
+        ))
+    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        breeding_record = self.get_object()
+        breeding_record = self.object
+        matrix = kinship.kinship_matrix([breeding_record.ewe_id], [breeding_record.ram_id])
+        context['expected_inbreeding'] = matrix[(breeding_record.ewe_id, breeding_record.ram_id)] * 100
         return context
 
 class BreedingRecordCreateView(LoginRequiredMixin, CreateView):
@@ -505,6 +702,108 @@ class BreedingRecordDeleteView(LoginRequiredMixin, DeleteView):
             return next_url
         return reverse_lazy('breeding-record-detail', kwargs={'pk': self.object.pk})
 
+# Expected inbreeding of a lamb from an ewe x ram pair, for the breeding form
+@login_required
+def expected_inbreeding(request):
+    ewe_id = request.GET.get('ewe', '')
+    ram_id = request.GET.get('ram', '')
+    if not (ewe_id.isdigit() and ram_id.isdigit()):
+        return JsonResponse({'error': 'ewe and ram are required'}, status=400)
+    ewe_id, ram_id = int(ewe_id), int(ram_id)
+    value = kinship.kinship_matrix([ewe_id], [ram_id])[(ewe_id, ram_id)]
+    return JsonResponse({'ewe': ewe_id, 'ram': ram_id, 'expected_inbreeding': value})
+
+class MatingKinshipView(LoginRequiredMixin, TemplateView):
+    template_name = 'sheep/mating_kinship.html'
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        ewes = list(Sheep.objects.filter(gender='F', status='ACTIVE').order_by('tag_number'))
+        rams = list(Sheep.objects.filter(gender='M', status='ACTIVE').order_by('tag_number'))
+        matrix = kinship.kinship_matrix([ewe.pk for ewe in ewes], [ram.pk for ram in rams])
+        context['rams'] = rams
+        context['rows'] = [
+            {'ewe': ewe, 'cells': [matrix[(ewe.pk, ram.pk)] * 100 for ram in rams]}
+            for ewe in ewes
+        ]
+        return context
+
+class BreedingPlanForm(forms.Form):
+    rams = forms.ModelMultipleChoiceField(
+        queryset=Sheep.objects.filter(gender='M', status='ACTIVE').order_by('tag_number'),
+        required=False,
+        help_text='Leave empty to use every active ram',
+    )
+    capacity = forms.IntegerField(min_value=1, initial=50, help_text='Most ewes a single ram can cover')
+    max_inbreeding = forms.DecimalField(
+        min_value=0, max_value=100, decimal_places=2, initial=12.5,
+        help_text='Pairs with expected lamb inbreeding at or above this percentage are never proposed',
+    )
+
+class BreedingPlanView(LoginRequiredMixin, TemplateView):
+    template_name = 'sheep/breeding_plan.html'
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        form = BreedingPlanForm(self.request.GET or None)
+        context['form'] = form
+        context['status_choices'] = BreedingRecord.STATUS_CHOICES
+        context['today'] = timezone.now().date()
+        if not form.is_valid():
+            return context
+        rams = list(form.cleaned_data['rams'] or form.fields['rams'].queryset)
+        ewes = list(Sheep.objects.filter(gender='F', status='ACTIVE').order_by('tag_number'))
+        plan = breeding_plan.plan_breeding_groups(
+            [ewe.pk for ewe in ewes],
+            [ram.pk for ram in rams],
+            capacity=form.cleaned_data['capacity'],
+            max_kinship=float(form.cleaned_data['max_inbreeding']) / 100,
+        )
+        ewes_by_id = {ewe.pk: ewe for ewe in ewes}
+        groups = plan.groups()
+        context['plan'] = plan
+        context['total_inbreeding'] = plan.total_kinship * 100
+        context['groups'] = [
+            {
+                'ram': ram,
+                'members': [{'ewe': ewes_by_id[ewe_id], 'inbreeding': value * 100}
+                            for ewe_id, value in groups.get(ram.pk, [])],
+            }
+            for ram in rams
+        ]
+        context['unassigned'] = [ewes_by_id[ewe_id] for ewe_id in plan.unassigned]
+        return context
+    
+    def post(self, request, *args, **kwargs):
+        pairs = []
+        for value in request.POST.getlist('pair'):
+            ewe_id, _, ram_id = value.partition(':')
+            if not (ewe_id.isdigit() and ram_id.isdigit()):
+                messages.error(request, "The breeding plan was not valid.")
+                return redirect(request.get_full_path())
+            pairs.append((int(ewe_id), int(ram_id)))
+        date_field = forms.DateField()
+        try:
+            date_started = date_field.clean(request.POST.get('date_started'))
+        except forms.ValidationError:
+            messages.error(request, "Please enter a valid breeding start date.")
+            return redirect(request.get_full_path())
+        status = request.POST.get('status', 'PLANNED')
+        if status not in dict(BreedingRecord.STATUS_CHOICES):
+            status = 'PLANNED'
+        # Only active ewes with active rams may be paired
+        active_ids = set(
+            Sheep.objects.filter(status='ACTIVE', pk__in={pk for pair in pairs for pk in pair})
+            .values_list('pk', flat=True)
+        )
+        pairs = [(ewe_id, ram_id) for ewe_id, ram_id in pairs if ewe_id in active_ids and ram_id in active_ids]
+        if not pairs:
+            messages.error(request, "There were no pairs to create breeding records for.")
+            return redirect('breeding-plan')
+        records = breeding_plan.create_breeding_records(pairs, date_started, status=status)
+        messages.success(request, f"{len(records)} breeding records created from the plan!")
+        return redirect('breeding-record-list')
+
 # Duplicate Breeding Record function
 @login_required
 def duplicate_breeding_record(request, pk):
@@ -548,21 +847,33 @@ class LambingRecordForm(forms.ModelForm):
         # Filter ewe field to show only females
         self.fields['ewe'].queryset = Sheep.objects.filter(gender='F')
         
-class LambingRecordListView(LoginRequiredMixin, ListView):
+class LambingRecordListView(LoginRequiredMixin, ConditionalGetMixin, CachedFragmentMixin, ListView):
     model = LambingRecord
     template_name = 'sheep/lambing_record_list.html'
     context_object_name = 'lambing_records'
     ordering = ['-date']
+    cache_models = conditional_models = (LambingRecord, Sheep)
+    
+    def get_queryset(self):
+        return super().get_queryset().select_related('ewe')
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         return context
 
-class LambingRecordDetailView(LoginRequiredMixin, DetailView):
+class LambingRecordDetailView(LoginRequiredMixin, ConditionalGetMixin, DetailView):
     model = LambingRecord
     template_name = 'sheep/lambing_record_detail.html'
     context_object_name = 'lambing_record'
     
+    def get_etag(self, request, *args, **kwargs):
+        pk = self.kwargs['pk']
+        return conditional.etag(request, 'lambing', conditional.rows_stamp(
+            (LambingRecord, [pk]),
+            (Sheep, LambingRecord.objects.filter(pk=pk).values('ewe')),
+            (Sheep, Sheep.objects.filter(birth_record=pk).values('pk')),
+        ))
+    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         # Get lambs associated with this lambing record using the new relationship
@@ -701,6 +1012,116 @@ class LambingImageDeleteView(LoginRequiredMixin, DeleteView):
         messages.success(request, f"Image deleted from lambing record successfully!")
         return super().delete(request, *args, **kwargs)
 
+# Productivity Views
+class ProductivityFilterForm(forms.Form):
+    ROLE_CHOICES = [('ewes', 'Ewes'), ('rams', 'Rams')]
+    CULL_CHOICES = [('', 'Any'), ('yes', 'Cull candidates'), ('no', 'Not cull candidates')]
+    # Sort parameter -> ordering, per role; nulls go last whichever way a column is sorted
+    SORTS = {
+        'ewes': {
+            'rank': ['ewe_rank', 'sheep__tag_number'],
+            'lambings': ['-lambings', 'sheep__tag_number'],
+            'lambing_rate': [models.F('lambing_rate').desc(nulls_last=True), 'sheep__tag_number'],
+            '-lambing_rate': [models.F('lambing_rate').asc(nulls_last=True), 'sheep__tag_number'],
+            'survival_rate': [models.F('survival_rate').desc(nulls_last=True), 'sheep__tag_number'],
+            '-survival_rate': [models.F('survival_rate').asc(nulls_last=True), 'sheep__tag_number'],
+            'lambing_interval': [models.F('lambing_interval').asc(nulls_last=True), 'sheep__tag_number'],
+            '-lambing_interval': [models.F('lambing_interval').desc(nulls_last=True), 'sheep__tag_number'],
+            'last_lambing': [models.F('last_lambing').desc(nulls_last=True), 'sheep__tag_number'],
+            'tag_number': ['sheep__tag_number'],
+        },
+        'rams': {
+            'sired_lambs_alive': ['-sired_lambs_alive', 'sheep__tag_number'],
+            'sired_survival_rate': [models.F('sired_survival_rate').desc(nulls_last=True), 'sheep__tag_number'],
+            '-sired_survival_rate': [models.F('sired_survival_rate').asc(nulls_last=True), 'sheep__tag_number'],
+            'progeny': ['-progeny', 'sheep__tag_number'],
+            'ewes_bred': ['-ewes_bred', 'sheep__tag_number'],
+            'tag_number': ['sheep__tag_number'],
+        },
+    }
+    DEFAULT_SORTS = {'ewes': 'rank', 'rams': 'sired_lambs_alive'}
+    
+    role = forms.ChoiceField(choices=ROLE_CHOICES, required=False)
+    status = forms.ChoiceField(choices=[('', 'Any Status')] + Sheep.STATUS_CHOICES, required=False)
+    cull = forms.ChoiceField(choices=CULL_CHOICES, required=False)
+    min_lambings = forms.IntegerField(min_value=0, required=False)
+    sort = forms.CharField(required=False)
+    
+    def role_value(self):
+        self.is_valid()
+        return self.cleaned_data.get('role') or 'ewes'
+    
+    def sort_value(self):
+        role = self.role_value()
+        sort = self.cleaned_data.get('sort')
+        return sort if sort in self.SORTS[role] else self.DEFAULT_SORTS[role]
+    
+    def filter(self, queryset):
+        """Apply the valid filters and sort to a SheepProductivity queryset, ignoring invalid ones"""
+        role = self.role_value()
+        data = self.cleaned_data
+        queryset = queryset.filter(sheep__gender='F' if role == 'ewes' else 'M')
+        if role == 'ewes':
+            queryset = queryset.filter(lambings__gt=0)
+        if data.get('status'):
+            queryset = queryset.filter(sheep__status=data['status'])
+        if data.get('cull') == 'yes':
+            queryset = queryset.filter(sheep__cull_candidate=True)
+        elif data.get('cull') == 'no':
+            queryset = queryset.filter(sheep__cull_candidate=False)
+        if data.get('min_lambings'):
+            queryset = queryset.filter(lambings__gte=data['min_lambings'])
+        return queryset.order_by(*self.SORTS[role][self.sort_value()])
+
+class ProductivityView(LoginRequiredMixin, ListView):
+    model = SheepProductivity
+    template_name = 'sheep/productivity_list.html'
+    context_object_name = 'rows'
+    paginate_by = 100
+    
+    def get_filter_form(self):
+        if not hasattr(self, '_filter_form'):
+            data = self.request.GET.copy()
+            # Like the sheep list, show the active flock unless asked otherwise
+            data.setdefault('status', 'ACTIVE')
+            self._filter_form = ProductivityFilterForm(data)
+        return self._filter_form
+    
+    def get_queryset(self):
+        queryset = super().get_queryset().select_related('sheep', 'sheep__breed')
+        return self.get_filter_form().filter(queryset)
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        form = self.get_filter_form()
+        context['filter_form'] = form
+        context['role'] = form.role_value()
+        context['current_sort'] = form.sort_value()
+        context['last_refreshed'] = self.last_refreshed
+        # Current filters without sort and page, for the column and page links
+        query = self.request.GET.copy()
+        for key in ('sort', 'page'):
+            query.pop(key, None)
+        context['filter_query'] = query.urlencode()
+        # Sort parameter behind each column header; a second click reverses it where that makes sense
+        sorts = ProductivityFilterForm.SORTS[context['role']]
+        context['sort_links'] = {
+            key: f'-{key}' if key == context['current_sort'] and f'-{key}' in sorts else key
+            for key in sorts if not key.startswith('-')
+        }
+        return context
+    
+    def get(self, request, *args, **kwargs):
+        self.last_refreshed = productivity.last_refreshed()
+        if self.last_refreshed is None:
+            productivity.refresh()
+            self.last_refreshed = productivity.last_refreshed()
+        return super().get(request, *args, **kwargs)
+    
+    def post(self, request, *args, **kwargs):
+        task = tasks.enqueue('refresh-productivity', user=request.user, unique=True)
+        return redirect(task_url(task, next_url=request.get_full_path()))
+
 # HealthRecord Views
 class HealthRecordForm(forms.ModelForm):
     class Meta:
@@ -713,22 +1134,99 @@ class HealthRecordForm(forms.ModelForm):
             'notes': forms.Textarea(attrs={'rows': 4}),
         }
 
-class HealthRecordListView(LoginRequiredMixin, ListView):
+class HealthRecordFilterForm(forms.Form):
+    DATE_RANGE_CHOICES = [('', 'All Dates'), ('30', 'Last 30 Days'), ('90', 'Last 90 Days'), ('365', 'Last Year')]
+    FOLLOWUP_CHOICES = [('', 'Any'), ('required', 'Follow-up required'), ('overdue', 'Follow-up overdue'), ('none', 'No follow-up')]
+    
+    record_type = forms.ChoiceField(choices=[('', 'All Types')] + HealthRecord.TYPE_CHOICES, required=False)
+    sheep = forms.CharField(required=False)
+    days = forms.ChoiceField(choices=DATE_RANGE_CHOICES, required=False)
+    date_from = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    date_to = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    followup = forms.ChoiceField(choices=FOLLOWUP_CHOICES, required=False)
+    
+    def filter(self, queryset):
+        """Apply the valid filters to a HealthRecord queryset, ignoring invalid ones"""
+        self.is_valid()
+        data = self.cleaned_data
+        today = timezone.now().date()
+        if data.get('record_type'):
+            queryset = queryset.filter(record_type=data['record_type'])
+        if data.get('sheep'):
+            queryset = queryset.filter(
+                models.Q(sheep__tag_number__icontains=data['sheep']) | models.Q(sheep__name__icontains=data['sheep'])
+            )
+        if data.get('days'):
+            queryset = queryset.filter(date__gte=today - timedelta(days=int(data['days'])))
+        if data.get('date_from'):
+            queryset = queryset.filter(date__gte=data['date_from'])
+        if data.get('date_to'):
+            queryset = queryset.filter(date__lte=data['date_to'])
+        followup = data.get('followup')
+        if followup == 'required':
+            queryset = queryset.filter(requires_followup=True)
+        elif followup == 'overdue':
+            queryset = queryset.filter(requires_followup=True, followup_date__lt=today)
+        elif followup == 'none':
+            queryset = queryset.filter(requires_followup=False)
+        return queryset
+
+class HealthRecordListView(LoginRequiredMixin, ConditionalGetMixin, ListView):
     model = HealthRecord
     template_name = 'sheep/health_record_list.html'
+    partial_template_name = 'sheep/health_record_table.html'
     context_object_name = 'health_records'
     ordering = ['-date']
+    conditional_models = (HealthRecord, Sheep)
+    page_size = 50
+    
+    def get_filter_form(self):
+        if not hasattr(self, '_filter_form'):
+            self._filter_form = HealthRecordFilterForm(self.request.GET)
+        return self._filter_form
+    
+    def get_queryset(self):
+        queryset = super().get_queryset().select_related('sheep')
+        return self.get_filter_form().filter(queryset)
+    
+    def get_template_names(self):
+        # Filter changes only re-render the results table
+        if self.request.GET.get('partial'):
+            return [self.partial_template_name]
+        return super().get_template_names()
     
     def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
+        paginator = KeysetPaginator(self.object_list, self.ordering[0], per_page=self.page_size)
+        try:
+            page = paginator.page(after=self.request.GET.get('after'), before=self.request.GET.get('before'))
+        except InvalidCursor:
+            raise Http404("Invalid page cursor")
+        context = super().get_context_data(object_list=page.object_list, **kwargs)
+        context['page'] = page
+        context['filter_form'] = self.get_filter_form()
         context['record_types'] = dict(HealthRecord.TYPE_CHOICES)
+        # Current filters, carried over to the page links
+        query = self.request.GET.copy()
+        for key in ('after', 'before', 'partial'):
+            query.pop(key, None)
+        context['filter_query'] = query.urlencode()
+        context['is_filtered'] = any(query.values())
         return context
 
-class HealthRecordDetailView(LoginRequiredMixin, DetailView):
+class HealthRecordDetailView(LoginRequiredMixin, ConditionalGetMixin, DetailView):
     model = HealthRecord
     template_name = 'sheep/health_record_detail.html'
     context_object_name = 'health_record'
     
+    def get_etag(self, request, *args, **kwargs):
+        pk = self.kwargs['pk']
+        sheep = HealthRecord.objects.filter(pk=pk).values('sheep')
+        return conditional.etag(request, 'health', conditional.rows_stamp(
+            (HealthRecord, [pk]),
+            (Sheep, sheep),
+            (Breed, Sheep.objects.filter(pk__in=sheep).values('breed')),
+        ))
+    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         return context
@@ -799,3 +1297,392 @@ class EweHealthRecordCreateView(LoginRequiredMixin, CreateView):
         if next_url:
             return next_url
         return reverse_lazy('sheep-detail', kwargs={'pk': self.kwargs['pk']})
+
+# Bulk Treatment
+class BulkTreatmentForm(forms.ModelForm):
+    status = forms.ChoiceField(choices=[('', 'Any status')] + Sheep.STATUS_CHOICES, required=False, initial='ACTIVE')
+    breed = forms.ModelChoiceField(queryset=Breed.objects.order_by('name'), required=False, empty_label='Any breed')
+    birth_year = forms.IntegerField(required=False, min_value=1900, max_value=2100)
+    tags = forms.CharField(required=False, widget=forms.Textarea(attrs={'rows': 3}),
+                           help_text='Only these tag numbers, separated by commas, spaces or new lines')
+
+    class Meta:
+        model = HealthRecord
+        fields = bulk.TREATMENT_FIELDS
+        widgets = {
+            'date': forms.DateInput(attrs={'type': 'date'}),
+            'followup_date': forms.DateInput(attrs={'type': 'date'}),
+            'notes': forms.Textarea(attrs={'rows': 3}),
+        }
+
+    def clean_tags(self):
+        return bulk.parse_tags(self.cleaned_data.get('tags'))
+
+    def clean(self):
+        cleaned_data = super().clean()
+        criteria = {name: cleaned_data.get(name) for name in ('status', 'breed', 'birth_year', 'tags')}
+        if not any(criteria.values()):
+            raise forms.ValidationError("Pick the animals to treat by status, breed, birth year or tag.")
+        # The whole batch is checked before anything is saved
+        self.criteria = criteria
+        self.selection, problems = bulk.select_sheep(**criteria)
+        if problems:
+            self.add_error('tags', problems)
+        elif not self.selection.exists():
+            raise forms.ValidationError("No animals match those choices.")
+        return cleaned_data
+
+class BulkTreatmentView(LoginRequiredMixin, TemplateView):
+    template_name = 'sheep/health_record_bulk.html'
+    preview_limit = 200
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.setdefault('form', BulkTreatmentForm(initial={'date': timezone.localdate()}))
+        return context
+
+    def post(self, request, *args, **kwargs):
+        form = BulkTreatmentForm(request.POST)
+        if not form.is_valid():
+            return self.render_to_response(self.get_context_data(form=form))
+        if 'preview' in request.POST:
+            preview = list(form.selection.values_list('tag_number', 'name')[:self.preview_limit])
+            count = form.selection.count()
+            return self.render_to_response(self.get_context_data(
+                form=form, preview=preview, count=count, more=count - len(preview),
+            ))
+        try:
+            records = bulk.treat_selection(form.cleaned_data, **form.criteria)
+        except bulk.BulkError as error:
+            # Sheep changed since the form was checked
+            form.add_error(None, error.problems)
+            return self.render_to_response(self.get_context_data(form=form))
+        record_type = form.cleaned_data['record_type']
+        messages.success(request, f"{len(records)} health records created successfully!")
+        return redirect(f"{reverse('health-record-list')}?{urlencode({'record_type': record_type})}")
+
+# Search View
+class SearchView(LoginRequiredMixin, TemplateView):
+    template_name = 'sheep/search.html'
+    per_page = 25
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.get('q', '').strip()
+        page = self.request.GET.get('page', '1')
+        page = int(page) if page.isdigit() and int(page) > 0 else 1
+        results, has_next = search.search(query, page=page, per_page=self.per_page)
+        context['query'] = query
+        context['results'] = results
+        context['page_number'] = page
+        context['has_next'] = has_next
+        context['has_previous'] = page > 1
+        return context
+
+# Bulk Import
+class FlockImportForm(forms.Form):
+    KIND_CHOICES = [('sheep', 'Sheep'), ('lambing', 'Lambing records'), ('health', 'Health records')]
+    FORMAT_CHOICES = [('csv', 'CSV'), ('jsonl', 'JSON lines')]
+    
+    kind = forms.ChoiceField(choices=KIND_CHOICES)
+    format = forms.ChoiceField(choices=FORMAT_CHOICES, initial='csv')
+    file = forms.FileField()
+    dry_run = forms.BooleanField(required=False, initial=True, help_text='Check the file and report errors without saving anything')
+
+class FlockImportView(LoginRequiredMixin, TemplateView):
+    template_name = 'sheep/flock_import.html'
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.setdefault('form', FlockImportForm())
+        context['columns'] = {kind: columns + list(sheep_columns) + (list(importer.PARENT_COLUMNS) if kind == 'sheep' else [])
+                              for kind, (_, columns, sheep_columns) in importer.IMPORT_KINDS.items()}
+        return context
+    
+    def post(self, request, *args, **kwargs):
+        form = FlockImportForm(request.POST, request.FILES)
+        if not form.is_valid():
+            return self.render_to_response(self.get_context_data(form=form))
+        # The upload is read line by line, never all at once
+        stream = importer.open_text(form.cleaned_data['file'].file)
+        report = importer.import_file(
+            stream, form.cleaned_data['kind'], format=form.cleaned_data['format'],
+            dry_run=form.cleaned_data['dry_run'],
+        )
+        if not report.dry_run and report.created:
+            messages.success(request, f"{report.created} rows imported successfully!")
+        return self.render_to_response(self.get_context_data(form=form, report=report))
+
+# Request profiles
+@staff_member_required
+def profile_list(request):
+    context = admin.site.each_context(request)
+    context.update(title='Request profiles', profiles=profiling.list_profiles(), keep=profiling.keep())
+    return render(request, 'sheep/profile_list.html', context)
+
+@staff_member_required
+def profile_detail(request, profile_id):
+    sort = request.GET.get('sort', 'cumulative')
+    if sort not in profiling.SORTS:
+        sort = 'cumulative'
+    try:
+        details = profiling.details(profile_id)
+        total, rows = profiling.call_table(profile_id, sort=sort)
+    except (OSError, ValueError):
+        raise Http404("No such profile")
+    context = admin.site.each_context(request)
+    context.update(
+        title=f"Profile of {details['method']} {details['path']}",
+        profile=details, total_ms=total * 1000, rows=rows,
+        sort=sort, sorts=[(key, label) for key, (_, label) in profiling.SORTS.items()],
+    )
+    return render(request, 'sheep/profile_detail.html', context)
+
+@staff_member_required
+def profile_download(request, profile_id):
+    try:
+        file = open(profiling.path(profile_id), 'rb')
+    except OSError:
+        raise Http404("No such profile")
+    return FileResponse(file, as_attachment=True, filename=f'{profile_id}.prof',
+                        content_type='application/octet-stream')
+
+# JSON API
+class SheepApiFilterForm(forms.Form):
+    status = forms.ChoiceField(choices=Sheep.STATUS_CHOICES, required=False)
+    gender = forms.ChoiceField(choices=Sheep.GENDER_CHOICES, required=False)
+    breed = forms.IntegerField(required=False)
+    birth_year = forms.IntegerField(required=False)
+    
+    def filter(self, queryset):
+        data = self.cleaned_data
+        if data.get('status'):
+            queryset = queryset.filter(status=data['status'])
+        if data.get('gender'):
+            queryset = queryset.filter(gender=data['gender'])
+        if data.get('breed') is not None:
+            queryset = queryset.filter(breed_id=data['breed'])
+        if data.get('birth_year') is not None:
+            queryset = queryset.filter(date_of_birth__year=data['birth_year'])
+        return queryset
+
+class BreedingRecordApiFilterForm(forms.Form):
+    status = forms.ChoiceField(choices=BreedingRecord.STATUS_CHOICES, required=False)
+    ewe = forms.IntegerField(required=False)
+    ram = forms.IntegerField(required=False)
+    
+    def filter(self, queryset):
+        data = self.cleaned_data
+        if data.get('status'):
+            queryset = queryset.filter(status=data['status'])
+        if data.get('ewe') is not None:
+            queryset = queryset.filter(ewe_id=data['ewe'])
+        if data.get('ram') is not None:
+            queryset = queryset.filter(ram_id=data['ram'])
+        return queryset
+
+class LambingRecordApiFilterForm(forms.Form):
+    ewe = forms.IntegerField(required=False)
+    date_from = forms.DateField(required=False)
+    date_to = forms.DateField(required=False)
+    
+    def filter(self, queryset):
+        data = self.cleaned_data
+        if data.get('ewe') is not None:
+            queryset = queryset.filter(ewe_id=data['ewe'])
+        if data.get('date_from'):
+            queryset = queryset.filter(date__gte=data['date_from'])
+        if data.get('date_to'):
+            queryset = queryset.filter(date__lte=data['date_to'])
+        return queryset
+
+class ApiLoginRequiredMixin(LoginRequiredMixin):
+    """Answers anonymous requests with a JSON 401 rather than a redirect to the login page"""
+    
+    def handle_no_permission(self):
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+
+class ApiView(ApiLoginRequiredMixin, ConditionalGetMixin, View):
+    """JSON list of an api.Resource, or one of its rows when the URL has a pk; see sheep/api.py"""
+    resource = None
+    # A form with a filter(queryset) method, bound to the query string
+    filter_form_class = None
+    
+    def get_expanded(self):
+        """{relation: related model} of the relations the request expands, or None if it is invalid"""
+        try:
+            _, expand = api.parse_fields(self.resource, self.request.GET)
+        except api.ApiError:
+            return None
+        return {name: api.RESOURCES[self.resource.relations[name]].model for name in expand}
+    
+    def get_conditional_models(self):
+        expanded = self.get_expanded()
+        return () if expanded is None else (self.resource.model, *expanded.values())
+    
+    def get_etag(self, request, *args, **kwargs):
+        if 'pk' not in kwargs:
+            return super().get_etag(request, *args, **kwargs)
+        expanded = self.get_expanded()
+        if expanded is None:
+            return None
+        row = self.resource.model.objects.filter(pk=kwargs['pk'])
+        return conditional.etag(request, 'api', conditional.rows_stamp(
+            (self.resource.model, [kwargs['pk']]),
+            *((model, row.values(self.resource.fields[name])) for name, model in expanded.items()),
+        ))
+    
+    def get_last_modified(self, request, *args, **kwargs):
+        # A single row has only an ETag, like the detail pages
+        if 'pk' in kwargs:
+            return None
+        return super().get_last_modified(request, *args, **kwargs)
+    
+    def get(self, request, pk=None):
+        try:
+            fields, expand = api.parse_fields(self.resource, request.GET)
+            if pk is not None:
+                return self.get_object(pk, fields, expand)
+            return self.get_list(fields, expand)
+        except api.ApiError as error:
+            return JsonResponse({'error': str(error)}, status=400)
+    
+    def get_object(self, pk, fields, expand):
+        rows = api.serialize(self.resource, self.resource.model.objects.filter(pk=pk), fields, expand)
+        if not rows:
+            return JsonResponse({'error': 'Not found'}, status=404)
+        return JsonResponse(rows[0])
+    
+    def get_list(self, fields, expand):
+        queryset = self.resource.model.objects.all()
+        if self.filter_form_class:
+            form = self.filter_form_class(self.request.GET)
+            if not form.is_valid():
+                return JsonResponse({'error': 'Invalid filters', 'filters': form.errors}, status=400)
+            queryset = form.filter(queryset)
+        rows, next_cursor, previous_cursor = api.page(self.resource, queryset, self.request.GET, fields, expand)
+        return JsonResponse({
+            'results': rows,
+            'next': self.page_url(after=next_cursor) if next_cursor else None,
+            'previous': self.page_url(before=previous_cursor) if previous_cursor else None,
+        })
+    
+    def page_url(self, **cursor):
+        query = self.request.GET.copy()
+        for key in ('after', 'before'):
+            query.pop(key, None)
+        query.update(cursor)
+        return self.request.build_absolute_uri(f'{self.request.path}?{query.urlencode()}')
+
+class BreedApiView(ApiView):
+    resource = api.BREED
+
+class SheepApiView(ApiView):
+    resource = api.SHEEP
+    filter_form_class = SheepApiFilterForm
+
+class BreedingRecordApiView(ApiView):
+    resource = api.BREEDING
+    filter_form_class = BreedingRecordApiFilterForm
+
+class LambingRecordApiView(ApiView):
+    resource = api.LAMBING
+    filter_form_class = LambingRecordApiFilterForm
+
+class HealthRecordApiView(ApiView):
+    resource = api.HEALTH
+    filter_form_class = HealthRecordFilterForm
+
+class SyncView(ApiLoginRequiredMixin, ConditionalGetMixin, View):
+    """Changes since a cursor for offline devices (GET) and their queued edits (POST); see sheep/sync.py"""
+    conditional_models = tuple(sync.KINDS)
+    forms = {
+        'breeds': BreedForm,
+        'sheep': SheepForm,
+        'breeding': BreedingRecordForm,
+        'lambing': LambingRecordForm,
+        'health': HealthRecordForm,
+    }
+    
+    def get(self, request):
+        try:
+            since = int(request.GET.get('since') or 0)
+            limit = api.parse_limit(request.GET)
+        except ValueError as error:
+            message = str(error) if isinstance(error, api.ApiError) else "since must be a cursor from an earlier response"
+            return JsonResponse({'error': message}, status=400)
+        return JsonResponse(sync.changes(since=since, limit=limit))
+    
+    def post(self, request):
+        try:
+            edits = json.loads(request.body).get('edits')
+        except (ValueError, AttributeError):
+            edits = None
+        if not isinstance(edits, list) or not 1 <= len(edits) <= api.MAX_LIMIT:
+            return JsonResponse({'error': f'Send {{"edits": [...]}} with 1 to {api.MAX_LIMIT} edits'}, status=400)
+        saved, results = sync.apply(edits, self.forms)
+        if saved:
+            status = 200
+        elif any(result['status'] == 'conflict' for result in results):
+            status = 409
+        else:
+            status = 400
+        return JsonResponse({'saved': saved, 'results': results}, status=status)
+
+# Background tasks
+def task_url(task, next_url=None):
+    """Page following a task, with a link back to where it was started from"""
+    url = reverse('task-detail', args=[task.pk])
+    return f'{url}?{urlencode({"next": next_url})}' if next_url else url
+
+def task_status(task):
+    """What the task page shows, as JSON for it to poll"""
+    return {
+        'id': task.pk,
+        'name': task.name,
+        'label': tasks.label(task.name),
+        'status': task.status,
+        'finished': task.finished,
+        'attempts': task.attempts,
+        'max_attempts': task.max_attempts,
+        'progress': {
+            'done': task.progress_done,
+            'total': task.progress_total,
+            'percent': task.percent,
+            'message': task.progress_message,
+        },
+        'message': (task.result or {}).get('message') if task.status == 'SUCCEEDED' else None,
+        'download': reverse('task-download', args=[task.pk]) if (task.result or {}).get('file') else None,
+        # The last line of the traceback is the exception itself
+        'error': task.error.strip().splitlines()[-1] if task.error else None,
+    }
+
+class TaskDetailView(LoginRequiredMixin, DetailView):
+    model = Task
+    template_name = 'sheep/task_detail.html'
+    context_object_name = 'task'
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['status'] = task_status(self.object)
+        next_url = self.request.GET.get('next')
+        if next_url and url_has_allowed_host_and_scheme(next_url, {self.request.get_host()}, self.request.is_secure()):
+            context['next_url'] = next_url
+        return context
+
+class TaskApiView(ApiLoginRequiredMixin, View):
+    def get(self, request, pk):
+        task = Task.objects.filter(pk=pk).first()
+        if task is None:
+            return JsonResponse({'error': 'Not found'}, status=404)
+        return JsonResponse(task_status(task))
+
+@login_required
+def task_download(request, pk):
+    task = get_object_or_404(Task, pk=pk, status='SUCCEEDED')
+    result = task.result or {}
+    try:
+        file = open(tasks.file_path(result.get('file')), 'rb')
+    except OSError:
+        raise Http404("The file is no longer kept")
+    return FileResponse(file, as_attachment=True, filename=result.get('download_name', result['file']))
@@ -42,11 +42,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings and query counts cover every other middleware
+    'sheep.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # After authentication, since only staff may ask for a profile
+    'sheep.middleware.RequestProfilerMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -91,6 +95,22 @@ DATABASES = {
 }
 DATABASES['default'] = DATABASES['production']
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# A directory on local disk is shared by every gunicorn worker, so a version
+# bumped by one worker invalidates cached pages in all of them.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'TIMEOUT': 600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -114,6 +134,67 @@ LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'home'
 LOGOUT_REDIRECT_URL = 'home'
 
+# Seconds to cache the rendered body of the sheep detail page; 0 turns the cache off.
+# Use a cache shared by all worker processes so that edits invalidate it everywhere.
+SHEEP_DETAIL_CACHE_TIMEOUT = 600
+
+# Seconds to cache the rendered body of the sheep, breeding and lambing lists and
+# breed pages; 0 turns the cache off. Same caveat as above.
+SHEEP_RESPONSE_CACHE_TIMEOUT = 600
+
+# Send ETag and Last-Modified with sheep, record and API pages, and answer unchanged
+# ones with 304 Not Modified; the validators come from the offline change feed.
+SHEEP_CONDITIONAL_GET = True
+
+# Query counts and timings of every request; staff get them in a Server-Timing header.
+# Requests slower than SHEEP_SLOW_REQUEST_MS milliseconds, or running one statement at
+# least SHEEP_REPEATED_QUERY_THRESHOLD times, are logged to 'sheep.requests' as JSON lines.
+SHEEP_REQUEST_METRICS = True
+SHEEP_SLOW_REQUEST_MS = 500
+SHEEP_REPEATED_QUERY_THRESHOLD = 10
+
+# Where profiles of single requests asked for with ?profile=1 are stored, and how many are kept
+SHEEP_PROFILE_DIR = BASE_DIR / 'profiles'
+SHEEP_PROFILE_KEEP = 50
+
+# Times a statement run outside a transaction is tried again, with a growing wait, when it
+# finds the SQLite database locked; 0 turns the retries off. See sheep/sqlite.py.
+SHEEP_SQLITE_LOCK_RETRIES = 3
+
+# Where backup_database writes compressed backups, and how many of each database are kept
+SHEEP_BACKUP_DIR = BASE_DIR / 'backups'
+SHEEP_BACKUP_KEEP = 14
+
+# Background tasks, run by the run_tasks command. Eager runs them inside the request
+# that queues them, so the development server needs no worker; production turns it off.
+# A running task whose worker has not been heard from in SHEEP_TASK_TIMEOUT seconds is
+# tried again; finished tasks and their files are deleted after SHEEP_TASK_KEEP_DAYS days.
+SHEEP_TASKS_EAGER = True
+SHEEP_TASK_TIMEOUT = 3600
+SHEEP_TASK_KEEP_DAYS = 7
+SHEEP_TASK_FILE_DIR = BASE_DIR / 'task_files'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'slow_requests': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'message',
+        },
+    },
+    'loggers': {
+        'sheep.requests': {
+            'handlers': ['slow_requests'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.1/topics/i18n/
 
@@ -15,11 +15,33 @@ DEBUG = False
 ALLOWED_HOSTS = ['sheep.exnihil.net']
 
 # Database
-# Use SQLite in production
+# Use SQLite in production, tuned for several gunicorn workers sharing it:
+# - WAL lets pages be read while a save is written, instead of waiting for it
+# - synchronous=NORMAL syncs to disk at checkpoints rather than every commit; safe with WAL,
+#   where a power cut can lose the last saves but not corrupt the database
+# - busy_timeout is how long a save waits for another to finish, in milliseconds
+# - cache_size (negative: KiB) and mmap_size (bytes) keep more of the file in memory per connection
+# - IMMEDIATE transactions take the write lock at BEGIN, so one that has read never fails
+#   for want of it later
+# - each worker thread keeps its connection for CONN_MAX_AGE seconds instead of reopening
+#   it and running these pragmas on every request
+# These apply when a connection is opened, and WAL stays on in the file once set.
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.environ.get('DB_NAME', str(BASE_DIR / 'production.db.sqlite3')),
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA busy_timeout=5000;'
+                'PRAGMA cache_size=-20000;'
+                'PRAGMA mmap_size=134217728'
+            ),
+        },
     }
 }
 
@@ -38,3 +60,18 @@ X_FRAME_OPTIONS = 'DENY'
 STATIC_ROOT = '/var/www/sheepmanager/staticfiles'
 MEDIA_ROOT = '/var/www/sheepmanager/media'
 
+# Database backups, outside the application directory
+SHEEP_BACKUP_DIR = os.environ.get('SHEEP_BACKUP_DIR', '/var/backups/sheepmanager')
+
+# Slow work goes to the run_tasks workers instead of holding up a gunicorn worker
+SHEEP_TASKS_EAGER = False
+
+# Slow request log, next to the gunicorn logs. WatchedFileHandler reopens it after logrotate,
+# and delay leaves it unopened until a request is logged, so management commands run as
+# other users do not need write access.
+LOGGING['handlers']['slow_requests'] = {
+    'class': 'logging.handlers.WatchedFileHandler',
+    'filename': os.environ.get('SLOW_REQUEST_LOG', '/var/log/gunicorn/sheepmanager-slow.log'),
+    'formatter': 'message',
+    'delay': True,
+}
@@ -15,13 +15,8 @@ DEBUG = False
 ALLOWED_HOSTS = ['sheep.exnihil.net', 'localhost', '127.0.0.1', '0.0.0.0','192.168.15.211']
 
 # Database
-# Use SQLite in production
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.environ.get('DB_NAME', str(BASE_DIR / 'production.db.sqlite3')),
-    }
-}
+# The same tuned SQLite as production; the options are explained in settings_production.py
+from .settings_production import DATABASES
 
 # Security settings
 SECURE_SSL_REDIRECT = False
@@ -38,3 +33,16 @@ X_FRAME_OPTIONS = 'DENY'
 STATIC_ROOT = '/var/www/sheepmanager/staticfiles'
 MEDIA_ROOT = '/var/www/sheepmanager/media'
 
+# Slow work goes to the run_tasks workers, as in production; run them with
+# --settings=sheepflock.settings_production_dev
+SHEEP_TASKS_EAGER = False
+
+# Slow request log, next to the gunicorn logs. WatchedFileHandler reopens it after logrotate,
+# and delay leaves it unopened until a request is logged, so management commands run as
+# other users do not need write access.
+LOGGING['handlers']['slow_requests'] = {
+    'class': 'logging.handlers.WatchedFileHandler',
+    'filename': os.environ.get('SLOW_REQUEST_LOG', '/var/log/gunicorn/sheepmanager-slow.log'),
+    'formatter': 'message',
+    'delay': True,
+}
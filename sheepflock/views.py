@@ -1,6 +1,8 @@
 from django.views.generic import TemplateView
 from django.contrib.auth.mixins import LoginRequiredMixin
 
+from sheep import dashboard
+
 class HomeView(LoginRequiredMixin, TemplateView):
     template_name = 'home.html'
 
@@ -9,4 +11,6 @@ class HomeView(LoginRequiredMixin, TemplateView):
         context['page_app'] = 'sheepflock'
         context['page_name'] = 'home'
         context['page_action'] = 'view'
+        # Read from running counts, so the cost does not grow with the flock
+        context['dashboard'] = dashboard.summary()
         return context